@@ -57,6 +57,30 @@ class EmailEmitter(AlertEmitter):
                 'message': tmpl.render(cls=alert['clazz'], **alert),
             })
 
+    def emit_digest(self, alerts, options):
+        to = options.get('to')
+        if not to:
+            return
+
+        if len(alerts) == 1:
+            kind, alert = alerts[0]
+            if kind == 'again':
+                self.emit_again(alert, options)
+            else:
+                self.emit_first(alert, options)
+            return
+
+        templates = {
+            kind: Template(filename=os.path.join(TEMPLATES_ROOT, 'email_{0}.mako'.format(kind)))
+            for kind in set(k for k, _ in alerts)
+        }
+
+        self.context.client.call_sync('alert.emitter.email.send', {
+            'to': to,
+            'subject': '{0}: {1} alerts'.format(socket.gethostname(), len(alerts)),
+            'message': '\n\n'.join(templates[kind].render(cls=alert['clazz'], **alert) for kind, alert in alerts),
+        })
+
     def cancel(self, alert, options):
         tmpl = Template(filename=os.path.join(TEMPLATES_ROOT, 'email_cancel.mako'))
         to = options.get('to')
@@ -53,6 +53,14 @@ class PushbulletEmitter(AlertEmitter):
             alert['description']
         )
 
+    def emit_digest(self, alerts, options):
+        api_key = self.context.client.call_sync('alert.emitter.pushbullet.get_api_key')
+        pb = Pushbullet(api_key)
+        pb.push_note(
+            '{0} alerts on {1}'.format(len(alerts), socket.gethostname()),
+            '\n'.join(alert['title'] for _, alert in alerts)
+        )
+
     def cancel(self, alert, options):
         api_key = self.context.client.call_sync('alert.emitter.pushbullet.get_api_key')
         pb = Pushbullet(api_key)
@@ -30,11 +30,14 @@ import os
 import sys
 import logging
 import argparse
+import copy
 import re
 import datastore
 import time
 import json
 import imp
+import heapq
+import queue
 import threading
 from bsd import setproctitle
 from datetime import timedelta, datetime
@@ -47,7 +50,12 @@ from freenas.serviced import checkin
 
 
 DEFAULT_CONFIGFILE = '/usr/local/etc/middleware.conf'
-REMINDER_SECONDS = 3600
+EMITTER_WORKERS = 4
+EMITTER_QUEUE_SIZE = 1024
+EMITTER_RETRIES = 5
+RETRY_BACKOFF = 2
+RETRY_BACKOFF_MAX = 300
+DIGEST_WINDOW = 10
 REMINDER_SCHEDULE = {
     'CRITICAL': 1,
     'WARNING': 12,
@@ -79,6 +87,172 @@ class AlertEmitter(object):
     def cancel(self, alert, options):
         raise NotImplementedError()
 
+    def emit_digest(self, alerts, options):
+        # alerts is a list of (kind, alert) tuples, kind being 'first' or 'again'
+        raise NotImplementedError()
+
+    @property
+    def supports_digest(self):
+        return type(self).emit_digest is not AlertEmitter.emit_digest
+
+
+class FilterIndex(object):
+    """
+    Alert filters with their predicates compiled, grouped by alert class
+    and sorted by the configured filter order.
+    """
+    def __init__(self, context):
+        self.context = context
+        self.lock = threading.Lock()
+        self.filters = {}
+
+    def load(self):
+        order = self.context.configstore.get('alert.filter.order') or []
+        position = {id: i for i, id in enumerate(order)}
+        index = {}
+
+        for i in self.context.datastore.query('alert.filters'):
+            predicates = [
+                (operators_table[pr['operator']], pr['property'], pr['value'])
+                for pr in i.get('predicates', []) if pr['operator'] in operators_table
+            ]
+
+            index.setdefault(i.get('clazz'), []).append((position.get(i['id'], len(order)), i, predicates))
+
+        for filters in index.values():
+            filters.sort(key=lambda f: f[0])
+
+        with self.lock:
+            self.filters = index
+
+    def match(self, alert):
+        with self.lock:
+            candidates = self.filters.get(None, []) + self.filters.get(alert['clazz'], [])
+
+        properties = alert.get('properties') or {}
+        for _, i, predicates in sorted(candidates, key=lambda f: f[0]):
+            for op, prop, value in predicates:
+                try:
+                    if not op(properties.get(prop, alert.get(prop)), value):
+                        break
+                except:
+                    continue
+            else:
+                yield i
+
+
+class Delivery(object):
+    __slots__ = ('name', 'fn', 'args', 'attempts')
+
+    def __init__(self, name, fn, *args):
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.attempts = 0
+
+
+class EmitterPool(object):
+    """
+    Delivers alerts through emitters on a fixed set of worker threads, so
+    that one slow or unreachable emitter doesn't hold up anything else.
+    Emitters implementing emit_digest() get alerts arriving within
+    DIGEST_WINDOW seconds of each other in a single call. Failed deliveries
+    are retried with exponential backoff.
+    """
+    def __init__(self, context, workers=EMITTER_WORKERS):
+        self.context = context
+        self.logger = context.logger
+        self.queue = queue.Queue(EMITTER_QUEUE_SIZE)
+        self.lock = threading.Lock()
+        self.digests = {}
+
+        for _ in range(workers):
+            t = threading.Thread(target=self.worker)
+            t.daemon = True
+            t.start()
+
+    def submit(self, name, emitter, kind, alert, options):
+        if kind == 'cancel' and emitter.supports_digest:
+            # Don't let a digest flushed later announce an alert that has
+            # been cancelled already. If it was never announced through
+            # this emitter at all, there's nothing to cancel either.
+            if self.drop_digested(name, alert['id']):
+                return
+
+        if kind != 'cancel' and emitter.supports_digest:
+            key = (name, json.dumps(options, sort_keys=True, default=str))
+            with self.lock:
+                digest = self.digests.get(key)
+                if digest is None:
+                    digest = self.digests[key] = []
+                    t = threading.Timer(DIGEST_WINDOW, self.flush_digest, args=(key, emitter, options))
+                    t.daemon = True
+                    t.start()
+
+                digest.append((kind, alert))
+            return
+
+        fn = {'first': emitter.emit_first, 'again': emitter.emit_again, 'cancel': emitter.cancel}[kind]
+        self.put(Delivery(name, fn, alert, options))
+
+    def drop_digested(self, name, id):
+        """
+        Removes alert id from digests pending for emitter name. Returns
+        True if a first notification of that alert was among them.
+        """
+        first = False
+        with self.lock:
+            for key, digest in self.digests.items():
+                if key[0] != name:
+                    continue
+
+                for kind, alert in digest:
+                    if alert['id'] == id and kind == 'first':
+                        first = True
+
+                digest[:] = [(k, a) for k, a in digest if a['id'] != id]
+
+        return first
+
+    def flush_digest(self, key, emitter, options):
+        with self.lock:
+            alerts = self.digests.pop(key)
+
+        if not alerts:
+            return
+
+        self.put(Delivery(key[0], emitter.emit_digest, alerts, options))
+
+    def put(self, delivery):
+        try:
+            self.queue.put(delivery, timeout=1)
+        except queue.Full:
+            self.logger.error('Emitter queue full, dropping alert delivery using {0}'.format(delivery.name))
+
+    def worker(self):
+        while True:
+            delivery = self.queue.get()
+            try:
+                delivery.fn(*delivery.args)
+            except BaseException as err:
+                # Failed to emit alert using alert emitter
+                # XXX: generate another alert about that
+                delivery.attempts += 1
+                if delivery.attempts > EMITTER_RETRIES:
+                    self.logger.error('Cannot emit alert using {0}: {1}, giving up'.format(delivery.name, str(err)))
+                    continue
+
+                delay = min(RETRY_BACKOFF * 2 ** (delivery.attempts - 1), RETRY_BACKOFF_MAX)
+                self.logger.warning('Cannot emit alert using {0}: {1}, retrying in {2} seconds'.format(
+                    delivery.name,
+                    str(err),
+                    delay
+                ))
+
+                t = threading.Timer(delay, self.put, args=(delivery,))
+                t.daemon = True
+                t.start()
+
 
 class ManagementService(RpcService):
     def __init__(self, ctx):
@@ -100,7 +274,7 @@ class AlertService(RpcService):
         self.context.emit_alert(alert)
 
     def cancel(self, id):
-        pass
+        self.context.unschedule_reminder(id)
 
 
 class Main(object):
@@ -112,6 +286,11 @@ class Main(object):
         self.client = None
         self.plugin_dirs = []
         self.emitters = {}
+        self.filters = FilterIndex(self)
+        self.emitter_pool = None
+        self.reminders = []
+        self.reminder_due = {}
+        self.reminder_cv = threading.Condition()
 
     def init_datastore(self):
         try:
@@ -131,8 +310,15 @@ class Main(object):
         self.client = Client()
         self.client.on_error(on_error)
         self.connect()
+        self.client.register_event_handler('alert.filter.changed', self.on_filter_changed)
+
+    def init_emitters(self):
+        self.emitter_pool = EmitterPool(self)
 
     def init_reminder(self):
+        for i in self.datastore.query('alerts', ('active', '=', True), ('dismissed', '=', False)):
+            self.schedule_reminder(i)
+
         t = threading.Thread(target=self.reminder_thread)
         t.daemon = True
         t.start()
@@ -156,6 +342,8 @@ class Main(object):
             try:
                 self.client.connect('unix:')
                 self.client.login_service('alertd')
+                # Filters could have changed while we were disconnected
+                self.filters.load()
                 self.client.enable_server()
                 self.client.register_service('alertd.management', ManagementService(self))
                 self.client.register_service('alertd.alert', AlertService(self))
@@ -185,50 +373,33 @@ class Main(object):
             except:
                 self.logger.error('Cannot initialize plugin {0}'.format(f), exc_info=True)
 
+    def on_filter_changed(self, args):
+        self.filters.load()
+
     def emit_alert(self, alert):
         if 'clazz' not in alert or 'id' not in alert:
             self.logger.warning('Ignoring invalid alert <id:{0}>'.format(alert.get('id')))
             return
 
         self.logger.debug('Emitting alert <id:{0}> (class {1})'.format(alert['id'], alert['clazz']))
-        for i in self.datastore.query('alert.filters', ('or', [
-            ('clazz', '=', None),
-            ('clazz', '=', alert['clazz'])
-        ])):
-            for pr in i.get('predicates', []):
-                if pr['operator'] not in operators_table:
-                    continue
+        snapshot = copy.deepcopy(alert)
+        for i in self.filters.match(alert):
+            emitter = self.emitters.get(i['emitter'])
+            if not emitter:
+                self.logger.warning('Invalid emitter {0} for alert filter {1}'.format(i['emitter'], i['id']))
+                continue
 
-                try:
-                    if not operators_table[pr['operator']](alert.properties.get(pr['property']), pr['value']):
-                        break
-                except:
-                    continue
+            self.logger.debug('Alert <id:{0}> matched filter {1}'.format(alert['id'], i['id']))
+            if alert['send_count'] > 0:
+                if not alert['one_shot']:
+                    self.emitter_pool.submit(i['emitter'], emitter, 'again', snapshot, i['parameters'])
             else:
-                try:
-                    emitter = self.emitters.get(i['emitter'])
-                    if not emitter:
-                        self.logger.warning('Invalid emitter {0} for alert filter {1}'.format(i['emitter'], i['id']))
-                        continue
-
-                    self.logger.debug('Alert <id:{0}> matched filter {1}'.format(alert['id'], i['id']))
-                    if alert['send_count'] > 0:
-                        if not alert['one_shot']:
-                            emitter.emit_again(alert, i['parameters'])
-                    else:
-                        emitter.emit_first(alert, i['parameters'])
-                except BaseException as err:
-                    # Failed to emit alert using alert emitter
-                    # XXX: generate another alert about that
-                    self.logger.error('Cannot emit alert <id:{0}> using {1}: {2}'.format(
-                        alert['id'],
-                        i['emitter'],
-                        str(err))
-                    )
+                self.emitter_pool.submit(i['emitter'], emitter, 'first', snapshot, i['parameters'])
 
         alert['send_count'] += 1
         alert['last_emitted_at'] = datetime.utcnow()
         self.datastore.update('alerts', alert['id'], alert)
+        self.schedule_reminder(alert)
 
     def cancel_alert(self, alert):
         self.logger.debug('Cancelling alert <id:{0}> (class {1})'.format(alert['id'], alert['clazz']))
@@ -239,26 +410,54 @@ class Main(object):
         })
 
         self.datastore.update('alerts', alert['id'], alert)
+        self.unschedule_reminder(alert['id'])
 
     def register_emitter(self, name, cls):
         self.emitters[name] = cls(self)
         self.logger.info('Registered emitter {0} (class {1})'.format(name, cls))
 
+    def schedule_reminder(self, alert):
+        interval = REMINDER_SCHEDULE.get(alert['severity'])
+        if not interval or not alert['active'] or alert['dismissed'] or alert['one_shot']:
+            return
+
+        last_emission = alert.get('last_emitted_at') or alert['created_at']
+        due = last_emission + timedelta(hours=interval)
+
+        with self.reminder_cv:
+            self.reminder_due[alert['id']] = due
+            heapq.heappush(self.reminders, (due, alert['id']))
+            self.reminder_cv.notify()
+
+    def unschedule_reminder(self, id):
+        with self.reminder_cv:
+            self.reminder_due.pop(id, None)
+
     def reminder_thread(self):
         while True:
-            time.sleep(REMINDER_SECONDS)
-            for i in self.datastore.query('alerts'):
-                if not i['active'] or i['dismissed']:
-                    continue
+            with self.reminder_cv:
+                while True:
+                    now = datetime.utcnow()
+                    if self.reminders and self.reminders[0][0] <= now:
+                        due, id = heapq.heappop(self.reminders)
+                        # Superseded by a later emission or unscheduled
+                        if self.reminder_due.get(id) != due:
+                            continue
+
+                        del self.reminder_due[id]
+                        break
 
-                last_emission = i.get('last_emitted_at') or i['created_at']
-                interval = REMINDER_SCHEDULE[i['severity']]
+                    timeout = (self.reminders[0][0] - now).total_seconds() if self.reminders else None
+                    self.reminder_cv.wait(timeout)
 
-                if not interval:
+            try:
+                alert = self.datastore.get_by_id('alerts', id)
+                if not alert or not alert['active'] or alert['dismissed']:
                     continue
 
-                if last_emission + timedelta(seconds=interval) <= datetime.utcnow():
-                    self.emit_alert(i)
+                self.emit_alert(alert)
+            except BaseException as err:
+                self.logger.error('Cannot emit reminder for alert <id:{0}>: {1}'.format(id, str(err)), exc_info=True)
 
     def checkin(self):
         checkin()
@@ -273,6 +472,7 @@ class Main(object):
         self.config = args.c
         self.parse_config(self.config)
         self.init_datastore()
+        self.init_emitters()
         self.init_dispatcher()
         self.scan_plugins()
         self.init_reminder()
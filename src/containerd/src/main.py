@@ -87,6 +87,7 @@ MGMT_INTERFACE = 'mgmt0'
 NAT_INTERFACE = 'nat0'
 DEFAULT_CONFIGFILE = '/usr/local/etc/middleware.conf'
 SCROLLBACK_SIZE = 20 * 1024
+CONSOLE_BATCH_DELAY = 0.02
 
 vtx_enabled = False
 svm_features = False
@@ -197,15 +198,96 @@ def unpack_docker_error(err):
 
 
 class BinaryRingBuffer(object):
+    """
+    Fixed size circular byte buffer. Positions are absolute byte counts
+    since the buffer was created, so readers only need to remember where
+    they stopped; a reader falling more than a buffer behind loses the
+    oldest data instead of holding up the writer.
+    """
     def __init__(self, size):
+        self.size = size
         self.data = bytearray(size)
+        self.written = 0
+        self.closed = False
+        self.event = Event()
 
     def push(self, data):
-        del self.data[0:len(data)]
-        self.data += data
+        view = memoryview(data)
+        self.written += max(len(view) - self.size, 0)
+        view = view[-self.size:]
+
+        pos = self.written % self.size
+        first = min(len(view), self.size - pos)
+        self.data[pos:pos + first] = view[:first]
+        self.data[:len(view) - first] = view[first:]
+        self.written += len(view)
+        self.notify()
+
+    def read(self, cursor=0):
+        start = max(cursor, self.written - self.size)
+        length = self.written - start
+        if length <= 0:
+            return b'', self.written
+
+        pos = start % self.size
+        with memoryview(self.data) as view:
+            if pos + length <= self.size:
+                data = bytes(view[pos:pos + length])
+            else:
+                data = b''.join((view[pos:], view[:pos + length - self.size]))
+
+        return data, self.written
+
+    def wait(self, cursor, timeout=None):
+        event = self.event
+        if self.written > cursor or self.closed:
+            return True
+
+        return event.wait(timeout)
+
+    def notify(self):
+        event, self.event = self.event, Event()
+        event.set()
+
+    def close(self):
+        self.closed = True
+        self.notify()
 
-    def read(self):
-        return self.data
+    def reader(self):
+        return BinaryRingReader(self)
+
+
+class BinaryRingReader(object):
+    """
+    Follows a BinaryRingBuffer, starting with its scrollback. Each
+    iteration yields everything written since the previous one.
+    """
+    def __init__(self, ring):
+        self.ring = ring
+        self.cursor = 0
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+        self.ring.notify()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self.closed:
+            data, self.cursor = self.ring.read(self.cursor)
+            if data:
+                return data
+
+            if self.ring.closed:
+                break
+
+            self.ring.wait(self.cursor)
+            # Let more output pile up, so it goes out in fewer messages
+            gevent.sleep(CONSOLE_BATCH_DELAY)
+
+        raise StopIteration
 
 
 class VirtualMachine(object):
@@ -223,7 +305,6 @@ class VirtualMachine(object):
         self.output_thread = None
         self.scrollback = BinaryRingBuffer(SCROLLBACK_SIZE)
         self.console_fd = None
-        self.console_queues = []
         self.console_thread = None
         self.tap_interfaces = {}
         self.vnc_socket = None
@@ -617,8 +698,7 @@ class VirtualMachine(object):
 
         # Clear console
         gevent.kill(self.console_thread)
-        for i in self.console_queues:
-            i.put(b'\033[2J')
+        self.scrollback.push(b'\033[2J')
 
     def set_state(self, state):
         self.logger.debug('State change: {0} -> {1}'.format(self.state, state))
@@ -821,19 +901,12 @@ class VirtualMachine(object):
                 continue
 
             self.scrollback.push(ch)
-            try:
-                for i in self.console_queues:
-                    i.put(ch, block=False)
-            except:
-                pass
 
     def console_register(self):
-        queue = gevent.queue.Queue(4096)
-        self.console_queues.append(queue)
-        return queue
+        return self.scrollback.reader()
 
-    def console_unregister(self, queue):
-        self.console_queues.remove(queue)
+    def console_unregister(self, reader):
+        reader.close()
 
     def console_write(self, data):
         try:
@@ -856,6 +929,121 @@ class Jail(object):
         pass
 
 
+class DockerCache(object):
+    """
+    In-memory copy of containers, networks and images of a single Docker
+    host. Populated once the event stream is set up and kept current from
+    Docker events afterwards, so queries don't hit the Docker API.
+    """
+    def __init__(self, host):
+        self.host = host
+        self.context = host.context
+        self.containers = {}
+        self.networks = {}
+        self.images = {}
+        self.ready = Event()
+
+    @property
+    def connection(self):
+        return self.host.connection
+
+    def sync(self):
+        containers = {}
+        for container in self.connection.containers(all=True):
+            try:
+                containers[container['Id']] = (container, self.connection.inspect_container(container['Id']))
+            except NotFound:
+                continue
+
+        networks = {}
+        for network in self.connection.networks():
+            try:
+                networks[network['Id']] = self.connection.inspect_network(network['Id'])
+            except NotFound:
+                continue
+
+        images = self.connection.images()
+
+        self.clear()
+        for id, container in containers.items():
+            self.containers[id] = container
+            self.context.docker_containers[id] = self.host
+
+        for id, network in networks.items():
+            self.networks[id] = network
+            self.context.docker_networks[id] = self.host
+
+        self.images = {i['Id']: i for i in images}
+        self.ready.set()
+
+    def clear(self):
+        for id in list(self.containers):
+            self.remove_container(id)
+
+        for id in list(self.networks):
+            self.remove_network(id)
+
+        self.images = {}
+
+    def update_container(self, id):
+        try:
+            container = next(iter(self.connection.containers(all=True, filters={'id': id})), None)
+            details = self.connection.inspect_container(id)
+        except NotFound:
+            container = None
+
+        if not container:
+            self.remove_container(id)
+            return
+
+        self.containers[container['Id']] = (container, details)
+        self.context.docker_containers[container['Id']] = self.host
+
+    def remove_container(self, id):
+        self.containers.pop(id, None)
+        if self.context.docker_containers.get(id) is self.host:
+            del self.context.docker_containers[id]
+
+    def update_network(self, id):
+        try:
+            details = self.connection.inspect_network(id)
+        except NotFound:
+            self.remove_network(id)
+            return
+
+        self.networks[details['Id']] = details
+        self.context.docker_networks[details['Id']] = self.host
+
+    def remove_network(self, id):
+        self.networks.pop(id, None)
+        if self.context.docker_networks.get(id) is self.host:
+            del self.context.docker_networks[id]
+
+    def update_images(self):
+        self.images = {i['Id']: i for i in self.connection.images()}
+
+    def on_event(self, ev):
+        if ev['Type'] == 'container':
+            if ev['Action'] == 'destroy':
+                self.remove_container(ev['id'])
+            else:
+                self.update_container(ev['id'])
+
+        if ev['Type'] == 'network':
+            netw_id = q.get(ev, 'Actor.ID')
+            cont_id = q.get(ev, 'Actor.Attributes.container')
+            if ev['Action'] == 'destroy':
+                self.remove_network(netw_id)
+            else:
+                self.update_network(netw_id)
+
+            if cont_id:
+                self.update_container(cont_id)
+
+        if ev['Type'] == 'image':
+            self.update_images()
+
+
 class DockerHost(object):
     def __init__(self, context, vm):
         self.context = context
@@ -866,6 +1054,7 @@ class DockerHost(object):
         self.mapped_ports = {}
         self.active_consoles = {}
         self.ready = Event()
+        self.cache = DockerCache(self)
         self.logger = logging.getLogger(self.__class__.__name__)
         gevent.spawn(self.wait_ready)
 
@@ -965,11 +1154,24 @@ class DockerHost(object):
         while True:
             events = self.connection.events(decode=True)
             self.logger.debug(f'Docker host VM {self.vm.name} starting to listen on events')
-            self.context.client.call_sync('docker.host.refresh_cache', self.vm.id, timeout=600)
-            self.logger.debug(f'Docker host VM {self.vm.name} local cache synced')
             try:
+                # Events are already being buffered, so nothing gets lost between the sync and the first event
+                self.cache.sync()
+                self.context.client.call_sync('docker.host.refresh_cache', self.vm.id, timeout=600)
+                self.logger.debug(f'Docker host VM {self.vm.name} local cache synced')
+
                 for ev in events:
                     self.logger.debug('Received docker event: {0}'.format(ev))
+                    try:
+                        self.cache.on_event(ev)
+                    except Exception as err:
+                        # Don't let one failed lookup end the loop and leave the cache stale for good
+                        self.logger.warning('Cannot update docker cache of {0} from event: {1}, resyncing'.format(
+                            self.vm.name,
+                            unpack_docker_error(err)
+                        ))
+                        self.cache.sync()
+
                     if ev['Type'] == 'container':
                         self.context.client.emit_event('containerd.docker.container.changed', {
                             'operation': actions.get(ev['Action'], 'update'),
@@ -977,8 +1179,8 @@ class DockerHost(object):
                         })
                         name = q.get(ev, 'Actor.Attributes.name')
 
-                        if ev['Action'] == 'die':
-                            details = self.connection.inspect_container(ev['id'])
+                        if ev['Action'] == 'die' and ev['id'] in self.cache.containers:
+                            _, details = self.cache.containers[ev['id']]
                             state = details['State']
                             if not state.get('Running') and state.get('ExitCode') not in (None, 0, 137):
                                 self.context.client.call_sync('alert.emit', {
@@ -1040,7 +1242,7 @@ class DockerHost(object):
                             mapped_ports = []
 
                             # Setup or destroy port redirection now, if needed
-                            details = self.connection.inspect_container(ev['id'])
+                            _, details = self.cache.containers.get(ev['id'], (None, {}))
                             for i in get_docker_ports(details):
                                 if i['host_port'] in mapped_ports:
                                     continue
@@ -1077,7 +1279,7 @@ class DockerHost(object):
                     if ev['Type'] == 'image':
                         image = first_or_default(
                             lambda i: ev['id'] in i['RepoTags'] if isinstance(i['RepoTags'], collections.Iterable) else False,
-                            self.connection.images(),
+                            self.cache.images.values(),
                             default=ev
                         )
                         id = image.get('id') or image.get('Id')
@@ -1128,6 +1330,7 @@ class DockerHost(object):
         return self.active_consoles[id]
 
     def shutdown(self):
+        self.cache.clear()
         p = pf.PF()
         for container_ports in self.mapped_ports.values():
             for i in container_ports:
@@ -1154,7 +1357,7 @@ class ContainerConsole(object):
         self.stdout = None
         self.stderr = None
         self.scrollback = None
-        self.console_queues = []
+        self.console_readers = []
         self.scrollback_t = None
         self.active = False
         self.lock = RLock()
@@ -1200,21 +1403,22 @@ class ContainerConsole(object):
 
     def console_register(self):
         with self.lock:
-            queue = gevent.queue.Queue(4096)
-            self.console_queues.append(queue)
             if not self.active:
                 self.start_console()
 
-            self.logger.debug('Registered a new console queue')
-            return queue
+            reader = self.scrollback.reader()
+            self.console_readers.append(reader)
+            self.logger.debug('Registered a new console reader')
+            return reader
 
-    def console_unregister(self, queue):
+    def console_unregister(self, reader):
         with self.lock:
-            self.console_queues.remove(queue)
+            reader.close()
+            self.console_readers.remove(reader)
 
-            self.logger.debug('Stopped a console queue')
-            if not len(self.console_queues):
-                self.logger.debug('Last console queue stopped. Detaching console')
+            self.logger.debug('Stopped a console reader')
+            if not len(self.console_readers):
+                self.logger.debug('Last console reader stopped. Detaching console')
                 self.stop_console()
 
     def console_write(self, data):
@@ -1225,16 +1429,10 @@ class ContainerConsole(object):
 
         def write(data):
             if data == b'':
-                data = StopIteration
+                self.scrollback.close()
             else:
                 self.scrollback.push(data)
 
-            try:
-                for i in self.console_queues:
-                    i.put(data, block=False)
-            except:
-                pass
-
         while True:
             try:
                 fd_o = self.stdout.fileno()
@@ -1625,13 +1823,9 @@ class DockerService(RpcService):
 
         result = []
         for host in self.context.iterate_docker_hosts():
-            for container in host.connection.containers(all=True):
+            network_ids = {n['Name']: n['Id'] for n in host.cache.networks.values()}
+            for container, details in host.cache.containers.values():
                 obj = {}
-                try:
-                    details = host.connection.inspect_container(container['Id'])
-                except NotFound:
-                    continue
-
                 host_config = q.get(details, 'HostConfig')
                 net_mode = host_config.get('NetworkMode')
                 bridge_enabled = net_mode == 'external'
@@ -1648,11 +1842,9 @@ class DockerService(RpcService):
                 hidden_builtin_networks = ('bridge', 'external', 'host', 'none')
                 # Docker does not assign the <container>.NetworkSettings.Networks.<network>.NetworkID
                 # untill the container is started, hence the below gymnastics to retrive the network id
-                network_names = list(q.get(details, 'NetworkSettings.Networks', {}).keys())
-                if network_names:
-                    for n in host.connection.networks(names=network_names):
-                        if n.get('Name') not in hidden_builtin_networks:
-                            networks.append(n.get('Id'))
+                for n in q.get(details, 'NetworkSettings.Networks', {}).keys():
+                    if n not in hidden_builtin_networks and n in network_ids:
+                        networks.append(network_ids[n])
                 labels = q.get(details, 'Config.Labels')
                 environment = q.get(details, 'Config.Env')
                 names = list(normalize_names(container['Names']))
@@ -1732,10 +1924,9 @@ class DockerService(RpcService):
         result = []
 
         for host in self.context.iterate_docker_hosts():
-            networks = host.connection.networks()
+            networks = host.cache.networks.values()
             networks_containers_map = {n['Name']: [] for n in networks}
-            containers = host.connection.containers(all=True)
-            for c in containers:
+            for c, _ in host.cache.containers.values():
                 network_names = list(q.get(c, 'NetworkSettings.Networks', {}).keys())
                 for n in network_names:
                     try:
@@ -1743,8 +1934,7 @@ class DockerService(RpcService):
                     except KeyError:
                         pass
 
-            for network in networks:
-                details = host.connection.inspect_network(network['Id'])
+            for details in networks:
                 config = q.get(details, 'IPAM.Config.0')
 
                 result.append({
@@ -1763,7 +1953,7 @@ class DockerService(RpcService):
     def query_images(self, filter=None, params=None):
         result = []
         for host in self.context.iterate_docker_hosts():
-            for image in host.connection.images():
+            for image in host.cache.images.values():
                 old_img = first_or_default(lambda o: o['id'] == image['Id'], result)
 
                 if old_img:
@@ -2030,6 +2220,9 @@ class DockerService(RpcService):
                 'Failed to connect container to network: {0}'.format(unpack_docker_error(err))
             )
 
+        host.cache.update_container(container_id)
+        host.cache.update_network(network_id)
+
         if not self.query_containers([('id', '=', container_id)], {'select': 'running', 'single': True}):
             # Docker does not transmit any event when stopped container is connected to network
             # so we must do this
@@ -2052,6 +2245,9 @@ class DockerService(RpcService):
                 'Failed to disconnect container from network: {0}'.format(unpack_docker_error(err))
             )
 
+        host.cache.update_container(container_id)
+        host.cache.update_network(network_id)
+
     def commit_image(self, container_id, new_name):
         host = self.context.docker_host_by_container_id(container_id)
 
@@ -2114,7 +2310,7 @@ class ConsoleConnection(WebSocketApplication, EventEmitter):
         self.context = context
         self.logger = logging.getLogger('ConsoleConnection')
         self.authenticated = False
-        self.console_queue = None
+        self.console_reader = None
         self.console_provider = None
         self.rd = None
         self.wr = None
@@ -2124,10 +2320,7 @@ class ConsoleConnection(WebSocketApplication, EventEmitter):
         self.logger.info('Opening console to %s...', self.console_provider.name)
 
         def read_worker():
-            for data in self.console_queue:
-                if data is None:
-                    return
-
+            for data in self.console_reader:
                 try:
                     self.ws.send(data.replace(b'\n\n', b'\r\n'))
                 except WebSocketError as err:
@@ -2152,11 +2345,8 @@ class ConsoleConnection(WebSocketApplication, EventEmitter):
 
     def on_close(self, *args, **kwargs):
         self.inq.put(StopIteration)
-        if self.console_queue:
-            self.console_queue.put(StopIteration)
-
-        if self.console_provider:
-            self.console_provider.console_unregister(self.console_queue)
+        if self.console_provider and self.console_reader:
+            self.console_provider.console_unregister(self.console_reader)
 
     def on_message(self, message, *args, **kwargs):
         if message is None:
@@ -2197,9 +2387,8 @@ class ConsoleConnection(WebSocketApplication, EventEmitter):
                         return
                     self.console_provider = self.context.vms[cid.id]
 
-            self.console_queue = self.console_provider.console_register()
+            self.console_reader = self.console_provider.console_register()
             self.ws.send(json.dumps({'status': 'ok'}))
-            self.ws.send(self.console_provider.scrollback.read())
 
             gevent.spawn(self.worker)
             return
@@ -2279,6 +2468,8 @@ class Main(object):
         self.vms = {}
         self.failed_autostart_vms = []
         self.docker_hosts = {}
+        self.docker_containers = {}
+        self.docker_networks = {}
         self.tokens = {}
         self.logger = logging.getLogger('containerd')
         self.bridge_interface = None
@@ -2439,24 +2630,25 @@ class Main(object):
                 return i.vm()
 
     def docker_host_by_container_id(self, id):
-        for host in self.docker_hosts.values():
-            try:
-                if host.connection.containers(all=True, quiet=True, filters={'id': id}):
-                    host.ready.wait()
-                    return host
-            except:
-                pass
+        host = self.docker_containers.get(id)
+        if not host and id:
+            # Docker accepts unambiguous ID prefixes as well
+            host = first_or_default(
+                lambda h: any(c.startswith(id) for c in h.cache.containers),
+                self.docker_hosts.values()
+            )
 
-            continue
+        if host and self.docker_hosts.get(host.vm.id) is host:
+            host.ready.wait()
+            return host
 
         raise RpcException(errno.ENOENT, 'Container {0} not found'.format(id))
 
     def docker_host_by_network_id(self, id):
-        for host in self.docker_hosts.values():
-            for n in host.connection.networks():
-                if n['Id'] == id:
-                    host.ready.wait()
-                    return host
+        host = self.docker_networks.get(id)
+        if host and self.docker_hosts.get(host.vm.id) is host:
+            host.ready.wait()
+            return host
 
         raise RpcException(errno.ENOENT, 'Network {0} not found'.format(id))
 
@@ -2471,6 +2663,7 @@ class Main(object):
     def iterate_docker_hosts(self):
         for host in self.docker_hosts.values():
             host.ready.wait()
+            host.cache.ready.wait()
             yield host
 
     def set_docker_api_forwarding(self, hostid):
@@ -26,9 +26,17 @@
 #####################################################################
 
 import re
+import copy
+import uuid
+import threading
 from datastore import DatastoreException
 
 
+CONFIG_CHANGED_EVENT = 'config.changed'
+CONFIG_MARKER_KEY = 'config_marker'
+_MISSING = object()
+
+
 class ConfigNode(object):
     def __init__(self, path, root):
         self.path = path
@@ -89,33 +97,261 @@ class ConfigNode(object):
                 self[k].update(v)
 
 
+class ConfigTree(object):
+    """
+    Prefix tree of config keys, split on dots. Used by the cached ConfigStore
+    to answer children queries without scanning the whole collection.
+    """
+    def __init__(self):
+        self.root = {}
+
+    def __walk(self, key, create=False):
+        node = self.root
+        for i in key.split('.'):
+            child = node.get(i)
+            if child is None:
+                if not create:
+                    return None
+
+                child = node[i] = {}
+
+            node = child
+
+        return node
+
+    def add(self, key):
+        self.__walk(key, True)
+
+    def discard(self, key):
+        parts = key.split('.')
+        path = [self.root]
+        for i in parts:
+            node = path[-1].get(i)
+            if node is None:
+                return
+
+            path.append(node)
+
+        # Prune now-empty branches bottom up
+        for name, node, parent in zip(reversed(parts), reversed(path[1:]), reversed(path[:-1])):
+            if node:
+                break
+
+            del parent[name]
+
+    def children(self, key):
+        node = self.__walk(key) if key else self.root
+        return list(node.keys()) if node else []
+
+    def descendants(self, key=None):
+        node = self.__walk(key) if key else self.root
+        if not node:
+            return
+
+        stack = [(key, node)]
+        while stack:
+            prefix, node = stack.pop()
+            for name, child in node.items():
+                path = prefix + '.' + name if prefix else name
+                yield path
+                stack.append((path, child))
+
+
 class ConfigStore(object):
-    def __init__(self, datastore):
+    """
+    Accessor for the 'config' collection.
+
+    With cache=True the whole collection is loaded once and kept in memory,
+    keyed by path, with a prefix tree for children lookups. Writes done through
+    set() update the cache and are announced via the notify callback (normally
+    emitting a 'config.changed' event); writes done by other processes have to
+    be fed back through invalidate().
+
+    The event may well arrive after a request made on the strength of the
+    write it announces, so every write also stores a fresh token under
+    CONFIG_MARKER_KEY. check() compares it against the token seen when the
+    cache was loaded, and is meant to be called at the start of every
+    request that must see writes made by its caller.
+    """
+    def __init__(self, datastore, cache=False, notify=None):
         self.__datastore = datastore
         if not self.__datastore.collection_exists('config'):
             raise DatastoreException("'config' collection doesn't exist")
 
+        self.__cached = cache
+        self.__notify = notify
+        self.__lock = threading.RLock()
+        self.__values = None
+        self.__tree = None
+        self.__stale = set()
+        self.__marker = None
+
     @staticmethod
     def create(datastore):
         datastore.collection_create('config', 'ltree', 'config')
 
+    @property
+    def cached(self):
+        return self.__cached
+
+    def __get_marker(self):
+        ret = self.__datastore.get_one('config', ('id', '=', CONFIG_MARKER_KEY))
+        return ret['value'] if ret is not None else None
+
+    def __load(self):
+        values = {}
+        tree = ConfigTree()
+        # Read the marker first, so that anything written while loading
+        # makes the next check() reload
+        marker = self.__get_marker()
+        for i in self.__datastore.query('config', wrap=False):
+            if i['id'] == CONFIG_MARKER_KEY:
+                continue
+
+            values[i['id']] = i['value']
+            tree.add(i['id'])
+
+        self.__values = values
+        self.__tree = tree
+        self.__marker = marker
+        self.__stale.clear()
+
+    def __refresh(self, key):
+        ret = self.__datastore.get_one('config', ('id', '=', key))
+        if ret is None:
+            if self.__values.pop(key, _MISSING) is not _MISSING:
+                self.__tree.discard(key)
+            return
+
+        if key not in self.__values:
+            self.__tree.add(key)
+
+        self.__values[key] = ret['value']
+
+    def __sync(self, key=None):
+        # Caller must hold self.__lock
+        if self.__values is None:
+            self.__load()
+            return
+
+        if not self.__stale:
+            return
+
+        if key is None:
+            stale = list(self.__stale)
+        else:
+            stale = [k for k in self.__stale if k == key or k.startswith(key + '.')]
+
+        for k in stale:
+            self.__refresh(k)
+            self.__stale.discard(k)
+
+    def __lookup(self, key):
+        with self.__lock:
+            self.__sync(key)
+            value = self.__values.get(key, _MISSING)
+
+        if isinstance(value, (dict, list)):
+            return copy.deepcopy(value)
+
+        return value
+
+    def __items(self, keys):
+        for k in keys:
+            v = self.__values.get(k, _MISSING)
+            if v is not _MISSING:
+                yield k, v
+
+    def invalidate(self, keys=None):
+        if not self.__cached:
+            return
+
+        with self.__lock:
+            if keys is None:
+                self.__values = None
+                self.__tree = None
+                self.__stale.clear()
+                return
+
+            if self.__values is not None:
+                self.__stale.update(keys)
+
+    def check(self):
+        """
+        Drops the cache if the collection has been written to by anybody,
+        including us, since it was loaded.
+        """
+        if not self.__cached:
+            return
+
+        with self.__lock:
+            if self.__values is not None and self.__get_marker() != self.__marker:
+                self.__values = None
+                self.__tree = None
+                self.__stale.clear()
+
+    def mark_changed(self):
+        """
+        Makes check() in every process drop its cache. Needs to be called
+        after writing the collection other than through set().
+        """
+        self.__datastore.upsert('config', CONFIG_MARKER_KEY, uuid.uuid4().hex, config=True)
+
     def exists(self, key):
+        if self.__cached:
+            return self.__lookup(key) is not _MISSING
+
         return self.__datastore.exists('config', ('id', '=', key))
 
     def get(self, key, default=None):
+        if self.__cached:
+            value = self.__lookup(key)
+            return default if value is _MISSING else value
+
         ret = self.__datastore.get_one('config', ('id', '=', key))
         return ret['value'] if ret is not None else default
 
     def set(self, key, value):
         self.__datastore.upsert('config', key, value, config=True)
+        self.mark_changed()
+        if self.__cached:
+            with self.__lock:
+                if self.__values is not None:
+                    if key not in self.__values:
+                        self.__tree.add(key)
+
+                    self.__values[key] = copy.deepcopy(value)
+                    self.__stale.discard(key)
+
+        if self.__notify:
+            self.__notify([key])
 
     def list_children(self, key=None):
+        if self.__cached:
+            with self.__lock:
+                self.__sync(key)
+                keys = list(self.__tree.descendants(key))
+                return [{'id': k, 'value': copy.deepcopy(v)} for k, v in self.__items(keys)]
+
         if key is None:
-            return self.__datastore.query('config', wrap=False)
+            return [i for i in self.__datastore.query('config', wrap=False) if i['id'] != CONFIG_MARKER_KEY]
         return self.__datastore.query('config', ('id', '~', '^' + key + '\..*'), wrap=False)
 
     def children_dict(self, root):
         result = {}
+        if self.__cached:
+            with self.__lock:
+                self.__sync(root)
+                for child in self.__tree.children(root):
+                    if not re.match(r'^[a-zA-Z0-9_]+$', child):
+                        continue
+
+                    prefix = root + '.' + child
+                    for k, v in self.__items(self.__tree.descendants(prefix)):
+                        result.setdefault(child, {})[k[len(prefix) + 1:]] = copy.deepcopy(v)
+
+            return result
+
         for item in self.__datastore.query('config', ('id', '~', '^' + re.escape(root) + '\.[a-zA-Z0-9_]+\.')):
             matched = item['id'][len(root) + 1:]
             key, _, value = matched.partition('.')
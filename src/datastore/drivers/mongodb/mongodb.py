@@ -25,9 +25,11 @@
 #
 #####################################################################
 
+import re
 import time
 import copy
 import uuid
+import threading
 import dateutil.parser
 import bson
 import pymongo
@@ -63,6 +65,10 @@ class MongodbDatastore(object):
         self.conn_db = None
         self.db = None
         self.connected = False
+        self.collections = {}
+        self.pkey_block_size = 1
+        self.pkey_blocks = {}
+        self.pkey_lock = threading.Lock()
         self.operators_table = {
             '>': '$gt',
             '<': '$lt',
@@ -134,8 +140,19 @@ class MongodbDatastore(object):
 
         return {'$and': result} if len(result) > 0 else {}
 
+    def _get_collection(self, name):
+        # Collection metadata is cached in-process. Only positive lookups are
+        # cached, so collections created by other processes are still seen.
+        c = self.collections.get(name)
+        if c is None:
+            c = self.db['collections'].find_one({"_id": name})
+            if c:
+                self.collections[name] = c
+
+        return c
+
     def _get_db(self, collection):
-        c = self.db['collections'].find_one({"_id": collection})
+        c = self._get_collection(collection)
         if not c:
             raise DatastoreException('Collection {0} not found'.format(collection))
 
@@ -156,6 +173,7 @@ class MongodbDatastore(object):
         unique_indexes = attributes.get('unique_indexes', [])
         cap = attributes.get('cap')
 
+        self.collections.pop(name, None)
         if not self.db['collections'].find_one(name):
             self.db['collections'].insert({
                 '_id': name,
@@ -184,7 +202,7 @@ class MongodbDatastore(object):
 
     @auto_retry
     def collection_exists(self, name):
-        return self.db['collections'].find_one({"_id": name}) is not None
+        return self._get_collection(name) is not None
 
     @auto_retry
     def collection_get_attrs(self, name):
@@ -217,6 +235,7 @@ class MongodbDatastore(object):
         migs = item.setdefault('migrations', [])
         migs.append(migration_name)
         self.db['collections'].update({'_id': name}, item)
+        self.collections.pop(name, None)
 
     @auto_retry
     def collection_list(self):
@@ -229,10 +248,16 @@ class MongodbDatastore(object):
 
         self._get_db(name).drop()
         self.db['collections'].remove({'_id': name})
+        self.db['counters'].delete_one({'_id': name})
+        self.collections.pop(name, None)
+        self.pkey_blocks.pop(name, None)
 
     @auto_retry
     def collection_get_pkey_type(self, name):
-        item = self.db['collections'].find_one({"_id": name})
+        item = self._get_collection(name)
+        if not item:
+            raise DatastoreException('Collection {0} not found'.format(name))
+
         return item['pkey-type']
 
     @auto_retry
@@ -240,16 +265,81 @@ class MongodbDatastore(object):
         item = self.db['collections'].find_one({"_id": name})
         item['pkey-type'] = type
         self.db['collections'].replace_one({'_id': name}, item)
+        self.collections.pop(name, None)
+
+    def _seed_counter(self, counter, value):
+        try:
+            self.db['counters'].insert_one({'_id': counter, 'seq': value})
+        except pymongo.errors.DuplicateKeyError:
+            self.db['counters'].update_one({'_id': counter}, {'$max': {'seq': value}})
+
+    def _get_max_serial(self, collection):
+        ret = self._get_db(collection).find_one(
+            {
+                '$or': [
+                    {'_id': {'$type': 16}},  # BSON int32
+                    {'_id': {'$type': 18}}   # BSON int64
+                ]
+            },
+            sort=[('_id', pymongo.DESCENDING)]
+        )
+
+        return ret['_id'] if ret else 0
+
+    def _get_max_prefixed(self, collection, prefix):
+        result = -1
+        for i in self._get_db(collection).find({'_id': {'$regex': '^{0}[0-9]+$'.format(re.escape(prefix))}}, {'_id': 1}):
+            result = max(result, int(i['_id'][len(prefix):]))
+
+        return result
+
+    def _allocate_ids(self, counter, count, seed):
+        # Atomically reserve `count` consecutive ids, returns the last one.
+        # `seed` is called to initialize the counter the first time it's used.
+        ret = self.db['counters'].find_one_and_update(
+            {'_id': counter},
+            {'$inc': {'seq': count}},
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+
+        if ret is None:
+            self._seed_counter(counter, seed())
+            return self._allocate_ids(counter, count, seed)
+
+        return ret['seq']
+
+    def _next_serial(self, collection, reseed=False):
+        if reseed:
+            # Somebody inserted documents with explicit keys past our counter
+            with self.pkey_lock:
+                self.pkey_blocks.pop(collection, None)
+
+            self._seed_counter(collection, self._get_max_serial(collection))
+
+        with self.pkey_lock:
+            block = self.pkey_blocks.get(collection)
+            if block and block[0] <= block[1]:
+                pkey = block[0]
+                block[0] += 1
+                return pkey
+
+        count = self.pkey_block_size
+        last = self._allocate_ids(collection, count, lambda: self._get_max_serial(collection))
+        if count > 1:
+            with self.pkey_lock:
+                self.pkey_blocks[collection] = [last - count + 2, last]
+
+        return last - count + 1
 
     @auto_retry
     def collection_get_next_pkey(self, name, prefix):
-        counter = 0
+        counter = '{0}:{1}'.format(name, prefix)
         while True:
-            pkey = prefix + str(counter)
+            pkey = prefix + str(self._allocate_ids(counter, 1, lambda: self._get_max_prefixed(name, prefix)))
             if not self.exists(name, ('id', '=', pkey)):
                 return pkey
 
-            counter += 1
+            self._seed_counter(counter, self._get_max_prefixed(name, prefix))
 
     @auto_retry
     def query(self, collection, *args, **kwargs):
@@ -403,6 +493,7 @@ class MongodbDatastore(object):
         pkey_type = self.collection_get_pkey_type(collection)
         autopkey = pkey is None and 'id' not in obj
         retries = 100
+        reseed = False
 
         if 'id' in obj:
             pkey = obj.pop('id')
@@ -413,16 +504,7 @@ class MongodbDatastore(object):
         while True:
             if autopkey:
                 if pkey_type in ('serial', 'integer'):
-                    ret = self._get_db(collection).find_one(
-                        {
-                            '$or': [
-                                {'_id': {'$type': 16}},  # BSON int32
-                                {'_id': {'$type': 18}}   # BSON int64
-                            ]
-                        },
-                        sort=[('_id', pymongo.DESCENDING)]
-                    )
-                    pkey = ret['_id'] + 1 if ret else 1
+                    pkey = self._next_serial(collection, reseed)
                 elif pkey_type == 'uuid':
                     pkey = str(uuid.uuid4())
 
@@ -438,12 +520,61 @@ class MongodbDatastore(object):
             except pymongo.errors.DuplicateKeyError:
                 if autopkey and retries > 0:
                     retries -= 1
+                    reseed = True
                     continue
 
                 raise DuplicateKeyException('Document with given key already exists')
 
             return pkey
 
+    @auto_retry
+    def insert_many(self, collection, objs, timestamp=True):
+        """
+        Inserts a batch of documents in a single round trip. Documents without
+        an 'id' get one generated for serial and uuid collections. Returns
+        the list of primary keys.
+        """
+        pkey_type = self.collection_get_pkey_type(collection)
+        t = datetime.utcnow()
+        docs = []
+
+        for obj in objs:
+            if hasattr(obj, '__getstate__'):
+                obj = obj.__getstate__()
+            else:
+                obj = copy.copy(obj)
+
+            pkey = obj.pop('id', None)
+            if pkey is None:
+                if pkey_type in ('serial', 'integer'):
+                    pkey = self._next_serial(collection)
+                elif pkey_type == 'uuid':
+                    pkey = str(uuid.uuid4())
+            elif pkey_type == 'uuid':
+                pkey = pkey.lower()
+
+            obj['_id'] = pkey
+            if timestamp:
+                obj['updated_at'] = t
+                obj['created_at'] = t
+
+            docs.append(obj)
+
+        if not docs:
+            return []
+
+        try:
+            self._get_db(collection).insert_many(docs, ordered=False)
+        except pymongo.errors.BulkWriteError as err:
+            errors = err.details.get('writeErrors', [])
+            if errors and all(e.get('code') == 11000 for e in errors):
+                # Everything else in the batch has been inserted
+                raise DuplicateKeyException('{0} documents with given keys already exist'.format(len(errors)))
+
+            raise DatastoreException('Bulk insert failed: {0}'.format(str(err)))
+
+        return [d['_id'] for d in docs]
+
     @auto_retry
     def update(self, collection, pkey, obj, upsert=False, timestamp=True, config=False):
         if hasattr(obj, '__getstate__'):
@@ -464,16 +595,25 @@ class MongodbDatastore(object):
         if 'id' in obj:
             del obj['id']
 
+        db = self._get_db(collection)
+        t = datetime.utcnow()
         if timestamp:
-            t = datetime.utcnow()
             obj['updated_at'] = t
 
-            if not self.get_by_id(collection, pkey):
-                obj['created_at'] = t
-
         try:
-            db = self._get_db(collection)
-            db.replace_one({'_id': pkey}, obj, upsert=upsert)
+            # Replacement documents cannot carry $setOnInsert, so replace first
+            # and set created_at only if the document has to be inserted
+            ret = db.replace_one({'_id': pkey}, obj)
+            if ret.matched_count == 0 and upsert:
+                doc = dict(obj, _id=pkey)
+                if timestamp:
+                    doc['created_at'] = t
+
+                try:
+                    db.insert_one(doc)
+                except pymongo.errors.DuplicateKeyError:
+                    # Somebody else inserted it in the meantime
+                    db.replace_one({'_id': pkey}, obj)
         except pymongo.errors.DuplicateKeyError:
             raise DuplicateKeyException('Document with given key already exists')
 
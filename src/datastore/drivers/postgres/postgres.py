@@ -232,6 +232,9 @@ class PostgresDatastore(object):
             self.conn.commit()
             return result[0]
 
+    def insert_many(self, collection, objs):
+        return [self.insert(collection, i) for i in objs]
+
     def update(self, collection, pkey, obj):
         if hasattr(obj, '__getstate__'):
             obj = obj.__getstate__()
@@ -146,7 +146,8 @@ class DirectoryServiceCreateTask(Task):
             'enumerate': True,
             'immutable': False,
             'uid_range': None,
-            'gid_range': None
+            'gid_range': None,
+            'cache_ttl': None
         })
 
         # Replace passed in params with normalized ones
@@ -323,6 +324,7 @@ def _init(dispatcher, plugin):
                     {'type': 'integer'}
                 ]
             },
+            'cache_ttl': {'type': ['integer', 'null']},
             'parameters': {'$ref': 'DirectoryParams'},
             'status': {'$ref': 'DirectoryStatus'}
         }
@@ -112,6 +112,11 @@ class StatProvider(Provider):
         ret = self.dispatcher.call_sync('statd.output.get_stats', data_source, params, no_copy=True)
         return {'data': list(ret)}
 
+    @accepts(h.one_of(str, h.array(str)), h.ref('GetStatsParams'))
+    @returns(h.ref('GetStatsColumnsResult'))
+    def get_stats_columns(self, data_source, params):
+        return self.dispatcher.call_sync('statd.output.get_stats_columns', data_source, params, no_copy=True)
+
     def normalize(self, name, value):
         return normalize(name, value)
 
@@ -26,6 +26,10 @@
 #####################################################################
 
 import os
+import time
+import json
+import array
+import socket
 import gevent
 import logging
 import traceback
@@ -37,6 +41,7 @@ import inspect
 import subprocess
 import bsd
 import signal
+import itertools
 from lib.freebsd import get_sysctl
 from threading import Condition
 from datetime import datetime
@@ -59,6 +64,13 @@ import collections
 
 
 TASKWORKER_PATH = '/usr/local/libexec/taskworker'
+TASK_FLUSH_INTERVAL = 2
+TEMPLATE_READY_TIMEOUT = 60
+TEMPLATE_SPAWN_TIMEOUT = 30
+EXECUTOR_POOL_INTERVAL = 5
+EXECUTOR_IDLE_TIMEOUT = 120
+EXECUTORS_MIN = 2
+FINISHED_TASKS_CACHE_SIZE = 256
 ERROR_TYPES = {
     'RpcException': RpcException,
     'TaskException': TaskException,
@@ -85,6 +97,171 @@ class WorkerState(object):
     ASSIGNED = 'ASSIGNED'
     EXECUTING = 'EXECUTING'
     STARTING = 'STARTING'
+    STOPPING = 'STOPPING'
+
+
+class ForkedWorker(object):
+    """
+    Task worker forked off the template process. Mimics the parts of the
+    Popen interface TaskExecutor relies on; exit status is reported by the
+    template, since the worker is not our child.
+    """
+    def __init__(self, pid, fd):
+        self.pid = pid
+        self.stdout = FileObjectPosix(fd, 'rb', close=True)
+        self.returncode = None
+        self.exited = Event()
+
+    def set_exited(self, returncode):
+        self.returncode = returncode
+        self.exited.set()
+
+    def wait(self):
+        self.exited.wait()
+        self.stdout.close()
+        return self.returncode
+
+    def terminate(self):
+        os.kill(self.pid, signal.SIGTERM)
+
+
+class TaskWorkerTemplate(object):
+    """
+    Manages the warm template process that forks task workers with plugin
+    modules already imported (see TemplateContext in taskworker/main.py).
+    """
+    def __init__(self, balancer):
+        self.balancer = balancer
+        self.logger = logging.getLogger('TaskWorkerTemplate')
+        self.proc = None
+        self.sock = None
+        self.ready = Event()
+        self.exiting = False
+        self.pending = {}
+        self.workers = {}
+        self.send_lock = RLock()
+        self.thread = None
+
+    def start(self):
+        self.thread = gevent.spawn(self.supervisor)
+
+    def stop(self):
+        self.exiting = True
+        self.restart()
+
+    def restart(self):
+        # Supervisor will spawn a new template unless we are exiting
+        if self.proc:
+            try:
+                self.proc.terminate()
+            except OSError:
+                pass
+
+    def supervisor(self):
+        while not self.exiting:
+            sock, remote = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                self.proc = Popen(
+                    [TASKWORKER_PATH, '--template', str(remote.fileno())] + self.balancer.dispatcher.plugin_dirs,
+                    close_fds=True,
+                    pass_fds=[remote.fileno()],
+                    preexec_fn=os.setpgrp,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT)
+            except OSError as err:
+                self.logger.error('Cannot spawn task executor template: {0}'.format(str(err)))
+                sock.close()
+                return
+            finally:
+                remote.close()
+
+            self.sock = sock
+            self.logger.debug('Started task executor template as PID {0}'.format(self.proc.pid))
+            output = gevent.spawn(self.output_reader, self.proc)
+
+            try:
+                for line in sock.makefile('rb'):
+                    self.on_message(json.loads(line.decode('utf-8')))
+            except (OSError, ValueError) as err:
+                self.logger.warning('Task executor template connection failed: {0}'.format(str(err)))
+
+            self.ready.clear()
+            self.sock = None
+            sock.close()
+
+            for result, fd in self.pending.values():
+                os.close(fd)
+                result.set_exception(OSError(errno.ECONNRESET, 'Task executor template died'))
+
+            # Orphaned workers will be reparented, so we won't learn their exit status
+            for worker in self.workers.values():
+                worker.set_exited(None)
+
+            self.pending.clear()
+            self.workers.clear()
+            self.proc.wait()
+            output.join()
+            self.logger.warning('Task executor template exited with code {0}'.format(self.proc.returncode))
+            gevent.sleep(1)
+
+    def output_reader(self, proc):
+        for line in proc.stdout:
+            self.logger.debug('Template: {0}'.format(line.decode('utf8').strip()))
+
+    def on_message(self, msg):
+        if msg['event'] == 'ready':
+            self.logger.info('Task executor template ready, {0} modules preloaded'.format(msg['modules']))
+            self.ready.set()
+
+        elif msg['event'] == 'started':
+            if msg['key'] not in self.pending:
+                # Nobody is waiting for this one anymore (spawn timed out)
+                self.logger.warning('Killing orphaned task executor PID {0}'.format(msg['pid']))
+                try:
+                    os.kill(msg['pid'], signal.SIGKILL)
+                except OSError:
+                    pass
+
+                return
+
+            result, fd = self.pending.pop(msg['key'])
+            worker = ForkedWorker(msg['pid'], fd)
+            self.workers[worker.pid] = worker
+            result.set(worker)
+
+        elif msg['event'] == 'exited':
+            worker = self.workers.pop(msg['pid'], None)
+            if worker:
+                worker.set_exited(msg['returncode'])
+
+    def spawn(self, key, index):
+        if not self.ready.is_set():
+            return None
+
+        rfd, wfd = os.pipe()
+        result = AsyncResult()
+        self.pending[key] = (result, rfd)
+
+        try:
+            with self.send_lock:
+                self.sock.sendmsg(
+                    [json.dumps({'key': key, 'index': index}).encode('utf-8') + b'\n'],
+                    [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [wfd]))]
+                )
+        except (OSError, AttributeError):
+            self.pending.pop(key, None)
+            os.close(rfd)
+            raise OSError(errno.ECONNRESET, 'Task executor template is not running')
+        finally:
+            os.close(wfd)
+
+        try:
+            return result.get(timeout=TEMPLATE_SPAWN_TIMEOUT)
+        except gevent.Timeout:
+            if self.pending.pop(key, None):
+                os.close(rfd)
+
+            raise
 
 
 class TaskExecutor(object):
@@ -100,6 +277,7 @@ class TaskExecutor(object):
         self.result = AsyncResult()
         self.exiting = False
         self.killed = False
+        self.idle_since = None
         self.thread = gevent.spawn(self.executor)
         self.cv = Condition()
         self.status_lock = RLock()
@@ -160,10 +338,6 @@ class TaskExecutor(object):
         self.conn.call_sync('taskproxy.update_env', env)
 
     def run(self, task):
-        def match_file(module, f):
-            name, ext = os.path.splitext(f)
-            return module == name and ext in ['.py', '.pyc', '.so']
-
         with self.cv:
             self.cv.wait_for(lambda: self.state == WorkerState.ASSIGNED)
             self.result = AsyncResult()
@@ -174,22 +348,7 @@ class TaskExecutor(object):
 
         self.balancer.logger.debug('Actually starting task {0}'.format(task.id))
 
-        filename = None
-        module_name = inspect.getmodule(task.clazz).__name__
-        for dir in self.balancer.dispatcher.plugin_dirs:
-            found = False
-            try:
-                for root, _, files in os.walk(dir):
-                    file = first_or_default(lambda f: match_file(module_name, f), files)
-                    if file:
-                        filename = os.path.join(root, file)
-                        found = True
-                        break
-
-                if found:
-                    break
-            except OSError:
-                continue
+        filename = self.balancer.get_module_filename(inspect.getmodule(task.clazz).__name__)
 
         try:
             self.conn.call_sync('taskproxy.run', {
@@ -267,7 +426,7 @@ class TaskExecutor(object):
             self.terminate()
 
             # Now kill all the subtasks
-            for subtask in filter(lambda t: t.parent is self.task, self.balancer.task_list):
+            for subtask in self.balancer.task_list.get_children(self.task):
                 self.balancer.logger.warning("Aborting subtask {0} because parent task {1} died".format(
                     subtask.id,
                     self.task.id
@@ -283,12 +442,24 @@ class TaskExecutor(object):
     def executor(self):
         while not self.exiting:
             try:
-                self.proc = Popen(
-                    [TASKWORKER_PATH, self.key, str(self.index)],
-                    close_fds=True,
-                    preexec_fn=os.setpgrp,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT)
+                self.proc = None
+                try:
+                    self.proc = self.balancer.template.spawn(self.key, self.index)
+                except (OSError, gevent.Timeout) as err:
+                    self.balancer.logger.warning('Cannot fork executor #{0} from template: {1}'.format(
+                        self.index,
+                        str(err)
+                    ))
+                    # A late fork from the template must not check in as this executor
+                    self.key = str(uuid.uuid4())
+
+                if not self.proc:
+                    self.proc = Popen(
+                        [TASKWORKER_PATH, self.key, str(self.index)],
+                        close_fds=True,
+                        preexec_fn=os.setpgrp,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT)
 
                 self.pid = self.proc.pid
                 self.balancer.logger.debug('Started executor #{0} as PID {1}'.format(self.index, self.pid))
@@ -333,6 +504,117 @@ class TaskExecutor(object):
             self.terminate()
 
 
+class TaskList(object):
+    """
+    Tasks known to the balancer, indexed by id and by parent id. Removed
+    (finished) tasks are kept around in a small LRU so that lookups of
+    recently finished tasks stay cheap.
+    """
+    def __init__(self, finished_size=FINISHED_TASKS_CACHE_SIZE):
+        self.tasks = collections.OrderedDict()
+        self.children = {}
+        self.finished = collections.OrderedDict()
+        self.finished_size = finished_size
+
+    def __iter__(self):
+        return iter(list(self.tasks.values()))
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def append(self, task):
+        self.tasks[task.id] = task
+        if task.parent:
+            self.children.setdefault(task.parent.id, collections.OrderedDict())[task.id] = task
+
+    def remove(self, task):
+        if self.tasks.get(task.id) is not task:
+            raise ValueError('Task {0} not in list'.format(task.id))
+
+        del self.tasks[task.id]
+        if task.parent:
+            siblings = self.children.get(task.parent.id)
+            if siblings is not None:
+                siblings.pop(task.id, None)
+                if not siblings:
+                    del self.children[task.parent.id]
+
+        self.retire(task)
+
+    def retire(self, task):
+        self.finished[task.id] = task
+        self.finished.move_to_end(task.id)
+        while len(self.finished) > self.finished_size:
+            self.finished.popitem(last=False)
+
+    def get(self, id):
+        task = self.tasks.get(id)
+        if task is None:
+            task = self.finished.get(id)
+            if task is not None:
+                self.finished.move_to_end(id)
+
+        return task
+
+    def get_children(self, parent):
+        return list(self.children.get(parent.id, {}).values())
+
+
+class TaskLogWriter(object):
+    """
+    Write-behind buffer for task documents in the log datastore. Updates that
+    do not change the task state are coalesced per task and written out at
+    most once per TASK_FLUSH_INTERVAL; state transitions are written through
+    immediately.
+    """
+    def __init__(self, balancer):
+        self.balancer = balancer
+        self.logger = logging.getLogger('TaskLogWriter')
+        self.pending = {}
+        self.lock = RLock()
+        self.thread = None
+
+    def start(self):
+        self.thread = gevent.spawn(self.flush_thread)
+
+    def write(self, task, immediate=False):
+        with self.lock:
+            if not immediate:
+                self.pending[task.id] = task
+                return
+
+            self.pending.pop(task.id, None)
+
+        self.__write(task)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        tasks = list(pending.values())
+        for idx, task in enumerate(tasks):
+            try:
+                self.__write(task)
+            except BaseException:
+                # Put back whatever was not written, unless a newer update
+                # for the same task has been queued in the meantime
+                with self.lock:
+                    for t in tasks[idx:]:
+                        self.pending.setdefault(t.id, t)
+                raise
+
+    def flush_thread(self):
+        while True:
+            gevent.sleep(TASK_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as err:
+                self.logger.warning('Cannot flush task state: {0}'.format(str(err)))
+
+    def __write(self, task):
+        self.balancer.dispatcher.datastore_log.update('tasks', task.id, task)
+
+
 class Task(object):
     def __init__(self, dispatcher, name=None):
         self.dispatcher = dispatcher
@@ -416,6 +698,14 @@ class Task(object):
 
     def set_state(self, state=None, progress=None, error=None):
         with self.slock:
+            if not state and not error:
+                # Progress update only - nothing to persist, so just send the delta
+                if progress and self.state not in (TaskState.FINISHED, TaskState.FAILED, TaskState.ABORTED):
+                    self.progress = progress
+                    self.__emit_progress()
+
+                return
+
             if state:
                 self.state = state
 
@@ -439,7 +729,7 @@ class Task(object):
                 self.progress = TaskStatus(0)
 
             self.dispatcher.dispatch_event('task.created' if self.state == TaskState.CREATED else 'task.updated', event)
-            self.dispatcher.datastore_log.update('tasks', self.id, self)
+            self.balancer.task_log.write(self, immediate=True)
             self.dispatcher.dispatch_event('task.changed', {
                 'operation': 'create' if state == TaskState.CREATED else 'update',
                 'ids': [self.id]
@@ -452,7 +742,7 @@ class Task(object):
             if self.state in (TaskState.FINISHED, TaskState.FAILED, TaskState.ABORTED):
                 try:
                     # Remove all subtasks
-                    for i in filter(lambda t: t.parent is self, self.balancer.task_list):
+                    for i in self.balancer.task_list.get_children(self):
                         self.balancer.task_list.remove(i)
 
                     # If top-level task, also remove self
@@ -464,15 +754,15 @@ class Task(object):
 
     def set_env(self, key, value):
         self.environment[key] = value
-        self.dispatcher.datastore_log.update('tasks', self.id, self)
+        self.balancer.task_log.write(self)
 
     def set_output(self, output):
         self.output = output
-        self.dispatcher.datastore_log.update('tasks', self.id, self)
+        self.balancer.task_log.write(self)
 
     def add_warning(self, warning):
         self.warnings.append(warning)
-        self.dispatcher.datastore_log.update('tasks', self.id, self)
+        self.balancer.task_log.write(self, immediate=True)
         self.dispatcher.dispatch_event('task.changed', {
             'operation': 'update',
             'ids': [self.id]
@@ -494,11 +784,17 @@ class Task(object):
 class Balancer(object):
     def __init__(self, dispatcher):
         self.dispatcher = dispatcher
-        self.task_list = []
+        self.task_list = TaskList()
         self.task_queue = Queue()
+        self.queued_tasks = {}
+        self.task_log = TaskLogWriter(self)
         self.resource_graph = dispatcher.resource_graph
         self.threads = []
         self.executors = []
+        self.executor_index = itertools.count()
+        self.executors_min = EXECUTORS_MIN
+        self.template = TaskWorkerTemplate(self)
+        self.module_filenames = {}
         self.logger = logging.getLogger('Balancer')
         self.dispatcher.require_collection('tasks', 'serial', type='log')
         self.create_initial_queues()
@@ -506,6 +802,15 @@ class Balancer(object):
         self.distribution_lock = RLock()
         self.debugger = None
         self.debugged_tasks = None
+        self.waiting_tasks = {}
+        self.running_tasks = set()
+        self.wait_queues = {}
+        self.wait_missing = set()
+        self.parked_tasks = {}
+        self.wait_sequence = itertools.count()
+        self.rescan_pending = False
+        self.class_priorities = {}
+        self.user_priorities = {}
         self.dispatcher.register_event_type('task.changed')
 
     def clean_stale_tasks(self):
@@ -539,14 +844,103 @@ class Balancer(object):
         self.resource_graph.add_resource(Resource('system'))
 
     def start_executors(self):
-        for i in range(0, max(get_sysctl("hw.ncpu"), 2)):
-            self.logger.info('Starting task executor #{0}...'.format(i))
-            self.executors.append(TaskExecutor(self, i))
+        self.executors_min = self.dispatcher.configstore.get('middleware.executors_min') or EXECUTORS_MIN
+        self.template.start()
+        self.template.ready.wait(TEMPLATE_READY_TIMEOUT)
+
+        for i in range(0, self.executors_min):
+            self.spawn_executor()
+
+    def spawn_executor(self):
+        executor = TaskExecutor(self, next(self.executor_index))
+        self.logger.info('Starting task executor #{0}...'.format(executor.index))
+        self.executors.append(executor)
+        return executor
+
+    def pool_thread(self):
+        """
+        Grows the executor pool ahead of demand when there are more queued
+        tasks than idle executors, and retires executors that stayed idle for
+        EXECUTOR_IDLE_TIMEOUT as long as more than executors_min are left.
+        """
+        while True:
+            gevent.sleep(EXECUTOR_POOL_INTERVAL)
+            now = time.time()
+            idle = []
+            for e in self.executors:
+                if e.state == WorkerState.IDLE:
+                    e.idle_since = e.idle_since or now
+                    idle.append(e)
+                else:
+                    e.idle_since = None
+
+            starting = len([e for e in self.executors if e.state == WorkerState.STARTING])
+            demand = self.task_queue.qsize() - len(idle) - starting
+            for _ in range(0, min(demand, max(get_sysctl("hw.ncpu"), 2))):
+                self.spawn_executor()
+
+            if demand > 0:
+                continue
+
+            for e in sorted(idle, key=lambda e: e.idle_since):
+                if len(self.executors) <= self.executors_min:
+                    break
+
+                if now - e.idle_since < EXECUTOR_IDLE_TIMEOUT:
+                    break
+
+                with e.cv:
+                    if e.state != WorkerState.IDLE:
+                        continue
+
+                    e.state = WorkerState.STOPPING
+
+                self.logger.info('Retiring idle task executor #{0}'.format(e.index))
+                self.executors.remove(e)
+                e.die()
+
+    def get_module_filename(self, module_name):
+        filename = self.module_filenames.get(module_name)
+        if filename:
+            return filename
+
+        for dir in self.dispatcher.plugin_dirs:
+            try:
+                for root, _, files in os.walk(dir):
+                    for f in files:
+                        name, ext = os.path.splitext(f)
+                        if ext in ('.py', '.pyc', '.so'):
+                            self.module_filenames.setdefault(name, os.path.join(root, f))
+            except OSError:
+                continue
+
+        return self.module_filenames.get(module_name)
+
+    def load_priorities(self):
+        self.class_priorities = self.dispatcher.configstore.get('middleware.task_class_priorities') or {}
+        self.user_priorities = self.dispatcher.configstore.get('middleware.task_user_priorities') or {}
+
+    def get_task_priority(self, task):
+        """
+        Lower value means higher priority. Task classes may declare a default
+        `priority` attribute, which can be overridden per task name pattern;
+        per-user adjustments are added on top of that.
+        """
+        priority = getattr(task.clazz, 'priority', 0)
+        for pattern, value in self.class_priorities.items():
+            if fnmatch.fnmatch(task.name, pattern):
+                priority = value
+                break
+
+        return priority + self.user_priorities.get(task.user, 0)
 
     def start(self):
+        self.load_priorities()
         self.clean_stale_tasks()
+        self.task_log.start()
         self.start_executors()
         self.threads.append(gevent.spawn(self.distribution_thread))
+        self.threads.append(gevent.spawn(self.pool_thread))
         self.logger.info("Started")
 
     def schema_to_list(self, schema):
@@ -558,16 +952,16 @@ class Balancer(object):
         }
 
     def verify_schema(self, clazz, args, strict=False):
-        params_schema = clazz._get_schema()
-        if not params_schema:
-            return []
+        def get_schema():
+            params_schema = clazz._get_schema()
+            if not params_schema:
+                return None
 
-        schema = self.schema_to_list(params_schema)
-        val = validator.create_validator(schema, resolver=self.dispatcher.rpc.get_schema_resolver(schema))
-        if strict:
-            val.fail_read_only = True
-        else:
-            val.remove_read_only = True
+            return self.schema_to_list(params_schema)
+
+        val = self.dispatcher.rpc.get_validator(clazz, get_schema, strict)
+        if not val:
+            return []
 
         return list(val.iter_errors(args))
 
@@ -603,6 +997,7 @@ class Balancer(object):
         task.environment['SENDER_ADDRESS'] = sender.client_address
         task.environment['ID'] = task.id
         task.set_state(TaskState.CREATED)
+        self.queued_tasks[task.id] = task
         self.task_queue.put(task)
         self.logger.info("Task %d submitted (type: %s, class: %s)", task.id, name, task.clazz)
         return task.id
@@ -695,6 +1090,7 @@ class Balancer(object):
 
         task.set_state(TaskState.CREATED)
         self.task_list.append(task)
+        self.running_tasks.add(task)
 
         task.start()
         return task
@@ -712,6 +1108,8 @@ class Balancer(object):
         success = False
         if task.started_at is None:
             success = True
+            with self.schedule_lock:
+                self.__forget(task)
         else:
             try:
                 task.executor.abort()
@@ -727,36 +1125,99 @@ class Balancer(object):
                 self.logger.debug("Task ID: %d, name: %s aborted by user", task.id, task.name)
 
     def task_exited(self, task):
+        self.running_tasks.discard(task)
         self.resource_graph.release(*task.resources)
-        self.schedule_tasks(True)
+        self.schedule_tasks(True, released=task.resources)
+
+    def resources_changed(self):
+        # Structural changes to the resource graph may unblock any of the
+        # waiting tasks, so coalesce them into a single full rescan
+        if not self.waiting_tasks or self.rescan_pending:
+            return
 
-    def schedule_tasks(self, exit=False):
+        def rescan():
+            self.rescan_pending = False
+            self.schedule_tasks(rescan=True)
+
+        self.rescan_pending = True
+        gevent.spawn(rescan)
+
+    def __park(self, task):
+        self.__unpark(task)
+        missing, busy = self.resource_graph.get_blocking_resources(*task.resources)
+        if missing or not busy:
+            self.wait_missing.add(task)
+
+        for name in busy:
+            self.wait_queues.setdefault(name, set()).add(task)
+
+        self.parked_tasks[task] = busy
+
+    def __unpark(self, task):
+        self.wait_missing.discard(task)
+        for name in self.parked_tasks.pop(task, []):
+            queue = self.wait_queues.get(name)
+            if queue is None:
+                continue
+
+            queue.discard(task)
+            if not queue:
+                del self.wait_queues[name]
+
+    def __forget(self, task):
+        self.__unpark(task)
+        self.waiting_tasks.pop(task, None)
+
+    def schedule_tasks(self, exit=False, task=None, released=None, rescan=False):
         """
         This function is called when:
         1) any new task is submitted to any of the queues
         2) any task exists
+        3) resource graph structure changes
+
+        Waiting tasks are parked on wait queues of the resources they are
+        blocked on, so only tasks waiting for a released resource (or one
+        of its ancestors) are re-tested. Candidates are tried in priority
+        order, oldest first.
         """
         with self.schedule_lock:
             started = 0
-            executing_tasks = [t for t in self.task_list if t.state == TaskState.EXECUTING]
-            waiting_tasks = [t for t in self.task_list if t.state == TaskState.WAITING]
+            candidates = set(self.wait_missing)
+
+            if task:
+                self.waiting_tasks[task] = (self.get_task_priority(task), next(self.wait_sequence))
+                candidates.add(task)
+
+            if released:
+                for name in self.resource_graph.get_resource_ancestors(*released):
+                    candidates.update(self.wait_queues.get(name, ()))
+
+            if rescan:
+                candidates.update(self.waiting_tasks)
 
-            for task in waiting_tasks:
-                if not self.resource_graph.can_acquire(*task.resources):
+            for t in sorted(candidates, key=lambda c: self.waiting_tasks.get(c, (0, 0))):
+                if t not in self.waiting_tasks or t.state != TaskState.WAITING:
+                    self.__forget(t)
                     continue
 
-                self.resource_graph.acquire(*task.resources)
-                self.threads.append(task.start())
+                if not self.resource_graph.can_acquire(*t.resources):
+                    self.__park(t)
+                    continue
+
+                self.__forget(t)
+                self.resource_graph.acquire(*t.resources)
+                self.running_tasks.add(t)
+                self.threads.append(t.start())
                 started += 1
 
-            if not started and not executing_tasks and (exit or len(waiting_tasks) == 1):
-                for task in waiting_tasks:
+            if not started and not self.running_tasks and (exit or len(self.waiting_tasks) == 1):
+                for t in list(self.waiting_tasks):
                     # Check whether or not task waits on nonexistent resources. If it does,
                     # abort it 'cause there's no chance anymore that missing resources will appear.
-                    missing_resources = [r for r in task.resources if self.resource_graph.get_resource(r) is None]
+                    missing_resources = [r for r in t.resources if self.resource_graph.get_resource(r) is None]
                     if missing_resources:
-                        self.logger.warning('Aborting task {0}: deadlock'.format(task.id))
-                        self.abort(task.id, VerifyException(
+                        self.logger.warning('Aborting task {0}: deadlock'.format(t.id))
+                        self.abort(t.id, VerifyException(
                             errno.EBUSY,
                             'Resource deadlock avoided, missing resources: {0}'.format(', '.join(missing_resources))
                         ))
@@ -790,6 +1251,8 @@ class Balancer(object):
                 self.logger.warning("Cannot verify task %d: %s", task.id, err)
                 task.set_state(TaskState.FAILED, TaskStatus(0), serialize_error(err))
                 task.ended.set()
+                self.task_list.retire(task)
+                self.queued_tasks.pop(task.id, None)
                 self.distribution_lock.release()
 
                 if not isinstance(err, VerifyException):
@@ -799,8 +1262,9 @@ class Balancer(object):
 
             task.set_state(TaskState.WAITING)
             self.task_list.append(task)
+            self.queued_tasks.pop(task.id, None)
             self.distribution_lock.release()
-            self.schedule_tasks()
+            self.schedule_tasks(task=task)
             if task.resources:
                 self.logger.debug("Task %d assigned to resources %s", task.id, ','.join(task.resources))
 
@@ -814,8 +1278,7 @@ class Balancer(object):
                     return
 
         # Out of executors! Need to spawn new one
-        executor = TaskExecutor(self, len(self.executors))
-        self.executors.append(executor)
+        executor = self.spawn_executor()
         with executor.cv:
             executor.cv.wait_for(lambda: executor.state == WorkerState.IDLE)
             executor.state = WorkerState.ASSIGNED
@@ -823,9 +1286,12 @@ class Balancer(object):
             self.logger.info("Task %d assigned to executor #%d", task.id, executor.index)
 
     def dispose_executors(self):
+        self.template.stop()
         for i in self.executors:
             i.die()
 
+        self.task_log.flush()
+
     def get_active_tasks(self):
         return [x for x in self.task_list if x.state in (
             TaskState.CREATED,
@@ -835,17 +1301,15 @@ class Balancer(object):
 
     def get_tasks(self, type=None):
         if type is None:
-            return self.task_list
+            return list(self.task_list)
 
         return [x for x in self.task_list if x.state == type]
 
     def get_task(self, id):
-        self.distribution_lock.acquire()
-        t = first_or_default(lambda x: x.id == id, self.task_list)
+        t = self.task_list.get(id)
         if not t:
-            t = first_or_default(lambda x: x.id == id, self.task_queue.queue)
+            t = self.queued_tasks.get(id)
 
-        self.distribution_lock.release()
         return t
 
     def get_executor_by_key(self, key):
@@ -26,7 +26,16 @@
 #####################################################################
 
 
+import re
 import logging
+import collections
+from bsd import fnmatch
+from freenas.dispatcher.jsonenc import dumps
+
+
+GLOB_CHARS = ('*', '?', '[')
+ROUTE_CACHE_SIZE = 4096
+FANOUT_STATS_SIZE = 1024
 
 
 class EventSource(object):
@@ -51,3 +60,172 @@ class EventSource(object):
 def sync(fn):
     fn.sync = True
     return fn
+
+
+class PreparedEvent(object):
+    """
+    Event on its way to subscribed connections. The wire payload is
+    encoded lazily, once, and shared by every recipient.
+    """
+    __slots__ = ('name', 'args', '_payload')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self._payload = None
+
+    @property
+    def payload(self):
+        if self._payload is None:
+            self._payload = dumps({
+                'namespace': 'events',
+                'name': 'event',
+                'id': None,
+                'args': {
+                    'name': self.name,
+                    'args': self.args
+                }
+            })
+
+        return self._payload
+
+
+class EventSubscriptionIndex(object):
+    """
+    Maps event names to the set of connections subscribed to them.
+
+    Exact masks are kept in a dict. Glob masks are stored in a character trie
+    keyed by their literal prefix (everything before the first wildcard), so
+    only masks whose prefix matches the event name are ever fnmatch()-ed.
+    Compiled regular expressions are rare and are checked linearly.
+    Lookups are memoized per event name until subscriptions change.
+    Fanout stats are kept for the FANOUT_STATS_SIZE most recently
+    dispatched event names only.
+    """
+
+    def __init__(self):
+        self.exact = {}
+        self.trie = {}
+        self.patterns = {}
+        self.routes = {}
+        self.fanout = collections.OrderedDict()
+
+    @staticmethod
+    def literal_prefix(mask):
+        for idx, ch in enumerate(mask):
+            if ch in GLOB_CHARS:
+                return mask[:idx]
+
+        return None
+
+    def add(self, mask, conn):
+        self.routes.clear()
+        if isinstance(mask, str):
+            prefix = self.literal_prefix(mask)
+            if prefix is None:
+                self.exact.setdefault(mask, set()).add(conn)
+                return
+
+            node = self.trie
+            for ch in prefix:
+                node = node.setdefault(ch, {})
+
+            node.setdefault(None, {}).setdefault(mask, set()).add(conn)
+            return
+
+        if isinstance(mask, re._pattern_type):
+            self.patterns.setdefault(mask, set()).add(conn)
+
+    def remove(self, mask, conn):
+        self.routes.clear()
+        if isinstance(mask, str):
+            prefix = self.literal_prefix(mask)
+            if prefix is None:
+                conns = self.exact.get(mask)
+                if conns is not None:
+                    conns.discard(conn)
+                    if not conns:
+                        del self.exact[mask]
+                return
+
+            path = [self.trie]
+            for ch in prefix:
+                node = path[-1].get(ch)
+                if node is None:
+                    return
+                path.append(node)
+
+            masks = path[-1].get(None, {})
+            conns = masks.get(mask)
+            if conns is None:
+                return
+
+            conns.discard(conn)
+            if conns:
+                return
+
+            del masks[mask]
+            if not masks:
+                del path[-1][None]
+
+            # Prune empty trie branches
+            for ch, parent, node in zip(reversed(prefix), reversed(path[:-1]), reversed(path[1:])):
+                if node:
+                    break
+                del parent[ch]
+            return
+
+        if isinstance(mask, re._pattern_type):
+            conns = self.patterns.get(mask)
+            if conns is not None:
+                conns.discard(conn)
+                if not conns:
+                    del self.patterns[mask]
+
+    def lookup(self, name):
+        result = self.routes.get(name)
+        if result is not None:
+            return result
+
+        result = set(self.exact.get(name, ()))
+        node = self.trie
+        for ch in name:
+            for mask, conns in node.get(None, {}).items():
+                if fnmatch(name, mask):
+                    result.update(conns)
+
+            node = node.get(ch)
+            if node is None:
+                break
+        else:
+            for mask, conns in node.get(None, {}).items():
+                if fnmatch(name, mask):
+                    result.update(conns)
+
+        for pat, conns in self.patterns.items():
+            if pat.match(name) is not None:
+                result.update(conns)
+
+        result = frozenset(result)
+        if len(self.routes) >= ROUTE_CACHE_SIZE:
+            self.routes.clear()
+
+        self.routes[name] = result
+        return result
+
+    def count(self, name, recipients):
+        counters = self.fanout.get(name)
+        if counters is None:
+            # Names like statd.<series>.pulse are unbounded, so forget the
+            # least recently dispatched ones
+            if len(self.fanout) >= FANOUT_STATS_SIZE:
+                self.fanout.popitem(last=False)
+
+            counters = self.fanout[name] = {'dispatched': 0, 'delivered': 0, 'max_fanout': 0}
+        else:
+            self.fanout.move_to_end(name)
+
+        counters['dispatched'] += 1
+        counters['delivered'] += recipients
+        if recipients > counters['max_fanout']:
+            counters['max_fanout'] = recipients
@@ -28,7 +28,6 @@
 import gevent.monkey
 gevent.monkey.patch_all()
 
-import copy
 import os
 import sys
 import re
@@ -66,11 +65,14 @@ from geventwebsocket import WebSocketApplication, WebSocketError
 
 from datastore import get_datastore
 from datastore.migrate import migrate_db, MigrationException
-from datastore.config import ConfigStore
+from datastore.config import ConfigStore, CONFIG_CHANGED_EVENT
+from freenas.dispatcher import validator
 from freenas.dispatcher.jsonenc import loads, dumps
 from freenas.dispatcher.rpc import RpcContext, RpcException, ServerLockProxy
 from freenas.dispatcher.server import Server, ServerConnection
 from resources import ResourceGraph, ResourceTracker
+from event import EventSubscriptionIndex, PreparedEvent, sync
+from resultcopy import copy_result
 from services import ManagementService, DebugService, EventService, TaskService
 from services import LockService, PluginService, ShellService
 from schemas import register_general_purpose_schemas
@@ -342,6 +344,7 @@ class Dispatcher(object):
         self.logger = logging.getLogger('Main')
         self.token_store = TokenStore(self)
         self.event_delivery_lock = RLock()
+        self.event_subscriptions = EventSubscriptionIndex()
         self.rpc = None
         self.balancer = None
         self.datastore = None
@@ -369,7 +372,7 @@ class Dispatcher(object):
         self.logger.info('Initializing')
 
         self.datastore = get_datastore(self.configfile)
-        self.configstore = ConfigStore(self.datastore)
+        self.configstore = ConfigStore(self.datastore, cache=True, notify=self.config_changed)
 
         self.logger.info('Connected to datastore')
 
@@ -400,6 +403,8 @@ class Dispatcher(object):
         self.register_event_type('server.ready')
         self.register_event_type('server.shutdown')
         self.register_event_type('server.schema_document_changed')
+        self.register_event_type(CONFIG_CHANGED_EVENT)
+        self.register_event_handler(CONFIG_CHANGED_EVENT, self.on_config_changed)
 
     def start(self):
         self.started_at = time.time()
@@ -469,6 +474,10 @@ class Dispatcher(object):
         # And look for new ones
         self.discover_plugins()
 
+        if self.balancer:
+            self.balancer.module_filenames.clear()
+            self.balancer.template.restart()
+
     def unload_plugins(self):
         # Generate a list of inverse plugin dependency
         required_by = {}
@@ -559,9 +568,12 @@ class Dispatcher(object):
             # If there's no timestamp, assume event fired right now
             args.setdefault('timestamp', datetime.datetime.utcnow())
 
-            for srv in self.ws_servers:
-                for conn in srv.connections:
-                    conn.outgoing_events.put((name, args))
+            recipients = self.event_subscriptions.lookup(name)
+            self.event_subscriptions.count(name, len(recipients))
+            if recipients:
+                event = PreparedEvent(name, args)
+                for conn in recipients:
+                    conn.outgoing_events.put(event)
 
         for h in self.event_handlers.get(name, []):
             def wrapper(handler, name):
@@ -578,6 +590,16 @@ class Dispatcher(object):
     def emit_event(self, name, args):
         return self.dispatch_event(name, args)
 
+    def config_changed(self, keys):
+        self.dispatch_event(CONFIG_CHANGED_EVENT, {'keys': keys, 'pid': os.getpid()})
+
+    @sync
+    def on_config_changed(self, args):
+        # Handled synchronously, so that a writer's next RPC call already
+        # sees the new values
+        if args.get('pid') != os.getpid():
+            self.configstore.invalidate(args.get('keys'))
+
     def call_sync(self, name, *args, **kwargs):
         return self.rpc.call_sync(name, *args, **kwargs)
 
@@ -654,6 +676,7 @@ class Dispatcher(object):
 
     def unregister_task_handler(self, name):
         del self.tasks[name]
+        self.rpc.invalidate_validators()
 
     def register_task_hook(self, hook, name, condition=None):
         task_name, hook_name = hook.split(':')
@@ -682,6 +705,7 @@ class Dispatcher(object):
 
     def register_schema_definition(self, name, definition):
         self.rpc.register_schema_definition(name, definition)
+        self.rpc.invalidate_validators()
         if self.ready:
             def emit_changed_event():
                 self.dispatch_event('server.schema_document_changed', {
@@ -692,6 +716,7 @@ class Dispatcher(object):
 
     def unregister_schema_definition(self, name):
         self.rpc.unregister_schema_definition(name)
+        self.rpc.invalidate_validators()
 
     def require_collection(self, collection, pkey_type='uuid', **kwargs):
         if not self.datastore.collection_exists(collection):
@@ -700,23 +725,44 @@ class Dispatcher(object):
     def register_resource(self, res, parents=None, children=None):
         self.logger.debug('Resource added: {0}'.format(res.name))
         self.resource_graph.add_resource(res, parents, children)
+        self.resources_changed()
+
+    def register_resources(self, resources):
+        if resources:
+            self.logger.debug('Resources added: {0}'.format(', '.join(r.name for r, _, _ in resources)))
+            self.resource_graph.add_resources(resources)
+            self.resources_changed()
 
     def update_resource(self, name, new_parents, new_children=None):
         self.logger.log(TRACE, 'Resource updated: {0}, new parents: {1}'.format(name, ', '.join(new_parents)))
         self.resource_graph.update_resource(name, new_parents, new_children)
+        self.resources_changed()
+
+    def update_resources(self, resources):
+        if resources:
+            self.logger.log(TRACE, 'Resources updated: {0}'.format(', '.join(n for n, _, _ in resources)))
+            self.resource_graph.update_resources(resources)
+            self.resources_changed()
 
     def rename_resource(self, oldname, newname):
         self.logger.log(TRACE, 'Resource renamed: {0} ->{1}'.format(oldname, newname))
         self.resource_graph.rename_resource(oldname, newname)
+        self.resources_changed()
 
     def unregister_resource(self, name):
         self.logger.debug('Resource removed: {0}'.format(name))
         self.resource_graph.remove_resource(name)
+        self.resources_changed()
 
     def unregister_resources(self, names):
         if names:
             self.logger.debug('Resources removed: {0}'.format(', '.join(names)))
             self.resource_graph.remove_resources(names)
+            self.resources_changed()
+
+    def resources_changed(self):
+        if self.balancer:
+            self.balancer.resources_changed()
 
     def resource_exists(self, name):
         return self.resource_graph.get_resource(name) is not None
@@ -871,6 +917,33 @@ class DispatcherRpcContext(RpcContext):
     def __init__(self, dispatcher):
         super(DispatcherRpcContext, self).__init__()
         self.dispatcher = dispatcher
+        self.validators = {}
+
+    def get_validator(self, key, schema_factory, strict=False):
+        """
+        Returns a compiled validator for the schema produced by schema_factory,
+        cached under (key, strict) until the schema document changes. Returns
+        None if there is no schema to validate against.
+        """
+        try:
+            return self.validators[(key, strict)]
+        except KeyError:
+            pass
+
+        schema = schema_factory()
+        val = None
+        if schema:
+            val = validator.create_validator(schema, resolver=self.get_schema_resolver(schema))
+            if strict:
+                val.fail_read_only = True
+            else:
+                val.remove_read_only = True
+
+        self.validators[(key, strict)] = val
+        return val
+
+    def invalidate_validators(self):
+        self.validators.clear()
 
     def call_sync(self, name, *args, **kwargs):
         no_copy = kwargs.pop('no_copy', False)
@@ -878,13 +951,13 @@ class DispatcherRpcContext(RpcContext):
         def unpack_chunk(it):
             for chunk in it:
                 for item in chunk:
-                    yield item if no_copy else copy.deepcopy(item)
+                    yield item if no_copy else copy_result(item)
 
         result = self.dispatch_call(name, list(args), streaming=True, validation=False)
         if hasattr(result, '__next__'):
             return unpack_chunk(result)
 
-        return result if no_copy else copy.deepcopy(result)
+        return result if no_copy else copy_result(result)
 
 
 class DispatcherConnection(ServerConnection):
@@ -922,8 +995,8 @@ class DispatcherConnection(ServerConnection):
         }
 
     def __event_worker(self):
-        for name, args in self.outgoing_events:
-            self.emit_event(name, args)
+        for event in self.outgoing_events:
+            self.send_prepared_event(event)
 
     def log(self, level, msg):
         self.logger.log(level, '[{0}] {1}'.format(self.client_address, msg))
@@ -953,6 +1026,7 @@ class DispatcherConnection(ServerConnection):
                 if match_event(name, mask):
                     ev.decref()
 
+            self.dispatcher.event_subscriptions.remove(mask, self)
             self.event_masks.remove(mask)
 
         self.outgoing_events.put(StopIteration)
@@ -999,6 +1073,8 @@ class DispatcherConnection(ServerConnection):
                     if match_event(name, mask):
                         ev.incref()
 
+                self.dispatcher.event_subscriptions.add(mask, self)
+
             self.event_masks = set.union(self.event_masks, set(event_masks))
 
     def on_events_unsubscribe(self, id, event_masks):
@@ -1022,6 +1098,8 @@ class DispatcherConnection(ServerConnection):
                     if match_event(name, mask):
                         ev.decref()
 
+                self.dispatcher.event_subscriptions.remove(mask, self)
+
             self.event_masks = set.difference(self.event_masks, intersecting_unsubscribe_events)
 
     def on_events_event(self, id, data):
@@ -1256,6 +1334,16 @@ class DispatcherConnection(ServerConnection):
                 continue
 
             self.send_event(event, args)
+            return
+
+    def send_prepared_event(self, event):
+        if not self.transport:
+            return
+
+        try:
+            self.transport.send(event.payload, [])
+        except (OSError, WebSocketError) as err:
+            self.trace('Cannot deliver event {0}: {1}'.format(event.name, err))
 
     def emit_rpc_call(self, id, method, args):
         return self.send_call(id, method, args)
@@ -36,6 +36,7 @@ class Resource(object):
     def __init__(self, name):
         self.name = name
         self.busy = False
+        self.busy_descendants = 0
 
     def __str__(self):
         return "<Resource '{0}'>".format(self.name)
@@ -55,6 +56,8 @@ class ResourceGraph(object):
         self.root = Resource('root')
         self.resources = nx.DiGraph()
         self.resources.add_node(self.root)
+        self.index = {self.root.name: self.root}
+        self.busy = set()
 
     def lock(self):
         self.mutex.acquire()
@@ -66,91 +69,183 @@ class ResourceGraph(object):
     def nodes(self):
         return self.resources.nodes()
 
+    def __mark_busy(self, resource):
+        if resource.busy:
+            return
+
+        resource.busy = True
+        self.busy.add(resource)
+        for i in nx.ancestors(self.resources, resource):
+            i.busy_descendants += 1
+
+    def __mark_free(self, resource):
+        if not resource.busy:
+            return
+
+        resource.busy = False
+        self.busy.discard(resource)
+        for i in nx.ancestors(self.resources, resource):
+            i.busy_descendants -= 1
+
+    def __recount(self):
+        # Graph structure changed, so ancestor sets of busy resources might
+        # have changed as well. Busy resources are few, so recount from scratch.
+        for i in self.resources.nodes():
+            i.busy_descendants = 0
+
+        for res in self.busy:
+            for i in nx.ancestors(self.resources, res):
+                i.busy_descendants += 1
+
+    def __add_resource(self, resource, parents, children):
+        if not resource:
+            raise ResourceError('Invalid resource')
+
+        if resource.name in self.index:
+            raise ResourceError('Resource {0} already exists'.format(resource.name))
+
+        self.resources.add_node(resource)
+        self.index[resource.name] = resource
+        if not parents:
+            parents = ['root']
+
+        for p in parents:
+            node = self.index.get(p)
+            if not node:
+                continue
+
+            self.resources.add_edge(node, resource)
+
+        for p in children or []:
+            node = self.index.get(p)
+            if not node:
+                raise ResourceError('Invalid child resource {0}'.format(p))
+
+            self.resources.add_edge(resource, node)
+
+    def __remove_resource(self, name):
+        resource = self.index.get(name)
+        if not resource:
+            return
+
+        for i in nx.descendants(self.resources, resource) | {resource}:
+            self.resources.remove_node(i)
+            self.busy.discard(i)
+            if self.index.get(i.name) is i:
+                del self.index[i.name]
+
+    def __update_resource(self, name, new_parents, new_children):
+        resource = self.index.get(name)
+        if not resource:
+            return
+
+        for i in list(self.resources.predecessors(resource)):
+            self.resources.remove_edge(i, resource)
+
+        for p in new_parents:
+            node = self.index.get(p)
+            if not node:
+                continue
+
+            self.resources.add_edge(node, resource)
+
+        for p in new_children or []:
+            node = self.index.get(p)
+            if not node:
+                raise ResourceError('Invalid child resource {0}'.format(p))
+
+            self.resources.add_edge(resource, node)
+
     def add_resource(self, resource, parents=None, children=None):
         with self.mutex:
-            if not resource:
-                raise ResourceError('Invalid resource')
-    
-            if self.get_resource(resource.name):
-                raise ResourceError('Resource {0} already exists'.format(resource.name))
-    
-            self.resources.add_node(resource)
-            if not parents:
-                parents = ['root']
-    
-            for p in parents:
-                node = self.get_resource(p)
-                if not node:
-                    continue
-    
-                self.resources.add_edge(node, resource)
+            self.__add_resource(resource, parents, children)
+            if self.busy and children:
+                self.__recount()
 
-            for p in children or []:
-                node = self.get_resource(p)
-                if not node:
-                    raise ResourceError('Invalid child resource {0}'.format(p))
+    def add_resources(self, resources):
+        with self.mutex:
+            try:
+                for resource, parents, children in resources:
+                    self.__add_resource(resource, parents, children)
+            finally:
+                if self.busy:
+                    self.__recount()
 
     def remove_resource(self, name):
         with self.mutex:
-            resource = self.get_resource(name)
-    
-            if not resource:
-                return
-    
-            for i in nx.descendants(self.resources, resource):
-                self.resources.remove_node(i)
-    
-            self.resources.remove_node(resource)
+            busy = bool(self.busy)
+            self.__remove_resource(name)
+            if busy:
+                self.__recount()
 
     def remove_resources(self, names):
         with self.mutex:
+            busy = bool(self.busy)
             for name in names:
-                resource = self.get_resource(name)
-    
-                if not resource:
-                    return
-    
-                for i in nx.descendants(self.resources, resource):
-                    self.resources.remove_node(i)
-    
-                self.resources.remove_node(resource)
+                self.__remove_resource(name)
+
+            if busy:
+                self.__recount()
 
     def rename_resource(self, oldname, newname):
         with self.mutex:
-            resource = self.get_resource(oldname)
+            resource = self.index.pop(oldname, None)
 
             if not resource:
                 return
 
             resource.name = newname
+            self.index[newname] = resource
 
     def update_resource(self, name, new_parents, new_children=None):
         with self.mutex:
-            resource = self.get_resource(name)
-    
-            if not resource:
-                return
-    
-            for i in self.resources.predecessors(resource):
-                self.resources.remove_edge(i, resource)
-    
-            for p in new_parents:
-                node = self.get_resource(p)
-                if not node:
+            self.__update_resource(name, new_parents, new_children)
+            if self.busy:
+                self.__recount()
+
+    def update_resources(self, resources):
+        with self.mutex:
+            try:
+                for name, new_parents, new_children in resources:
+                    self.__update_resource(name, new_parents, new_children)
+            finally:
+                if self.busy:
+                    self.__recount()
+
+    def get_resource(self, name):
+        return self.index.get(name)
+
+    def get_blocking_resources(self, *names):
+        """
+        Returns a tuple of (missing, busy) resource names. Busy resources are
+        ones that are either acquired themselves or have an acquired descendant.
+        """
+        with self.mutex:
+            missing = []
+            busy = []
+            for name in names:
+                res = self.index.get(name)
+                if not res:
+                    missing.append(name)
                     continue
-    
-                self.resources.add_edge(node, resource)
 
-            for p in new_children or []:
-                node = self.get_resource(p)
-                if not node:
-                    raise ResourceError('Invalid child resource {0}'.format(p))
+                if res.busy or res.busy_descendants:
+                    busy.append(name)
 
-                self.resources.add_edge(resource, node)
+            return missing, busy
 
-    def get_resource(self, name):
-        f = [i for i in self.resources.nodes() if i.name == name]
-        return f[0] if len(f) > 0 else None
+    def get_resource_ancestors(self, *names):
+        with self.mutex:
+            result = set()
+            for name in names:
+                res = self.index.get(name)
+                if not res:
+                    continue
+
+                result.add(res.name)
+                result.update(i.name for i in nx.ancestors(self.resources, res))
+
+            return result
 
     def get_resource_dependencies(self, name):
         res = self.get_resource(name)
@@ -163,17 +258,19 @@ class ResourceGraph(object):
 
         with self.mutex:
             self.logger.debug('Acquiring following resources: %s', ','.join(names))
-    
+
             for name in names:
-                res = self.get_resource(name)
+                res = self.index.get(name)
                 if not res:
                     raise ResourceError('Resource {0} not found'.format(name))
-    
-                for i in nx.descendants(self.resources, res):
-                    if i.name not in names and i.busy:
-                        raise ResourceError('Cannot acquire, some of dependent resources are busy')
-    
-                res.busy = True
+
+                if res.busy_descendants:
+                    # Busy descendants are fine as long as we are acquiring them ourselves
+                    for i in nx.descendants(self.resources, res):
+                        if i.name not in names and i.busy:
+                            raise ResourceError('Cannot acquire, some of dependent resources are busy')
+
+                self.__mark_busy(res)
 
     def can_acquire(self, *names):
         if not names:
@@ -181,19 +278,15 @@ class ResourceGraph(object):
 
         with self.mutex:
             self.logger.log(TRACE, 'Trying to acquire following resources: %s', ','.join(names))
-    
+
             for name in names:
-                res = self.get_resource(name)
+                res = self.index.get(name)
                 if not res:
                     return False
-    
-                if res.busy:
+
+                if res.busy or res.busy_descendants:
                     return False
-    
-                for i in nx.descendants(self.resources, res):
-                    if i.busy:
-                        return False
-    
+
             return True
 
     def release(self, *names):
@@ -202,11 +295,11 @@ class ResourceGraph(object):
 
         with self.mutex:
             self.logger.debug('Releasing following resources: %s', ','.join(names))
-    
+
             for name in names:
-                res = self.get_resource(name)
+                res = self.index.get(name)
                 if res:
-                    res.busy = False
+                    self.__mark_free(res)
 
     def draw(self, path):
         return nx.write_dot(nx.relabel_nodes(self.resources, lambda n: f'"{n.name}"'), path)
@@ -230,18 +323,16 @@ class ResourceTracker(object):
     def on_changed(self, args):
         with self.lock:
             if args['operation'] == 'create':
-                for i in args['entities']:
-                    res = Resource(self.name_callback(i['id']))
-                    parents = self.parents_callback(i)
-                    children = self.children_callback(i)
-                    self.dispatcher.register_resource(res, parents=parents, children=children)
+                self.dispatcher.register_resources([
+                    (Resource(self.name_callback(i['id'])), self.parents_callback(i), self.children_callback(i))
+                    for i in args['entities']
+                ])
 
             elif args['operation'] == 'update':
-                for i in args['entities']:
-                    name = self.name_callback(i['id'])
-                    parents = self.parents_callback(i)
-                    children = self.children_callback(i)
-                    self.dispatcher.update_resource(name, new_parents=parents, new_children=children)
+                self.dispatcher.update_resources([
+                    (self.name_callback(i['id']), self.parents_callback(i), self.children_callback(i))
+                    for i in args['entities']
+                ])
 
             elif args['operation'] == 'rename':
                 for i in args['ids']:
@@ -249,8 +340,7 @@ class ResourceTracker(object):
                     self.dispatcher.rename_resource(self.name_callback(oldid), self.name_callback(newid))
 
             elif args['operation'] == 'delete':
-                for i in args['ids']:
-                    self.dispatcher.unregister_resource(self.name_callback(i))
+                self.dispatcher.unregister_resources([self.name_callback(i) for i in args['ids']])
 
             else:
                 raise AssertionError('Invalid changed event type: {0}'.format(args['operation']))
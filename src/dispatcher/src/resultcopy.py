@@ -0,0 +1,83 @@
+#+
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+"""
+Copying of results of in-process RPC calls.
+
+Results are shared between the service that produced them (often straight
+out of its cache) and its in-process callers, so callers have to get a
+private copy. Results are almost always plain JSON-like data, which is
+copied here without going through the generic copy.deepcopy() machinery;
+anything else is handed over to copy.deepcopy().
+"""
+
+import copy
+import datetime
+import uuid
+
+
+IMMUTABLE_TYPES = frozenset([
+    str, bytes, int, float, bool, complex, type(None),
+    datetime.datetime, datetime.date, datetime.time, datetime.timedelta, uuid.UUID
+])
+
+
+def copy_result(obj, memo=None):
+    """
+    Deep copies obj. Objects referenced more than once are copied once,
+    same as with copy.deepcopy().
+    """
+    cls = type(obj)
+    if cls in IMMUTABLE_TYPES:
+        return obj
+
+    if memo is None:
+        memo = {}
+
+    key = id(obj)
+    if key in memo:
+        return memo[key]
+
+    if cls is dict:
+        result = memo[key] = {}
+        for k, v in obj.items():
+            result[k] = v if type(v) in IMMUTABLE_TYPES else copy_result(v, memo)
+
+        return result
+
+    if cls is list:
+        result = memo[key] = []
+        for v in obj:
+            result.append(v if type(v) in IMMUTABLE_TYPES else copy_result(v, memo))
+
+        return result
+
+    if cls is tuple:
+        result = memo[key] = tuple(copy_result(v, memo) for v in obj)
+        return result
+
+    return copy.deepcopy(obj, memo)
@@ -232,6 +232,12 @@ class EventService(RpcService):
     def get_my_subscriptions(self, sender):
         return list(sender.event_masks)
 
+    def get_fanout_stats(self):
+        return {k: v.copy() for k, v in self.__dispatcher.event_subscriptions.fanout.items()}
+
+    def get_event_types(self):
+        return list(self.__dispatcher.event_types.keys())
+
     @private
     def suspend(self):
         self.__dispatcher.event_delivery_lock.acquire()
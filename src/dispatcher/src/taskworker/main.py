@@ -29,6 +29,11 @@
 import os
 import sys
 import errno
+import json
+import array
+import fnmatch
+import select
+import signal
 import socket
 import traceback
 import logging
@@ -41,7 +46,7 @@ from freenas.dispatcher.fd import FileDescriptor
 from freenas.dispatcher.rpc import RpcService, RpcException, RpcWarning
 from freenas.utils import load_module_from_file, configure_logging, serialize_traceback
 from datastore import get_datastore
-from datastore.config import ConfigStore
+from datastore.config import ConfigStore, CONFIG_CHANGED_EVENT
 
 
 def serialize_error(err):
@@ -140,7 +145,7 @@ class TaskProxyService(RpcService):
 
 
 class Context(object):
-    def __init__(self):
+    def __init__(self, module_cache=None):
         self.service = TaskProxyService(self)
         self.task = queue.Queue(1)
         self.datastore = None
@@ -148,7 +153,7 @@ class Context(object):
         self.configstore = None
         self.conn = None
         self.instance = None
-        self.module_cache = {}
+        self.module_cache = module_cache or {}
         self.running = Event()
 
     def put_status(self, state, result=None, exception=None):
@@ -169,6 +174,13 @@ class Context(object):
         if self.instance:
             self.instance.task_progress_handler(args)
 
+    def config_changed(self, keys):
+        self.conn.emit_event(CONFIG_CHANGED_EVENT, {'keys': keys, 'pid': os.getpid()})
+
+    def config_changed_handler(self, args):
+        if args.get('pid') != os.getpid():
+            self.configstore.invalidate(args.get('keys'))
+
     def collect_fds(self, obj):
         if isinstance(obj, dict):
             for v in obj.values():
@@ -202,18 +214,12 @@ class Context(object):
 
             instance.join_subtasks(instance.run_subtask(hook, *task['args'], **extra_env))
 
-    def main(self):
-        if len(sys.argv) != 3:
-            print("Invalid number of arguments", file=sys.stderr)
-            sys.exit(errno.EINVAL)
-
-        key = sys.argv[1]
-        index = int(sys.argv[2])
+    def main(self, key, index):
         configure_logging('taskworker#{0}'.format(index), logging.DEBUG)
 
         self.datastore = get_datastore()
         self.datastore_log = get_datastore(log=True)
-        self.configstore = ConfigStore(self.datastore)
+        self.configstore = ConfigStore(self.datastore, cache=True, notify=self.config_changed)
         self.conn = Client()
         self.conn.connect('unix:')
         self.conn.login_service('task.{0}'.format(os.getpid()))
@@ -221,12 +227,16 @@ class Context(object):
         self.conn.call_sync('management.enable_features', ['streaming_responses'])
         self.conn.rpc.register_service_instance('taskproxy', self.service)
         self.conn.register_event_handler('task.progress', self.task_progress_handler)
+        self.conn.register_event_handler(CONFIG_CHANGED_EVENT, self.config_changed_handler)
         self.conn.call_sync('task.checkin', key)
         setproctitle('task executor (idle)')
 
         while True:
             try:
                 task = self.task.get()
+                # Tasks run right after the ones they depend on, possibly
+                # before config.changed events from those have arrived
+                self.configstore.check()
                 logging.root.setLevel(self.conn.call_sync('management.get_logging_level'))
                 setproctitle('task executor (tid {0})'.format(task['id']))
 
@@ -293,6 +303,131 @@ class Context(object):
             setproctitle('task executor (idle)')
 
 
+class TemplateContext(object):
+    """
+    Warm template process. Imports all the plugin modules up front and then
+    fork()s task workers on request of the dispatcher, so workers start with
+    modules already loaded and share their pages with the template.
+
+    Requests arrive on the control socket as JSON lines carrying worker key
+    and index, along with the write end of the worker output pipe passed as
+    SCM_RIGHTS ancillary data. Worker start and exit notifications are sent
+    back the same way. Datastore and dispatcher connections are not shared
+    with the workers, as neither pymongo nor the dispatcher client are
+    fork-safe; each worker opens its own after fork().
+    """
+    def __init__(self, control_fd, plugin_dirs):
+        self.control = socket.socket(fileno=control_fd)
+        self.plugin_dirs = plugin_dirs
+        self.module_cache = {}
+        self.buffer = b''
+        self.fds = []
+        self.wakeup_r, self.wakeup_w = os.pipe()
+
+    def preload(self):
+        for dir in self.plugin_dirs:
+            for root, _, filenames in os.walk(dir):
+                if os.path.basename(root) == 'disabled':
+                    continue
+
+                for i in fnmatch.filter(filenames, '*.py') + fnmatch.filter(filenames, '*.so'):
+                    filename = os.path.join(root, i)
+                    name, _ = os.path.splitext(i)
+                    try:
+                        self.module_cache[filename] = load_module_from_file(name, filename)
+                    except BaseException as err:
+                        logging.warning('Cannot preload {0}: {1}'.format(filename, str(err)))
+
+    def send(self, msg):
+        self.control.sendall(json.dumps(msg).encode('utf-8') + b'\n')
+
+    def spawn(self, request, fd):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.set_wakeup_fd(-1)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                os.setpgrp()
+                os.dup2(fd, sys.stdout.fileno())
+                os.dup2(fd, sys.stderr.fileno())
+                for i in (fd, self.wakeup_r, self.wakeup_w, self.control.fileno()):
+                    os.close(i)
+
+                Context(self.module_cache).main(request['key'], request['index'])
+            except SystemExit as err:
+                code = err.code if isinstance(err.code, int) else errno.EFAULT
+            except BaseException:
+                traceback.print_exc()
+                code = errno.EFAULT
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+
+        os.close(fd)
+        self.send({'event': 'started', 'key': request['key'], 'pid': pid})
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+
+            if pid == 0:
+                return
+
+            if os.WIFSIGNALED(status):
+                returncode = -os.WTERMSIG(status)
+            else:
+                returncode = os.WEXITSTATUS(status)
+
+            self.send({'event': 'exited', 'pid': pid, 'returncode': returncode})
+
+    def read_requests(self):
+        fds = array.array('i')
+        data, ancdata, _, _ = self.control.recvmsg(4096, socket.CMSG_LEN(16 * fds.itemsize))
+        if not data:
+            sys.exit(0)
+
+        for level, type, cmsg_data in ancdata:
+            if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+                fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+
+        self.buffer += data
+        self.fds.extend(fds)
+        while b'\n' in self.buffer:
+            line, self.buffer = self.buffer.split(b'\n', 1)
+            self.spawn(json.loads(line.decode('utf-8')), self.fds.pop(0))
+
+    def main(self):
+        configure_logging('taskworker-template', logging.DEBUG)
+        setproctitle('task executor template')
+        self.preload()
+
+        os.set_blocking(self.wakeup_w, False)
+        signal.set_wakeup_fd(self.wakeup_w)
+        signal.signal(signal.SIGCHLD, lambda signo, frame: None)
+        self.send({'event': 'ready', 'modules': len(self.module_cache)})
+
+        while True:
+            readable, _, _ = select.select([self.control, self.wakeup_r], [], [])
+            if self.wakeup_r in readable:
+                os.read(self.wakeup_r, 512)
+                self.reap()
+
+            if self.control in readable:
+                self.read_requests()
+
+
 if __name__ == '__main__':
+    if len(sys.argv) >= 3 and sys.argv[1] == '--template':
+        TemplateContext(int(sys.argv[2]), sys.argv[3:]).main()
+
+    if len(sys.argv) != 3:
+        print("Invalid number of arguments", file=sys.stderr)
+        sys.exit(errno.EINVAL)
+
     ctx = Context()
-    ctx.main()
+    ctx.main(sys.argv[1], int(sys.argv[2]))
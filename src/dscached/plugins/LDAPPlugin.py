@@ -42,6 +42,19 @@ from freenas.utils.query import get, contains
 
 
 TICKET_RENEW_LIFE = 30 * 86400  # 30 days
+PAGE_SIZE = 500
+USER_ATTRIBUTE_MAPPING = {
+    'uid': 'uidNumber',
+    'username': 'uid',
+    'sid': 'sambaSID'
+}
+
+GROUP_ATTRIBUTE_MAPPING = {
+    'gid': 'gidNumber',
+    'name': 'cn',
+    'sid': 'sambaSID'
+}
+
 logger = logging.getLogger(__name__)
 
 
@@ -79,9 +92,13 @@ class LDAPPlugin(DirectoryServicePlugin):
             with self.bind_lock:
                 self.conn.bind()
 
-        id = self.conn.search(search_base, search_filter, attributes=attributes or ldap3.ALL_ATTRIBUTES)
-        result, status = self.conn.get_response(id)
-        return result
+        return self.conn.extend.standard.paged_search(
+            search_base=search_base,
+            search_filter=search_filter,
+            attributes=attributes or ldap3.ALL_ATTRIBUTES,
+            paged_size=PAGE_SIZE,
+            generator=True
+        )
 
     def search_one(self, *args, **kwargs):
         return first_or_default(None, self.search(*args, **kwargs))
@@ -103,27 +120,55 @@ class LDAPPlugin(DirectoryServicePlugin):
     def get_gecos(self, entry):
         pass
 
-    def convert_user(self, entry):
+    def build_query(self, objectclass, mappings, filter):
+        # Only positive predicates on attributes stored verbatim in LDAP are
+        # passed to the server, which makes the result a superset of what
+        # was asked for. Callers apply the whole filter on top of it anyway.
+        # Negations are not, as LDAP matching is case insensitive and most
+        # attributes are multi-valued, so (!(attr=value)) could drop entries
+        # the filter would keep.
+        predicates = [
+            i for i in filter or []
+            if len(i) == 3 and mappings.get(i[0]) and i[1] in ('=', 'in')
+        ]
+
+        builder = LdapQueryBuilder(mappings)
+        return builder.build_query([('objectclass', '=', objectclass)] + predicates)
+
+    def get_group_index(self, search_filter='(objectclass=posixGroup)'):
+        primary = {}
+        members = {}
+
+        for i in self.search(self.group_dn, search_filter):
+            g = dict(i['attributes'])
+            id = self.get_id(g)
+            if contains(g, 'gidNumber'):
+                primary.setdefault(int(get(g, 'gidNumber')), id)
+
+            for m in get(g, 'memberUid') or []:
+                members.setdefault(m, []).append(id)
+
+        return primary, members
+
+    def convert_user(self, entry, groups=None):
         entry = dict(entry['attributes'])
         pwd_change_time = get(entry, 'sambaPwdLastSet')
-        groups = []
-        group = None
         username = get(entry, 'uid.0')
+        gid = int(get(entry, 'gidNumber')) if contains(entry, 'gidNumber') else None
 
-        if contains(entry, 'gidNumber'):
-            ret = self.search_one(
-                self.group_dn,
-                '(gidNumber={0})'.format(get(entry, 'gidNumber'))
-            )
+        if not groups:
+            # Primary and auxiliary groups of a single user in one go
+            builder = LdapQueryBuilder()
+            qstr = builder.build_query([
+                ('objectclass', '=', 'posixGroup'),
+                ('or', [('gidNumber', '=', gid), ('memberUid', '=', username)] if gid is not None else [
+                    ('memberUid', '=', username)
+                ])
+            ])
 
-            if ret:
-                group = dict(ret['attributes'])
-
-        # Try to find any auxiliary groups
-        for i in self.search(self.group_dn, '(memberUid={0})'.format(get(entry, 'uid'))):
-            g = dict(i['attributes'])
-            groups.append(self.get_id(g))
+            groups = self.get_group_index(qstr)
 
+        primary, members = groups
         return {
             'id': self.get_id(entry),
             'sid': get(entry, 'sambaSID'),
@@ -136,8 +181,8 @@ class LDAPPlugin(DirectoryServicePlugin):
             'nthash': get(entry, 'sambaNTPassword'),
             'lmhash': get(entry, 'sambaLMPassword'),
             'password_changed_at': datetime.utcfromtimestamp(int(pwd_change_time)) if pwd_change_time else None,
-            'group': self.get_id(group) if group else None,
-            'groups': groups,
+            'group': primary.get(gid),
+            'groups': members.get(username, []),
             'sudo': False
         }
 
@@ -153,9 +198,15 @@ class LDAPPlugin(DirectoryServicePlugin):
         }
 
     def getpwent(self, filter=None, params=None):
-        logger.debug('getpwent(filter={0}, params={0})'.format(filter, params))
-        result = self.search(self.user_dn, '(objectclass=posixAccount)')
-        return (self.convert_user(i) for i in result)
+        logger.debug('getpwent(filter={0}, params={1})'.format(filter, params))
+        qstr = self.build_query('posixAccount', USER_ATTRIBUTE_MAPPING, filter)
+        logger.debug('getpwent query string: {0}'.format(qstr))
+
+        # Paged searches can't be interleaved on a single connection, so
+        # the group index has to be complete before the user search starts
+        groups = self.get_group_index()
+        for i in self.search(self.user_dn, qstr):
+            yield self.convert_user(i, groups)
 
     def getpwnam(self, name):
         logger.debug('getpwnam(name={0})'.format(name))
@@ -183,8 +234,11 @@ class LDAPPlugin(DirectoryServicePlugin):
         return self.convert_user(user)
 
     def getgrent(self, filter=None, params=None):
-        logger.debug('getgrent(filter={0}, params={0})'.format(filter, params))
-        result = self.search(self.group_dn, '(objectclass=posixGroup)')
+        logger.debug('getgrent(filter={0}, params={1})'.format(filter, params))
+        qstr = self.build_query('posixGroup', GROUP_ATTRIBUTE_MAPPING, filter)
+        logger.debug('getgrent query string: {0}'.format(qstr))
+
+        result = self.search(self.group_dn, qstr)
         return (self.convert_group(i) for i in result)
 
     def getgrnam(self, name):
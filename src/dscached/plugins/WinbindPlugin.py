@@ -53,6 +53,7 @@ from freenas.utils.query import get
 AD_REALM_ID = uuid.UUID('01a35b82-0168-11e6-88d6-0cc47a3511b4')
 WINBINDD_PIDFILE = '/var/run/samba4/winbindd.pid'
 WINBINDD_KEEPALIVE = 60
+SID_BATCH_SIZE = 100
 AD_LDAP_ATTRIBUTE_MAPPING = {
     'id': 'objectGUID',
     'sd': 'objectSid',
@@ -672,6 +673,35 @@ class WinbindPlugin(DirectoryServicePlugin):
             else:
                 return self.convert_group(result)
 
+    def map_sids(self, sids):
+        if not self.is_joined():
+            logger.debug('map_sids: not joined')
+            return {}
+
+        result = {}
+        for chunk in (sids[i:i + SID_BATCH_SIZE] for i in range(0, len(sids), SID_BATCH_SIZE)):
+            qstr = '(|{0})'.format(''.join(
+                '(objectSid={0})'.format(ldap3.utils.conv.escape_bytes(SID(i).binary())) for i in chunk
+            ))
+
+            for r in self.search(self.base_dn, qstr, attributes=['objectClass', 'objectSid', 'uidNumber', 'gidNumber']):
+                entry = dict(r['attributes'])
+                classes = get(entry, 'objectClass')
+                if 'person' in classes:
+                    if 'user' not in classes or 'computer' in classes:
+                        continue
+
+                    xid = ('UID', self.mapper.get_uid(entry))
+                elif 'group' in classes:
+                    xid = ('GID', self.mapper.get_gid(entry))
+                else:
+                    continue
+
+                if xid[1] is not None:
+                    result[str(get(entry, 'objectSid'))] = xid
+
+        return result
+
     def authenticate(self, username, password):
         if '\\' in username:
             domain, username = username.split('\\', 1)
@@ -36,13 +36,15 @@ import errno
 import datastore
 import time
 import json
+import bisect
 import ipaddress
 import socket
 import netif
 from bsd import setproctitle
-from threading import RLock, Thread
+from threading import RLock, Thread, Event
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from datastore.config import ConfigStore
+from datastore.config import ConfigStore, CONFIG_CHANGED_EVENT
 from freenas.dispatcher.client import Client, ClientError
 from freenas.dispatcher.server import Server
 from freenas.dispatcher.rpc import RpcContext, RpcService, RpcException, generator, get_sender, accepts, returns
@@ -58,6 +60,9 @@ NOGROUP_GID = 65533
 RID_BASE = 1000
 DEFAULT_CONFIGFILE = '/usr/local/etc/middleware.conf'
 DEFAULT_SOCKET_ADDRESS = 'unix:///var/run/dscached.sock'
+CACHE_SIZE = 65536
+NEGATIVE_CACHE_TTL = 30
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
 AF_MAP = {
     socket.AF_INET: ipaddress.IPv4Address,
     socket.AF_INET6: ipaddress.IPv6Address
@@ -169,77 +174,225 @@ class CacheItem(object):
         })
 
 
-class TTLCacheStore(object):
+class LookupStats(object):
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def __getstate__(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'latency': [
+                {'le': le, 'count': count}
+                for le, count in zip(LATENCY_BUCKETS + (None,), self.histogram)
+            ]
+        }
+
+    def record(self, elapsed):
+        self.misses += 1
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+
+
+class Lookup(object):
+    __slots__ = ('done', 'result')
+
     def __init__(self):
+        self.done = Event()
+        self.result = None
+
+
+class TTLCacheStore(object):
+    """
+    Size bounded LRU cache of directory objects, addressable by id, uuid and
+    any of their names. Failed lookups are remembered for negative_ttl
+    seconds, and concurrent lookups of the same missing key are coalesced
+    into a single backend call, see lookup().
+    """
+    def __init__(self, size=CACHE_SIZE, negative_ttl=NEGATIVE_CACHE_TTL):
+        self.lock = RLock()
+        self.size = size
+        self.negative_ttl = negative_ttl
         self.id_store = {}
         self.name_store = {}
-        self.uuid_store = {}
+        self.uuid_store = OrderedDict()
+        self.negative = {}
+        self.pending = {}
+        self.directory_stats = {}
         self.hits = 0
         self.misses = 0
+        self.negative_hits = 0
+        self.coalesced = 0
+        self.evictions = 0
 
     def __len__(self):
         return len(self.id_store)
 
     def __getstate__(self):
-        return {
-            'size': len(self),
-            'hits': self.hits,
-            'misses': self.misses
-        }
+        with self.lock:
+            return {
+                'size': len(self),
+                'max_size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'negative_size': len(self.negative),
+                'negative_hits': self.negative_hits,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+                'directories': {k: v.__getstate__() for k, v in self.directory_stats.items()}
+            }
 
-    def get(self, id=None, uuid=None, name=None):
+    def __stats(self, directory):
+        stats = self.directory_stats.get(directory.name)
+        if not stats:
+            stats = self.directory_stats[directory.name] = LookupStats()
+
+        return stats
+
+    def __key(self, id=None, uuid=None, name=None):
         if id is not None:
-            item = self.id_store.get(id)
+            return self.id_store, 'id', id
         elif uuid is not None:
-            item = self.uuid_store.get(uuid.lower())
+            return self.uuid_store, 'uuid', uuid.lower()
         elif name is not None:
-            item = self.name_store.get(name)
+            return self.name_store, 'name', name
         else:
             raise AssertionError('Either id=, uuid= or name= parameter must be filled')
 
+    def __remove(self, item):
+        item.destroyed = True
+        for i in item.names:
+            if self.name_store.get(i) is item:
+                del self.name_store[i]
+
+        if self.id_store.get(item.id) is item:
+            del self.id_store[item.id]
+
+        self.uuid_store.pop(item.uuid, None)
+
+    def get(self, id=None, uuid=None, name=None):
+        store, _, key = self.__key(id, uuid, name)
+        with self.lock:
+            item = store.get(key)
+            if item:
+                if item.expired:
+                    self.__remove(item)
+                    self.misses += 1
+                    return
+
+                self.uuid_store.move_to_end(item.uuid)
+                self.__stats(item.directory).hits += 1
+                self.hits += 1
+                return item
+
+            self.misses += 1
+            return
+
+    def lookup(self, fetch, scope=None, id=None, uuid=None, name=None):
+        """
+        Returns the cached item for the given key, or calls fetch() to get it
+        from the backends. fetch() returns a CacheItem or None. scope tells
+        apart lookups of the same key done with different backend sets, as
+        their misses can't be shared.
+        """
+        item = self.get(id, uuid, name)
         if item:
-            if item.expired:
-                self.flush(item.uuid)
-                self.misses += 1
-                return
+            return item
+
+        _, field, key = self.__key(id, uuid, name)
+        key = (field, key, scope)
+        leader = False
+        with self.lock:
+            expires_at = self.negative.get(key)
+            if expires_at:
+                if expires_at > time.monotonic():
+                    self.negative_hits += 1
+                    return
+
+                del self.negative[key]
+
+            lookup = self.pending.get(key)
+            if lookup:
+                self.coalesced += 1
+            else:
+                lookup = self.pending[key] = Lookup()
+                leader = True
+
+        if not leader:
+            lookup.done.wait()
+            return lookup.result
 
-            self.hits += 1
+        try:
+            item = fetch()
+            with self.lock:
+                if item:
+                    self.set(item)
+                elif self.negative_ttl:
+                    self.negative[key] = time.monotonic() + self.negative_ttl
+
+            lookup.result = item
             return item
+        finally:
+            with self.lock:
+                del self.pending[key]
 
-        self.misses += 1
-        return
+            lookup.done.set()
+
+    def fetch(self, directory, fn, *args):
+        """
+        Calls backend lookup function fn, accounting its latency to directory
+        """
+        start = time.monotonic()
+        try:
+            return fn(*args)
+        finally:
+            with self.lock:
+                self.__stats(directory).record(time.monotonic() - start)
 
     def flush(self, uuid):
-        item = self.uuid_store.get(uuid)
-        if item:
-            with item.lock:
-                if item.destroyed:
-                    return
+        with self.lock:
+            item = self.uuid_store.get(uuid.lower())
+            if item:
+                self.__remove(item)
 
-                for i in item.names:
-                    del self.name_store[i]
-                del self.uuid_store[item.uuid]
-                del self.id_store[item.id]
+            # Whatever got changed might have been looked up without success
+            self.negative.clear()
 
     def query(self, filter=None, params=None):
         return query(self.id_store, *(filter or []), **(params or {}))
 
     def set(self, item):
-        with item.lock:
+        with self.lock:
+            old = self.uuid_store.get(item.uuid)
+            if old:
+                self.__remove(old)
+
             self.id_store[item.id] = item
             self.uuid_store[item.uuid] = item
             for i in item.names:
                 self.name_store[i] = item
 
+            while len(self.uuid_store) > self.size:
+                _, oldest = self.uuid_store.popitem(last=False)
+                self.__remove(oldest)
+                self.evictions += 1
+
     def expire(self):
-        for uuid, item in self.uuid_store.items():
-            if item.expired:
-                self.flush(uuid)
+        with self.lock:
+            for item in [i for i in self.uuid_store.values() if i.expired]:
+                self.__remove(item)
+
+            now = time.monotonic()
+            for key in [k for k, v in self.negative.items() if v <= now]:
+                del self.negative[key]
 
     def clear(self):
-        self.name_store.clear()
-        self.uuid_store.clear()
-        self.id_store.clear()
+        with self.lock:
+            self.name_store.clear()
+            self.uuid_store.clear()
+            self.id_store.clear()
+            self.negative.clear()
 
 
 class Directory(object):
@@ -252,6 +405,7 @@ class Directory(object):
         self.parameters = definition['parameters']
         self.enabled = definition['enabled']
         self.enumerate = definition['enumerate']
+        self.ttl = definition.get('cache_ttl')
         self.max_uid = self.min_uid = None
         self.max_gid = self.min_gid = None
         self.status_code = 0
@@ -276,6 +430,10 @@ class Directory(object):
             self.context.logger.error('Parameters: {0}'.format(self.parameters))
             raise ValueError('Failed to initialize {0}'.format(self.plugin_type))
 
+    @property
+    def cache_ttl(self):
+        return self.ttl or self.context.cache_ttl
+
     def configure(self):
         try:
             if self.instance.get_kerberos_realm(self.parameters):
@@ -356,17 +514,18 @@ class ManagementService(RpcService):
         return {
             'users': self.context.users_cache.__getstate__(),
             'groups': self.context.groups_cache.__getstate__(),
-            'hosts': self.context.hosts_cache.__getstate__()
+            'hosts': self.context.hosts_cache.__getstate__(),
+            'idmap': self.context.idmap_cache.__getstate__()
         }
 
     def clean_cache(self):
         self.context.logger.warning('Cleaning caches')
-        for i in self.context.users_cache, self.context.groups_cache, self.context.hosts_cache:
+        for i in self.context.users_cache, self.context.groups_cache, self.context.hosts_cache, self.context.idmap_cache:
             i.expire()
 
     def flush_cache(self):
         self.context.logger.warning('Flushing caches')
-        for i in self.context.users_cache, self.context.groups_cache, self.context.hosts_cache:
+        for i in self.context.users_cache, self.context.groups_cache, self.context.hosts_cache, self.context.idmap_cache:
             i.clear()
 
     def normalize_parameters(self, plugin, parameters):
@@ -489,104 +648,88 @@ class AccountService(RpcService):
 
     @accepts(int, bool)
     def getpwuid(self, uid, skip_ad=False):
-        # Try the cache first
-        item = self.context.users_cache.get(id=uid)
-        if item:
-            if skip_ad and item.directory.plugin_type == 'winbind':
-                raise RpcException(errno.ENOENT, 'UID {0} not found'.format(uid))
-
-            return fix_passwords(item.annotated)
-
-        dirs = self.context.get_active_directories()
+        def fetch():
+            for d in self.context.get_active_directories():
+                if skip_ad and d.plugin_type == 'winbind':
+                    continue
 
-        for d in dirs:
-            if skip_ad and d.plugin_type == 'winbind':
-                continue
+                try:
+                    user = self.context.users_cache.fetch(d, d.instance.getpwuid, uid)
+                except:
+                    continue
 
-            try:
-                user = d.instance.getpwuid(uid)
-            except:
-                continue
+                if user:
+                    resolve_primary_group(self.context, user)
+                    aliases = alias(d, user, 'username')
+                    aliases.remove(user['username'])
+                    return CacheItem(user['uid'], user['id'], aliases, copy.copy(user), d, d.cache_ttl)
 
-            if user:
-                resolve_primary_group(self.context, user)
-                aliases = alias(d, user, 'username')
-                aliases.remove(user['username'])
-                item = CacheItem(user['uid'], user['id'], aliases, copy.copy(user), d, self.context.cache_ttl)
-                self.context.users_cache.set(item)
-                return fix_passwords(item.annotated)
+        item = self.context.users_cache.lookup(fetch, skip_ad, id=uid)
+        if not item or (skip_ad and item.directory.plugin_type == 'winbind'):
+            raise RpcException(errno.ENOENT, 'UID {0} not found'.format(uid))
 
-        raise RpcException(errno.ENOENT, 'UID {0} not found'.format(uid))
+        return fix_passwords(item.annotated)
 
     @accepts(str, bool)
     def getpwnam(self, user_name, skip_ad=False):
-        # Try the cache first
-        item = self.context.users_cache.get(name=user_name)
-        if item:
-            if skip_ad and item.directory.plugin_type == 'winbind':
-                raise RpcException(errno.ENOENT, 'User {0} not found'.format(user_name))
+        def fetch():
+            if '@' in user_name:
+                # Fully qualified user name
+                fqdn = True
+                name, domain_name = user_name.split('@', 1)
+                directory = self.context.get_directory_by_domain(domain_name)
+                dirs = [directory] if directory else []
+            else:
+                fqdn = False
+                name = user_name
+                dirs = self.context.get_searched_directories()
 
-            return fix_passwords(item.annotated)
+            for d in dirs:
+                if skip_ad and d.plugin_type == 'winbind':
+                    continue
 
-        if '@' in user_name:
-            # Fully qualified user name
-            fqdn = True
-            user_name, domain_name = user_name.split('@', 1)
-            directory = self.context.get_directory_by_domain(domain_name)
-            dirs = [directory] if directory else []
-        else:
-            fqdn = False
-            dirs = self.context.get_searched_directories()
+                try:
+                    user = self.context.users_cache.fetch(d, d.instance.getpwnam, name)
+                except:
+                    continue
 
-        for d in dirs:
-            if skip_ad and d.plugin_type == 'winbind':
-                continue
-
-            try:
-                user = d.instance.getpwnam(user_name)
-            except:
-                continue
+                if user:
+                    resolve_primary_group(self.context, user)
+                    aliases = alias(d, user, 'username')
+                    if fqdn:
+                        aliases.remove(name)
 
-            if user:
-                resolve_primary_group(self.context, user)
-                aliases = alias(d, user, 'username')
-                if fqdn:
-                    aliases.remove(user_name)
+                    return CacheItem(user['uid'], user['id'], aliases, copy.copy(user), d, d.cache_ttl)
 
-                item = CacheItem(user['uid'], user['id'], aliases, copy.copy(user), d, self.context.cache_ttl)
-                self.context.users_cache.set(item)
-                return fix_passwords(item.annotated)
+        item = self.context.users_cache.lookup(fetch, skip_ad, name=user_name)
+        if not item or (skip_ad and item.directory.plugin_type == 'winbind'):
+            raise RpcException(errno.ENOENT, 'User {0} not found'.format(user_name))
 
-        raise RpcException(errno.ENOENT, 'User {0} not found'.format(user_name))
+        return fix_passwords(item.annotated)
 
     @accepts(str, bool)
     def getpwuuid(self, uuid, skip_ad=False):
-        # Try the cache first
-        item = self.context.users_cache.get(uuid=uuid)
-        if item:
-            if skip_ad and item.directory.plugin_type == 'winbind':
-                raise RpcException(errno.ENOENT, 'UUID {0} not found'.format(uuid))
+        def fetch():
+            for d in self.context.get_active_directories():
+                if skip_ad and d.plugin_type == 'winbind':
+                    continue
 
-            return fix_passwords(item.annotated)
+                try:
+                    user = self.context.users_cache.fetch(d, d.instance.getpwuuid, uuid)
+                except:
+                    continue
 
-        for d in self.context.get_active_directories():
-            if skip_ad and d.plugin_type == 'winbind':
-                continue
-
-            try:
-                user = d.instance.getpwuuid(uuid)
-            except:
-                continue
+                if user:
+                    resolve_primary_group(self.context, user)
+                    aliases = alias(d, user, 'username')
+                    aliases.remove(user['username'])
+                    return CacheItem(user['uid'], user['id'], aliases, copy.copy(user), d, d.cache_ttl)
 
-            if user:
-                resolve_primary_group(self.context, user)
-                aliases = alias(d, user, 'username')
-                aliases.remove(user['username'])
-                item = CacheItem(user['uid'], user['id'], aliases, copy.copy(user), d, self.context.cache_ttl)
-                self.context.users_cache.set(item)
-                return fix_passwords(item.annotated)
+        item = self.context.users_cache.lookup(fetch, skip_ad, uuid=uuid)
+        if not item or (skip_ad and item.directory.plugin_type == 'winbind'):
+            raise RpcException(errno.ENOENT, 'UUID {0} not found'.format(uuid))
 
-        raise RpcException(errno.ENOENT, 'UUID {0} not found'.format(uuid))
+        return fix_passwords(item.annotated)
 
     @accepts(str, bool, bool)
     def getgroupmembership(self, user_name, skip_ad=False, include_primary_group=False):
@@ -706,99 +849,83 @@ class GroupService(RpcService):
 
     @accepts(str, bool)
     def getgrnam(self, name, skip_ad=False):
-        # Try the cache first
-        item = self.context.groups_cache.get(name=name)
-        if item:
-            if skip_ad and item.directory.plugin_type == 'winbind':
-                raise RpcException(errno.ENOENT, 'Group {0} not found'.format(name))
+        def fetch():
+            if '@' in name:
+                # Fully qualified group name
+                fqdn = True
+                group_name, domain_name = name.split('@', 1)
+                directory = self.context.get_directory_by_domain(domain_name)
+                dirs = [directory] if directory else []
+            else:
+                fqdn = False
+                group_name = name
+                dirs = self.context.get_searched_directories()
 
-            return item.annotated
+            for d in dirs:
+                if skip_ad and d.plugin_type == 'winbind':
+                    continue
 
-        if '@' in name:
-            # Fully qualified group name
-            fqdn = True
-            name, domain_name = name.split('@', 1)
-            directory = self.context.get_directory_by_domain(domain_name)
-            dirs = [directory] if directory else []
-        else:
-            fqdn = False
-            dirs = self.context.get_searched_directories()
+                try:
+                    group = self.context.groups_cache.fetch(d, d.instance.getgrnam, group_name)
+                except:
+                    continue
 
-        for d in dirs:
-            if skip_ad and d.plugin_type == 'winbind':
-                continue
+                if group:
+                    aliases = alias(d, group, 'name')
+                    if fqdn:
+                        aliases.remove(group_name)
 
-            try:
-                group = d.instance.getgrnam(name)
-            except:
-                continue
+                    return CacheItem(group['gid'], group['id'], aliases, copy.copy(group), d, d.cache_ttl)
 
-            if group:
-                aliases = alias(d, group, 'name')
-                if fqdn:
-                    aliases.remove(name)
+        item = self.context.groups_cache.lookup(fetch, skip_ad, name=name)
+        if not item or (skip_ad and item.directory.plugin_type == 'winbind'):
+            raise RpcException(errno.ENOENT, 'Group {0} not found'.format(name))
 
-                item = CacheItem(group['gid'], group['id'], aliases, copy.copy(group), d, self.context.cache_ttl)
-                self.context.groups_cache.set(item)
-                return item.annotated
-
-        raise RpcException(errno.ENOENT, 'Group {0} not found'.format(name))
+        return item.annotated
 
     @accepts(int, bool)
     def getgrgid(self, gid, skip_ad=False):
-        # Try the cache first
-        item = self.context.groups_cache.get(id=gid)
-        if item:
-            if skip_ad and item.directory.plugin_type == 'winbind':
-                raise RpcException(errno.ENOENT, 'Group {0} not found'.format(gid))
-
-            return item.annotated
-
-        dirs = self.context.get_active_directories()
+        def fetch():
+            for d in self.context.get_active_directories():
+                if skip_ad and d.plugin_type == 'winbind':
+                    continue
 
-        for d in dirs:
-            if skip_ad and d.plugin_type == 'winbind':
-                continue
+                try:
+                    group = self.context.groups_cache.fetch(d, d.instance.getgrgid, gid)
+                except:
+                    continue
 
-            try:
-                group = d.instance.getgrgid(gid)
-            except:
-                continue
+                if group:
+                    aliases = alias(d, group, 'name')
+                    return CacheItem(group['gid'], group['id'], aliases, copy.copy(group), d, d.cache_ttl)
 
-            if group:
-                aliases = alias(d, group, 'name')
-                item = CacheItem(group['gid'], group['id'], aliases, copy.copy(group), d, self.context.cache_ttl)
-                self.context.groups_cache.set(item)
-                return item.annotated
+        item = self.context.groups_cache.lookup(fetch, skip_ad, id=gid)
+        if not item or (skip_ad and item.directory.plugin_type == 'winbind'):
+            raise RpcException(errno.ENOENT, 'GID {0} not found'.format(gid))
 
-        raise RpcException(errno.ENOENT, 'GID {0} not found'.format(gid))
+        return item.annotated
 
     @accepts(str, bool)
     def getgruuid(self, uuid, skip_ad=False):
-        # Try the cache first
-        item = self.context.groups_cache.get(uuid=uuid)
-        if item:
-            if skip_ad and item.directory.plugin_type == 'winbind':
-                raise RpcException(errno.ENOENT, 'UUID {0} not found'.format(uuid))
-
-            return item.annotated
+        def fetch():
+            for d in self.context.get_active_directories():
+                if skip_ad and d.plugin_type == 'winbind':
+                    continue
 
-        for d in self.context.get_active_directories():
-            if skip_ad and d.plugin_type == 'winbind':
-                continue
+                try:
+                    group = self.context.groups_cache.fetch(d, d.instance.getgruuid, uuid)
+                except:
+                    continue
 
-            try:
-                group = d.instance.getgruuid(uuid)
-            except:
-                continue
+                if group:
+                    aliases = alias(d, group, 'name')
+                    return CacheItem(group['gid'], group['id'], aliases, copy.copy(group), d, d.cache_ttl)
 
-            if group:
-                aliases = alias(d, group, 'name')
-                item = CacheItem(group['gid'], group['id'], aliases, copy.copy(group), d, self.context.cache_ttl)
-                self.context.groups_cache.set(item)
-                return item.annotated
+        item = self.context.groups_cache.lookup(fetch, skip_ad, uuid=uuid)
+        if not item or (skip_ad and item.directory.plugin_type == 'winbind'):
+            raise RpcException(errno.ENOENT, 'UUID {0} not found'.format(uuid))
 
-        raise RpcException(errno.ENOENT, 'UUID {0} not found'.format(uuid))
+        return item.annotated
 
 
 class HostService(RpcService):
@@ -830,6 +957,7 @@ class HostService(RpcService):
 
     def gethostbyaddr(self, addr, af):
         if addr in list(my_ips()):
+            self.context.configstore.check()
             hostname = self.context.configstore.get('system.hostname')
             return {
                 'name': hostname,
@@ -860,72 +988,108 @@ class IdmapService(RpcService):
         self.logger = logging.getLogger('IdmapService')
         self.localsid = None
 
-    def sids_to_unixids(self, sids):
+    def get_localsid(self):
         if not self.localsid:
             self.localsid = self.context.configstore.get('service.smb.sid')
 
-        result = []
-        for i in sids:
-            base, rid = split_sid(i)
-            if base == self.localsid:
+        return self.localsid
+
+    def cache_mapping(self, directory, type, xid, sid):
+        self.context.idmap_cache.set(CacheItem(
+            (type, xid), sid, [],
+            {'type': type, 'xid': xid, 'sid': sid},
+            directory, directory.cache_ttl
+        ))
+
+    def sids_to_unixids(self, sids):
+        localsid = self.get_localsid()
+        result = [[None, None] for _ in sids]
+        domains = {}
+        pending = {}
+
+        for i, sid in enumerate(sids):
+            base, rid = split_sid(sid)
+            if base == localsid:
                 # RID translation in order
-                xid, type = rid_to_xid(rid, RID_BASE)
-                result.append([type, xid])
-                self.logger.debug(f'Translated SID {i} into {type} {xid}')
+                xid, type = rid_to_xid(int(rid), RID_BASE)
+                result[i] = [type, xid]
                 continue
 
-            for d in self.context.get_active_directories():
-                if d.instance.get_domain_sid() == base:
-                    item = d.instance.getsid(i)
-                    if item:
-                        if 'uid' in item:
-                            result.append(['UID', item['uid']])
-                            self.logger.debug(f'Translated SID {i} into UID {item["uid"]}')
-                        else:
-                            result.append(['GID', item['gid']])
-                            self.logger.debug(f'Translated SID {i} into GID {item["gid"]}')
-
-                        break
-            else:
-                result.append([None, None])
+            item = self.context.idmap_cache.get(uuid=sid)
+            if item:
+                result[i] = [item.value['type'], item.value['xid']]
+                continue
+
+            pending.setdefault(base, []).append((i, sid))
+
+        if not pending:
+            return result
+
+        for d in self.context.get_active_directories():
+            domain_sid = d.instance.get_domain_sid()
+            if domain_sid in pending:
+                domains.setdefault(domain_sid, []).append(d)
+
+        for base, entries in pending.items():
+            for d in domains.get(base, []):
+                try:
+                    mappings = self.context.idmap_cache.fetch(d, d.instance.map_sids, [sid for _, sid in entries])
+                except:
+                    self.logger.warning(f'Directory {d.name} failed to translate SIDs', exc_info=True)
+                    continue
+
+                remaining = []
+                for i, sid in entries:
+                    mapping = mappings.get(sid)
+                    if not mapping:
+                        remaining.append((i, sid))
+                        continue
 
+                    type, xid = mapping
+                    self.cache_mapping(d, type, xid, sid)
+                    result[i] = [type, xid]
+
+                entries = remaining
+                if not entries:
+                    break
+
+        self.logger.debug(f'Translated {len(sids)} SIDs, {len(pending)} domains looked up')
         return result
 
     def unixids_to_sids(self, ids):
-        if not self.localsid:
-            self.localsid = self.context.configstore.get('service.smb.sid')
-
+        localsid = self.get_localsid()
         result = []
         for type, xid in ids:
             if type == 'UID':
-                self.context.account_service.getpwuid(xid)
-                entry = self.context.users_cache.get(id=xid)
+                cache = self.context.users_cache
+                lookup = self.context.account_service.getpwuid
                 rid = uid_to_rid(xid, RID_BASE)
 
             elif type == 'GID':
-                self.context.group_service.getgrgid(xid)
-                entry = self.context.groups_cache.get(id=xid)
+                cache = self.context.groups_cache
+                lookup = self.context.group_service.getgrgid
                 rid = gid_to_rid(xid, RID_BASE)
 
             else:
                 raise RpcException(errno.EINVAL, f'Unknown ID type {type}')
 
-            if entry.value.get('sid'):
-                result.append(entry.value['sid'])
-                self.logger.debug(f'Translated {type} {xid} into SID {entry.value["sid"]}')
+            item = self.context.idmap_cache.get(id=(type, xid))
+            if item:
+                result.append(item.value['sid'])
                 continue
 
-            if entry.directory.instance.get_domain_sid() == self.localsid:
-                if type == 'UID':
-                    rid = uid_to_rid(xid, RID_BASE)
-                elif type == 'GID':
-                    rid = gid_to_rid(xid, RID_BASE)
+            lookup(xid)
+            entry = cache.get(id=xid)
+            sid = entry.value.get('sid')
 
-                result.append(f'{self.localsid}-{rid}')
-                self.logger.debug(f'Translated {type} {xid} into SID {self.localsid}-{rid}')
-                continue
+            if not sid and entry.directory.instance.get_domain_sid() == localsid:
+                sid = f'{localsid}-{rid}'
 
-            result.append(None)
+            if sid:
+                self.cache_mapping(entry.directory, type, xid, sid)
+                self.logger.debug(f'Translated {type} {xid} into SID {sid}')
+
+            result.append(sid)
 
         return result
 
@@ -947,6 +1111,7 @@ class Main(object):
         self.users_cache = TTLCacheStore()
         self.groups_cache = TTLCacheStore()
         self.hosts_cache = TTLCacheStore()
+        self.idmap_cache = TTLCacheStore()
         self.cache_ttl = 7200
         self.search_order = []
         self.cache_enumerations = True
@@ -1023,7 +1188,11 @@ class Main(object):
             self.logger.error('Cannot initialize datastore: %s', str(err))
             sys.exit(1)
 
-        self.configstore = ConfigStore(self.datastore)
+        self.configstore = ConfigStore(self.datastore, cache=True)
+
+    def on_config_changed(self, args):
+        if args.get('pid') != os.getpid():
+            self.configstore.invalidate(args.get('keys'))
 
     def init_dispatcher(self):
         def on_error(reason, **kwargs):
@@ -1034,6 +1203,7 @@ class Main(object):
         self.client = Client()
         self.client.on_error(on_error)
         self.connect()
+        self.client.register_event_handler(CONFIG_CHANGED_EVENT, self.on_config_changed)
 
     def init_server(self, address):
         self.server = Server(self)
@@ -1063,6 +1233,9 @@ class Main(object):
             try:
                 self.client.connect('unix:')
                 self.client.login_service('dscached')
+                self.client.subscribe_events(CONFIG_CHANGED_EVENT)
+                # Changes made while disconnected were never announced to us
+                self.configstore.invalidate()
                 self.client.enable_server(self.rpc)
                 self.client.resume_service('dscached.account')
                 self.client.resume_service('dscached.group')
@@ -1115,6 +1288,7 @@ class Main(object):
                 continue
 
     def load_config(self):
+        self.configstore.check()
         self.search_order = self.configstore.get('directory.search_order')
         self.cache_ttl = self.configstore.get('directory.cache_ttl')
         self.cache_enumerations = self.configstore.get('directory.cache_enumerations')
@@ -85,6 +85,15 @@ class DirectoryServicePlugin(object):
     def getsid(self, sid):
         raise NotImplementedError()
 
+    def map_sids(self, sids):
+        result = {}
+        for i in sids:
+            item = self.getsid(i)
+            if item:
+                result[i] = ('UID', item['uid']) if 'uid' in item else ('GID', item['gid'])
+
+        return result
+
     def configure(self, *args, **kwargs):
         pass
 
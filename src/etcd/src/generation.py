@@ -0,0 +1,170 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import copy
+import collections.abc
+
+
+DATASTORE_READ_METHODS = ('query', 'query_stream', 'get_one', 'get_by_id', 'exists')
+
+
+def is_read_only(method):
+    name = method.rsplit('.', 1)[-1]
+    return name == 'query' or name.startswith('get')
+
+
+def collection_matches(collection, service):
+    # Collections are named after their service, mostly in plural
+    # ('users' for user.*, 'iscsi.targets' for iscsi.target.*)
+    return collection in (service, service + 's')
+
+
+class GenerationPass(object):
+    """
+    State shared by everything generated in response to a single request:
+    results of read-only RPC calls and the targets already generated.
+    """
+    def __init__(self):
+        self.results = {}
+        self.generated = set()
+
+
+class Dependencies(object):
+    def __init__(self):
+        self.config = set()
+        self.methods = set()
+        self.collections = set()
+
+    def __getstate__(self):
+        return {
+            'config': sorted(self.config),
+            'methods': sorted(self.methods),
+            'collections': sorted(self.collections)
+        }
+
+    def matches(self, keys=None, methods=None):
+        for k in keys or []:
+            for i in self.config:
+                if not i or k == i or k.startswith(i + '.') or i.startswith(k + '.'):
+                    return True
+
+        for m in methods or []:
+            for i in self.methods:
+                if m == i or i.startswith(m + '.'):
+                    return True
+
+            for i in self.collections:
+                if collection_matches(i, m):
+                    return True
+
+        return False
+
+
+class RecordingClient(object):
+    def __init__(self, client, generation_pass, dependencies):
+        self.client = client
+        self.generation_pass = generation_pass
+        self.dependencies = dependencies
+
+    def __getattr__(self, item):
+        return getattr(self.client, item)
+
+    def call_sync(self, name, *args, **kwargs):
+        # Writes are not dependencies, and would make whatever does them
+        # get marked dirty by its own changes
+        if not is_read_only(name):
+            return self.client.call_sync(name, *args, **kwargs)
+
+        self.dependencies.methods.add(name)
+
+        key = (name, repr(args), repr(sorted(kwargs.items())))
+        if key not in self.generation_pass.results:
+            result = self.client.call_sync(name, *args, **kwargs)
+            if isinstance(result, collections.abc.Iterator):
+                result = list(result)
+
+            self.generation_pass.results[key] = result
+
+        # Templates are free to modify whatever they got
+        return copy.deepcopy(self.generation_pass.results[key])
+
+
+class RecordingConfigStore(object):
+    def __init__(self, configstore, dependencies):
+        self.configstore = configstore
+        self.dependencies = dependencies
+
+    def __getattr__(self, item):
+        return getattr(self.configstore, item)
+
+    def exists(self, key):
+        self.dependencies.config.add(key)
+        return self.configstore.exists(key)
+
+    def get(self, key, default=None):
+        self.dependencies.config.add(key)
+        return self.configstore.get(key, default)
+
+    def list_children(self, key=None):
+        self.dependencies.config.add(key or '')
+        return self.configstore.list_children(key)
+
+    def children_dict(self, root):
+        self.dependencies.config.add(root)
+        return self.configstore.children_dict(root)
+
+
+class RecordingDatastore(object):
+    def __init__(self, datastore, dependencies):
+        self.datastore = datastore
+        self.dependencies = dependencies
+
+    def __getattr__(self, item):
+        attr = getattr(self.datastore, item)
+        if item not in DATASTORE_READ_METHODS:
+            return attr
+
+        def fn(collection, *args, **kwargs):
+            self.dependencies.collections.add(collection)
+            return attr(collection, *args, **kwargs)
+
+        return fn
+
+
+class GenerationContext(object):
+    """
+    Stands in for the etcd context while generating a single file or
+    running a single plugin, recording what it reads.
+    """
+    def __init__(self, context, generation_pass, dependencies):
+        self.context = context
+        self.client = RecordingClient(context.client, generation_pass, dependencies)
+        self.configstore = RecordingConfigStore(context.configstore, dependencies)
+        self.datastore = RecordingDatastore(context.datastore, dependencies)
+
+    def __getattr__(self, item):
+        return getattr(self.context, item)
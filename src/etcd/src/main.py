@@ -35,9 +35,13 @@ import errno
 import datastore
 import time
 import imp
+import tempfile
+import threading
+import contextlib
 import renderers
+from generation import GenerationPass, GenerationContext, Dependencies
 from bsd import setproctitle
-from datastore.config import ConfigStore
+from datastore.config import ConfigStore, CONFIG_CHANGED_EVENT
 from freenas.dispatcher.client import Client, ClientError
 from freenas.dispatcher.rpc import RpcService, RpcException
 from freenas.utils import configure_logging
@@ -46,6 +50,8 @@ from freenas.serviced import checkin
 
 
 DEFAULT_CONFIGFILE = '/usr/local/etc/middleware.conf'
+EVENT_SUFFIX = '.changed'
+ENTITY_SUBSCRIBER_PREFIX = 'entity-subscriber.'
 TEMPLATE_RENDERERS = {
     '.mako': renderers.MakoTemplateRenderer,
     '.py': renderers.PythonRenderer,
@@ -69,20 +75,48 @@ class FileGenerationService(RpcService):
         self.context = ctx
         self.context.generate_all = self.generate_all
         self.datastore = ctx.datastore
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def generation_pass(self):
+        current = getattr(self.local, 'current', None)
+        if current:
+            yield current
+            return
+
+        # Whoever asked for this may have just written the config, and its
+        # config.changed event can still be on its way
+        self.context.configstore.check()
+        self.local.current = GenerationPass()
+        try:
+            yield self.local.current
+        finally:
+            self.local.current = None
 
     def generate_all(self):
-        for group in self.datastore.query('etcd.groups'):
-            self.generate_group(group['name'])
+        with self.generation_pass():
+            for group in self.datastore.query('etcd.groups'):
+                self.generate_group(group['name'])
 
     def generate_file(self, filename):
         if filename not in self.context.managed_files.keys():
             return
 
-        text = self.context.generate_file(filename)
+        with self.generation_pass() as p:
+            target = 'file:{0}'.format(filename)
+            if target in p.generated:
+                return
+
+            p.generated.add(target)
+            self.context.mark_clean(target)
+            dependencies = Dependencies()
+            text = self.context.generate_file(filename, GenerationContext(self.context, p, dependencies))
+            self.context.dependencies[target] = dependencies
+
         filepath = os.path.join(self.context.root, filename)
         try:
-            with open(filepath, 'w', encoding='utf-8') as fd:
-                fd.write(text)
+            if not self.context.write_file(filepath, text):
+                return
         except FileNotFoundError as e:
             self.context.logger.error('Failed to open {0}: {1}'.format(filepath, e), exc_info=True)
             return
@@ -106,25 +140,71 @@ class FileGenerationService(RpcService):
             self.context.logger.error('Invalid plugin source {0}, no run method'.format(pname))
             return
 
-        try:
-            plugin.run(self.context)
-        except Exception as err:
-            self.context.logger.error('Cannot run plugin {0}: {1}'.format(name, str(err)), exc_info=True)
+        with self.generation_pass() as p:
+            target = 'plugin:{0}'.format(name)
+            if target in p.generated:
+                return
+
+            p.generated.add(target)
+            self.context.mark_clean(target)
+            dependencies = Dependencies()
+            try:
+                plugin.run(GenerationContext(self.context, p, dependencies))
+            except Exception as err:
+                self.context.logger.error('Cannot run plugin {0}: {1}'.format(name, str(err)), exc_info=True)
+
+            self.context.dependencies[target] = dependencies
 
     def generate_group(self, name):
         group = self.datastore.get_one('etcd.groups', ('name', '=', name))
         if not group:
             raise RpcException(errno.ENOENT, 'Group {0} not found'.format(name))
 
-        for i in group['dependencies']:
-            typ, fname = i.split(':')
+        with self.generation_pass():
+            for i in group['dependencies']:
+                typ, fname = i.split(':')
+
+                if typ == 'file':
+                    self.generate_file(fname)
+                elif typ == 'plugin':
+                    self.generate_plugin(fname)
+                elif typ == 'group':
+                    self.generate_group(fname)
+
+    def generate_dependents(self, keys=None, methods=None):
+        """
+        Regenerates files and plugins which read any of the given config
+        keys (or their parents/children), called any of the given RPC
+        methods (or methods of the given services) or read the datastore
+        collection of any of the given services the last time around.
+        """
+        result = []
+        with self.generation_pass():
+            for target, dependencies in list(self.context.dependencies.items()):
+                if not dependencies.matches(keys, methods):
+                    continue
+
+                typ, name = target.split(':', 1)
+                if typ == 'file':
+                    self.generate_file(name)
+                elif typ == 'plugin':
+                    self.generate_plugin(name)
+
+                result.append(target)
 
-            if typ == 'file':
-                self.generate_file(fname)
-            elif typ == 'plugin':
-                self.generate_plugin(fname)
-            elif typ == 'group':
-                self.generate_group(fname)
+        return result
+
+    def get_dirty(self):
+        """
+        Returns files and plugins whose inputs changed since they were
+        last generated. Tasks are expected to regenerate those (through
+        generate_dependents() or otherwise) along with reloading whatever
+        uses them; etcd never does that on its own.
+        """
+        return self.context.get_dirty()
+
+    def get_dependencies(self):
+        return {k: v.__getstate__() for k, v in self.context.dependencies.items()}
 
     def get_managed_files(self):
         return self.context.managed_files
@@ -143,9 +223,13 @@ class Main(object):
         self.datastore = None
         self.configstore = None
         self.client = None
+        self.generation_service = None
+        self.dirty = set()
+        self.dirty_lock = threading.Lock()
         self.plugin_dirs = []
         self.renderers = {}
         self.managed_files = {}
+        self.dependencies = {}
 
     def init_datastore(self):
         try:
@@ -154,7 +238,43 @@ class Main(object):
             self.logger.error('Cannot initialize datastore: %s', str(err))
             sys.exit(1)
 
-        self.configstore = ConfigStore(self.datastore)
+        self.configstore = ConfigStore(self.datastore, cache=True, notify=self.config_changed)
+
+    def config_changed(self, keys):
+        try:
+            self.client.emit_event(CONFIG_CHANGED_EVENT, {'keys': keys, 'pid': os.getpid()})
+        except (OSError, RpcException) as err:
+            self.logger.warning('Cannot announce config change: {0}'.format(str(err)))
+
+    def on_config_changed(self, args):
+        if args.get('pid') != os.getpid():
+            self.configstore.invalidate(args.get('keys'))
+
+    def on_event(self, name, args):
+        if not name.endswith(EVENT_SUFFIX):
+            return
+
+        if name == CONFIG_CHANGED_EVENT:
+            # Our own writes come from generation itself
+            if args.get('pid') != os.getpid():
+                self.mark_dirty(keys=args.get('keys'))
+            return
+
+        self.mark_dirty(services=[name[:-len(EVENT_SUFFIX)]])
+
+    def mark_dirty(self, keys=None, services=None):
+        with self.dirty_lock:
+            for target, dependencies in list(self.dependencies.items()):
+                if dependencies.matches(keys, services):
+                    self.dirty.add(target)
+
+    def mark_clean(self, target):
+        with self.dirty_lock:
+            self.dirty.discard(target)
+
+    def get_dirty(self):
+        with self.dirty_lock:
+            return sorted(self.dirty)
 
     def init_dispatcher(self):
         def on_error(reason, **kwargs):
@@ -164,15 +284,27 @@ class Main(object):
 
         self.client = Client()
         self.client.on_error(on_error)
+        self.client.on_event(self.on_event)
+        self.generation_service = FileGenerationService(self)
         self.connect()
+        self.client.register_event_handler(CONFIG_CHANGED_EVENT, self.on_config_changed)
 
     def connect(self):
         while True:
             try:
                 self.client.connect('unix:')
                 self.client.login_service('etcd')
+                self.client.subscribe_events(CONFIG_CHANGED_EVENT)
+                # Changes made while disconnected were never announced to us
+                self.configstore.invalidate()
+                # Subscribe by name; a '*.changed' mask would also pull in
+                # every entity-subscriber event source
+                self.client.subscribe_events(*[
+                    i for i in self.client.call_sync('event.get_event_types')
+                    if i.endswith(EVENT_SUFFIX) and not i.startswith(ENTITY_SUBSCRIBER_PREFIX)
+                ])
                 self.client.enable_server()
-                self.client.register_service('etcd.generation', FileGenerationService(self))
+                self.client.register_service('etcd.generation', self.generation_service)
                 self.client.register_service('etcd.management', ManagementService(self))
                 self.client.register_service('etcd.debug', DebugService())
                 self.client.resume_service('etcd.generation')
@@ -220,7 +352,7 @@ class Main(object):
                     self.managed_files[name] = abspath
                     self.logger.info('Adding managed file %s [%s]', name, ext)
 
-    def generate_file(self, file_path):
+    def generate_file(self, file_path, context=None):
         if file_path not in self.managed_files.keys():
             raise RpcException(errno.ENOENT, 'No such file')
 
@@ -231,11 +363,42 @@ class Main(object):
 
         renderer = self.renderers[ext]
         try:
-            return renderer.render_template(template_path)
+            return renderer.render_template(template_path, context)
         except Exception as e:
             self.logger.warn('Cannot generate file {0}: {1}'.format(file_path, str(e)))
             return "# FILE GENERATION FAILED: {0}\n".format(str(e))
 
+    def write_file(self, filepath, text):
+        data = text.encode('utf-8')
+        try:
+            st = os.stat(filepath)
+            with open(filepath, 'rb') as fd:
+                if fd.read() == data:
+                    return False
+        except FileNotFoundError:
+            st = None
+
+        # Write next to the target and rename over it, so nobody ever
+        # sees a partially written file
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(filepath), prefix='.etcd.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+
+            if st:
+                os.chmod(tmppath, st.st_mode & 0o7777)
+                os.chown(tmppath, st.st_uid, st.st_gid)
+            else:
+                os.chmod(tmppath, 0o644)
+
+            os.replace(tmppath, filepath)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmppath)
+            raise
+
+        return True
+
     def emit_event(self, name, params):
         self.client.emit_event(name, params)
 
@@ -27,10 +27,13 @@
 
 
 from mako import exceptions
-from mako.template import Template
+from mako.lookup import TemplateLookup
 from datastore.config import ConfigStore
 
 
+TEMPLATE_MODULE_DIR = '/var/tmp/etcd/templates'
+
+
 class TemplateFunctions:
     @staticmethod
     def disclaimer(comment_style='#'):
@@ -40,19 +43,27 @@ class TemplateFunctions:
 class MakoTemplateRenderer(object):
     def __init__(self, context):
         self.context = context
+        # Compiled templates are kept in memory and in the module directory,
+        # and recompiled only when the template source changes
+        self.lookup = TemplateLookup(
+            directories=['/'],
+            module_directory=TEMPLATE_MODULE_DIR,
+            filesystem_checks=True
+        )
 
-    def get_template_context(self):
+    def get_template_context(self, context=None):
+        context = context or self.context
         return {
             "disclaimer": TemplateFunctions.disclaimer,
-            "config": self.context.configstore,
-            "dispatcher": self.context.client,
-            "ds": self.context.datastore
+            "config": context.configstore,
+            "dispatcher": context.client,
+            "ds": context.datastore
         }
 
-    def render_template(self, path):
+    def render_template(self, path, context=None):
         try:
-            tmpl = Template(filename=path)
-            return tmpl.render(**self.get_template_context())
+            tmpl = self.lookup.get_template(path)
+            return tmpl.render(**self.get_template_context(context))
         except:
             self.context.logger.debug('Failed to render mako template: {0}'.format(
                 exceptions.text_error_template().render()
@@ -40,9 +40,9 @@ import dateutil.tz
 import tables
 import signal
 import time
+import calendar
 import collections
 import numpy as np
-import pandas as pd
 from datetime import datetime, timedelta
 import gevent
 import gevent.socket
@@ -53,7 +53,7 @@ from gevent.server import StreamServer
 from freenas.dispatcher.client import Client, ClientError
 from freenas.dispatcher.rpc import RpcService, RpcException, accepts, returns, generator
 from datastore import DatastoreException, get_datastore
-from ringbuffer import MemoryRingBuffer, PersistentRingBuffer
+from ringbuffer import MemoryRingBuffer, PersistentRingBuffer, Rollup, resample
 from freenas.utils.debug import DebugService
 from freenas.utils.trace_logger import TRACE
 from freenas.utils import configure_logging, to_timedelta, materialized_paths_to_tree
@@ -63,6 +63,17 @@ from freenas.serviced import checkin
 EVENT_RE = re.compile(r'^statd\.(.*)\.pulse$')
 DEFAULT_CONFIGFILE = '/usr/local/etc/middleware.conf'
 DEFAULT_DBFILE = 'stats.hdf'
+FLUSH_INTERVAL = 30
+QUERY_CACHE_SIZE = 8
+INPUT_BUFFER_SIZE = 256 * 1024
+FREQUENCY_RE = re.compile(r'^(\d*)\s*([a-zA-Z]+)$')
+FREQUENCY_UNITS = {
+    'S': 1, 's': 1, 'sec': 1,
+    'T': 60, 'min': 60,
+    'H': 3600, 'h': 3600,
+    'D': 86400, 'd': 86400,
+    'W': 604800, 'w': 604800
+}
 threadpool = gevent.threadpool.ThreadPool(5)
 
 
@@ -70,6 +81,56 @@ def round_timestamp(timestamp, frequency):
     return int(frequency * round(float(timestamp) / frequency))
 
 
+def parse_points(buffer):
+    """
+    Parses a buffer of complete graphite plaintext protocol lines.
+    Returns names (list of bytes), values (float64) and timestamps (int64).
+    """
+    tokens = buffer.split()
+    if len(tokens) % 3 == 0 and buffer.count(b'\n') == len(tokens) // 3:
+        try:
+            names = tokens[0::3]
+            values = np.array(tokens[1::3]).astype('f8')
+            timestamps = np.array(tokens[2::3]).astype('f8').astype('i8')
+            return names, values, timestamps
+        except ValueError:
+            pass
+
+    # Slow path: blank or malformed lines in the buffer
+    names = []
+    values = []
+    timestamps = []
+    for line in buffer.splitlines():
+        try:
+            name, value, timestamp = line.split()
+            value = float(value)
+            timestamp = int(float(timestamp))
+        except ValueError:
+            continue
+
+        names.append(name)
+        values.append(value)
+        timestamps.append(timestamp)
+
+    return names, np.array(values, dtype='f8'), np.array(timestamps, dtype='i8')
+
+
+def parse_frequency(s):
+    m = FREQUENCY_RE.match(s)
+    if not m or m.group(2) not in FREQUENCY_UNITS:
+        raise ValueError('Invalid frequency: {0}'.format(s))
+
+    step = int(m.group(1) or 1) * FREQUENCY_UNITS[m.group(2)]
+    if step <= 0:
+        raise ValueError('Invalid frequency: {0}'.format(s))
+
+    return step
+
+
+def to_timestamp(dt):
+    return calendar.timegm(dt.utctimetuple())
+
+
 def parse_datetime(s):
     return dateutil.parser.parse(s)
 
@@ -135,10 +196,15 @@ class DataSource(object):
         self.logger = logging.getLogger('DataSource:{0}'.format(self.name))
         self.bucket_buffers = self.create_buckets()
         self.primary_buffer = self.bucket_buffers[0]
+        self.rollups = [
+            (Rollup(int(b.interval.total_seconds()), b.consolidation), self.bucket_buffers[b.index])
+            for b in self.config.buckets[1:]
+        ]
         self.primary_interval = self.config.buckets[0].interval
         self.last_value = 0
         self.events_enabled = False
         self.alerts = alert_config
+        self.query_cache = collections.OrderedDict()
 
     def create_buckets(self):
         # Primary bucket should be hold in memory
@@ -156,10 +222,11 @@ class DataSource(object):
         timestamp = round_timestamp(timestamp, self.config.primary_interval.total_seconds())
         change = None
         self.primary_buffer.push(timestamp, value)
+        self.query_cache.clear()
 
-        for b in self.config.buckets[1:]:
-            if timestamp % b.interval.total_seconds() == 0:
-                self.persist(timestamp, self.bucket_buffers[b.index], b)
+        for rollup, buffer in self.rollups:
+            for ts, v in rollup.add(timestamp, value):
+                buffer.push(ts, v)
 
         if math.isnan(value):
             value = None
@@ -192,35 +259,54 @@ class DataSource(object):
                     if value < self.alerts['alert_low']:
                         self.emit_alert_low()
 
-    def persist(self, timestamp, buffer, bucket):
-        def doit():
-            count = bucket.interval.total_seconds() / self.config.buckets[0].interval.total_seconds()
-            data = self.bucket_buffers[0].data
-            mean = np.mean(list(zip(*data[-count:]))[1])
-            buffer.push(timestamp, mean)
+    def submit_many(self, timestamps, values):
+        for timestamp, value in zip(timestamps.tolist(), values.tolist()):
+            self.submit(timestamp, value)
+
+    def write(self):
+        written = False
+        for b in self.bucket_buffers[1:]:
+            if b.write():
+                written = True
 
-        threadpool.apply(doit)
+        return written
 
     def query(self, start, end, frequency):
+        """
+        Returns timestamps and values of the data source between start and end,
+        resampled to frequency. Results are cached until new data arrives, so
+        they must not be modified.
+        """
+        step = parse_frequency(frequency)
+        first = to_timestamp(start) // step
+        last = to_timestamp(end) // step
+        key = (first, last, step)
+
+        ret = self.query_cache.get(key)
+        if ret is not None:
+            self.query_cache.move_to_end(key)
+            return ret
+
         self.logger.debug('Query: start={0}, end={1}, frequency={2}'.format(start, end, frequency))
         buckets = list(self.config.get_covered_buckets(start, end))
 
-        def doit():
-            df = pd.DataFrame()
+        # Make pending rows visible before handing tables to a worker thread
+        self.write()
 
-            for b in buckets:
-                new = self.bucket_buffers[b.index].df
-                if new is not None:
-                    df = pd.concat((df, new))
+        def doit():
+            return resample(
+                [self.bucket_buffers[b.index].views() for b in buckets],
+                first * step,
+                max(last - first + 1, 0),
+                step
+            )
 
-            df = df.reset_index().drop_duplicates(subset='index').set_index('index')
-            if len(buckets):
-                df = df.sort()[0]
-                df = df[start:end]
-                df = df.resample(frequency, how='mean').interpolate()
-            return df
+        ret = threadpool.apply(doit)
+        self.query_cache[key] = ret
+        if len(self.query_cache) > QUERY_CACHE_SIZE:
+            self.query_cache.popitem(last=False)
 
-        return threadpool.apply(doit)
+        return ret
 
     def check_alerts(self):
         if self.last_value is not None:
@@ -269,6 +355,7 @@ class InputServer(object):
         self.context = context
         self.thread = None
         self.server = StreamServer(('127.0.0.1', 2003), handle=self.handle)
+        self.handles = {}
 
     def start(self):
         self.thread = gevent.spawn(self.server.serve_forever)
@@ -276,17 +363,49 @@ class InputServer(object):
     def stop(self):
         gevent.kill(self.thread)
 
+    def get_handle(self, name):
+        # Maps series names as they come on the wire to data sources
+        try:
+            return self.handles[name]
+        except KeyError:
+            _, _, datapoint = name.decode('utf-8', 'replace').partition('.')
+            ds = self.context.get_data_source('localhost.{0}'.format(datapoint))
+            self.handles[name] = ds
+            return ds
+
+    def submit(self, buffer, address):
+        try:
+            names, values, timestamps = parse_points(buffer)
+            if not names:
+                return
+
+            # Group points by series, keeping arrival order within each series
+            series, inverse = np.unique(np.array(names, dtype=object), return_inverse=True)
+            order = np.argsort(inverse, kind='stable')
+            bounds = np.cumsum(np.bincount(inverse))[:-1]
+
+            for name, idx in zip(series, np.split(order, bounds)):
+                self.get_handle(name).submit_many(timestamps[idx], values[idx])
+        except Exception as err:
+            self.context.logger.warning('Cannot process input from {0}: {1}'.format(address, str(err)))
+
     def handle(self, socket, address):
-        fd = socket.makefile()
+        pending = b''
         while True:
-            line = fd.readline()
-            if not line:
+            data = socket.recv(INPUT_BUFFER_SIZE)
+            if not data:
                 break
 
-            name, value, timestamp = line.split()
-            _, _, datapoint = name.partition('.')
-            ds = self.context.get_data_source('localhost.{0}'.format(datapoint))
-            ds.submit(int(timestamp), float(value))
+            pending += data
+            end = pending.rfind(b'\n')
+            if end == -1:
+                continue
+
+            self.submit(pending[:end + 1], address)
+            pending = pending[end + 1:]
+
+        if pending.strip():
+            self.submit(pending, address)
 
         socket.shutdown(gevent.socket.SHUT_RDWR)
         socket.close()
@@ -347,50 +466,28 @@ class OutputService(RpcService):
 
     @generator
     def get_stats(self, data_source, params):
-        start = params.pop('start', None)
-        end = params.pop('end', datetime.utcnow())
-        timespan = params.pop('timespan', None)
-        frequency = params.pop('frequency', '10S')
-
-        if start is None and timespan is None:
-            raise RpcException(errno.EINVAL, 'Either "start" or "timespan" is required')
-
-        if start is not None and timespan is not None:
-            raise RpcException(errno.EINVAL, 'Both "start" and "timespan" specified')
-
-        if timespan is not None:
-            start = datetime.utcnow() - timedelta(seconds=timespan)
-
-        if start.tzinfo:
-            start = local_to_utc(start)
-
-        if end.tzinfo:
-            end = local_to_utc(end)
+        _, columns = self.context.query(data_source, params)
 
         if type(data_source) is str:
-            ds = self.context.data_sources.get(data_source)
-            if not ds:
-                raise RpcException(errno.ENOENT, 'Data source {0} not found'.format(data_source))
-
-            df = ds.query(start, end, frequency)
-            for i in range(len(df)):
-                yield str(df[i])
+            for i in columns[0]:
+                yield str(i)
 
             return
 
-        if type(data_source) is list:
-            final = pd.DataFrame()
-            for ds_name in data_source:
-                ds = self.context.data_sources.get(ds_name)
-                if not ds:
-                    raise RpcException(errno.ENOENT, 'Data source {0} not found'.format(ds_name))
-
-                final[ds_name] = ds.query(start, end, frequency)
+        for row in zip(*columns):
+            yield [str(i) for i in row]
 
-            for i in range(len(final)):
-                yield [str(final[col][i]) for col in data_source]
+    def get_stats_columns(self, data_source, params):
+        timestamps, columns = self.context.query(data_source, params)
+        names = [data_source] if type(data_source) is str else data_source
 
-            return
+        return {
+            'timestamps': timestamps.tolist(),
+            'data': {
+                name: np.where(np.isnan(values), None, values).tolist()
+                for name, values in zip(names, columns)
+            }
+        }
 
 
 class AlertService(RpcService):
@@ -438,6 +535,7 @@ class Main(object):
         self.event_lock = RLock()
         self.logger = logging.getLogger('statd')
         self.data_sources = {}
+        self.flush_count = 0
 
     def init_datastore(self):
         try:
@@ -471,6 +569,24 @@ class Main(object):
         except Exception as e:
             self.logger.error(str(e))
 
+    def flush(self):
+        written = False
+        for ds in list(self.data_sources.values()):
+            if ds.write():
+                written = True
+
+        if written:
+            self.hdf.flush()
+            self.flush_count += 1
+
+    def flush_worker(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as err:
+                self.logger.error('Cannot flush stats database: {0}'.format(str(err)))
+
     def init_alert_config(self, name):
         config_name = name if self.datastore.exists('statd.alerts', ('id', '=', name)) else 'default'
         alert_config = self.datastore.get_by_id('statd.alerts', config_name)
@@ -487,6 +603,49 @@ class Main(object):
             self.client.call_sync('plugin.register_event_type', 'statd.output', 'statd.{0}.pulse'.format(name))
             return ds
 
+    def query(self, data_source, params):
+        """
+        Resampled values of one or more data sources, as a timestamps array
+        and a list of value arrays, one per data source
+        """
+        start = params.pop('start', None)
+        end = params.pop('end', datetime.utcnow())
+        timespan = params.pop('timespan', None)
+        frequency = params.pop('frequency', '10S')
+
+        if start is None and timespan is None:
+            raise RpcException(errno.EINVAL, 'Either "start" or "timespan" is required')
+
+        if start is not None and timespan is not None:
+            raise RpcException(errno.EINVAL, 'Both "start" and "timespan" specified')
+
+        if timespan is not None:
+            start = datetime.utcnow() - timedelta(seconds=timespan)
+
+        if start.tzinfo:
+            start = local_to_utc(start)
+
+        if end.tzinfo:
+            end = local_to_utc(end)
+
+        names = [data_source] if type(data_source) is str else data_source
+        sources = []
+        for ds_name in names:
+            ds = self.data_sources.get(ds_name)
+            if not ds:
+                raise RpcException(errno.ENOENT, 'Data source {0} not found'.format(ds_name))
+
+            sources.append(ds)
+
+        try:
+            # All columns share the same binning, so timestamps line up
+            columns = [ds.query(start, end, frequency) for ds in sources]
+        except ValueError as err:
+            raise RpcException(errno.EINVAL, str(err))
+
+        timestamps = columns[0][0] if columns else np.empty(0, dtype='i8')
+        return timestamps, [values for _, values in columns]
+
     def register_schemas(self):
         self.client.register_schema('GetStatsParams', {
             'type': 'object',
@@ -509,6 +668,24 @@ class Main(object):
             }
         })
 
+        self.client.register_schema('GetStatsColumnsResult', {
+            'type': 'object',
+            'additionalProperties': False,
+            'properties': {
+                'timestamps': {
+                    'type': 'array',
+                    'items': {'type': 'integer'}
+                },
+                'data': {
+                    'type': 'object',
+                    'additionalProperties': {
+                        'type': 'array',
+                        'items': {'type': ['number', 'null']}
+                    }
+                }
+            }
+        })
+
     def connect(self):
         while True:
             try:
@@ -543,6 +720,10 @@ class Main(object):
     def die(self):
         self.logger.warning('Exiting')
         self.server.stop()
+        if self.hdf:
+            self.flush()
+            self.hdf.close()
+
         self.client.disconnect()
         sys.exit(0)
 
@@ -583,6 +764,7 @@ class Main(object):
         self.init_dispatcher()
         self.init_database()
         self.server.start()
+        gevent.spawn(self.flush_worker)
         self.logger.info('Started')
         self.checkin()
         self.client.wait_forever()
@@ -26,6 +26,7 @@
 #####################################################################
 
 
+import math
 import time
 import numpy as np
 import pandas as pd
@@ -72,6 +73,18 @@ class MemoryRingBuffer(object):
 
         return pd.DataFrame(index=self.data['timestamp'], data=self.data['value'])
 
+    def views(self):
+        """
+        Contents in chronological order, as views into the underlying store
+        """
+        if self.empty:
+            return []
+
+        if self.tail > self.head:
+            return [self.store[self.head:self.tail]]
+
+        return [self.store[self.head:], self.store[:self.tail]]
+
     def push(self, timestamp, value):
         self.store[self.tail] = (timestamp, value)
         self.tail = (self.tail + 1) % self.size
@@ -82,10 +95,126 @@ class MemoryRingBuffer(object):
         pass
 
 
+def resample(buckets, start, count, step):
+    """
+    Resample ring buffer contents into count bins of step seconds, first one
+    starting at start. buckets is a list of view lists (see views()) ordered
+    from the finest to the coarsest resolution; each bin takes the mean of
+    the finest bucket having any samples in it. Empty bins are interpolated.
+    Returns timestamps (int64 seconds) and values (float64) arrays.
+    """
+    timestamps = start + np.arange(count, dtype='i8') * step
+    result = np.full(count, np.nan)
+
+    for views in buckets:
+        sums = np.zeros(count)
+        counts = np.zeros(count, dtype='i8')
+
+        for v in views:
+            ts = v['timestamp']
+            ts = ts.view('i8') if ts.dtype.kind == 'M' else ts.astype('i8')
+            values = v['value']
+            idx = (ts - start) // step
+            mask = (idx >= 0) & (idx < count) & ~np.isnan(values)
+            sums += np.bincount(idx[mask], weights=values[mask], minlength=count)
+            counts += np.bincount(idx[mask], minlength=count)
+
+        fill = (counts > 0) & np.isnan(result)
+        result[fill] = sums[fill] / counts[fill]
+
+    valid = ~np.isnan(result)
+    if valid.any():
+        first = np.argmax(valid)
+        x = np.arange(count)
+        result[first:] = np.interp(x[first:], x[valid], result[valid])
+
+    timestamps.flags.writeable = False
+    result.flags.writeable = False
+    return timestamps, result
+
+
+class Rollup(object):
+    """
+    Running aggregate of primary bucket values falling into one interval of
+    a lower resolution bucket. Updated on ingest, so that consolidating an
+    interval doesn't need to go back to the primary buffer.
+    """
+    def __init__(self, interval, consolidation=None):
+        self.interval = interval
+        self.consolidation = consolidation or 'avg'
+        self.period = None
+        self.points = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    @property
+    def value(self):
+        if not self.count:
+            return float('nan')
+
+        if self.consolidation == 'min':
+            return self.min
+
+        if self.consolidation == 'max':
+            return self.max
+
+        if self.consolidation == 'sum':
+            return self.sum
+
+        return self.sum / self.count
+
+    def reset(self):
+        self.period = None
+        self.points = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, timestamp, value):
+        """
+        Account value sampled at timestamp. Returns a list of (timestamp,
+        value) for each interval it finished, empty if the current one is
+        still open. A sample skipping past the previous boundary and landing
+        on the next one finishes two.
+        """
+        ret = []
+
+        # Interval is identified by its end; a sample right at the boundary
+        # belongs to the interval it closes
+        period = -(-timestamp // self.interval)
+        if self.points and period != self.period:
+            # Boundary sample never came, close the previous interval now
+            ret.append((self.period * self.interval, self.value))
+            self.reset()
+
+        self.period = period
+        self.points += 1
+        if not math.isnan(value):
+            self.count += 1
+            self.sum += value
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+
+        if timestamp % self.interval == 0:
+            ret.append((timestamp, self.value))
+            self.reset()
+
+        return ret
+
+
 class PersistentRingBuffer(object):
+    """
+    Ring buffer backed by a HDF5 table. Pushed rows are kept in memory and
+    written out by write(); head and tail pointers are mirrored in table
+    attributes only at that point, so a push costs no HDF5 I/O at all.
+    """
     def __init__(self, table, size):
         self.table = table
         self.size = size
+        self.pending = []
 
         if (
             not hasattr(self.table.attrs, 'tail')
@@ -97,53 +226,97 @@ class PersistentRingBuffer(object):
             self.table.attrs.head = 0
             self.fill_initial()
 
+        self.head = int(self.table.attrs.head)
+        self.tail = int(self.table.attrs.tail)
+        self.pending_start = self.tail
+
     @property
     def empty(self):
-        return self.table.attrs.head == self.table.attrs.tail
+        return self.head == self.tail
+
+    @property
+    def dirty(self):
+        return len(self.pending) > 0
 
     @property
     def used_count(self):
         if self.empty:
             return 0
 
-        if self.table.attrs.tail > self.table.attrs.head:
-            return self.table.attrs.tail - self.table.attrs.head - 1
+        if self.tail > self.head:
+            return self.tail - self.head - 1
 
-        if self.table.attrs.head > self.table.attrs.tail:
-            return (self.size - self.table.attrs.head) + self.table.attrs.tail - 1
+        if self.head > self.tail:
+            return (self.size - self.head) + self.tail - 1
 
     @property
     def data(self):
         if self.empty:
             return None
 
-        if self.table.attrs.tail > self.table.attrs.head:
-            return self.table[self.table.attrs.head:self.table.attrs.tail]
+        # Rows still pending in memory are not visible here, call write() first
+        if self.tail > self.head:
+            return self.table[self.head:self.tail]
 
-        if self.table.attrs.head > self.table.attrs.tail:
-            return np.concatenate((self.table[self.table.attrs.head:], self.table[:self.table.attrs.tail]))
+        if self.head > self.tail:
+            return np.concatenate((self.table[self.head:], self.table[:self.tail]))
 
     @property
     def df(self):
         if self.empty:
             return None
 
+        data = self.data
         return pd.DataFrame(
-            index=pd.to_datetime(self.data['timestamp'], unit='s', utc=True),
-            data=self.data['value']
+            index=pd.to_datetime(data['timestamp'], unit='s', utc=True),
+            data=data['value']
         )
 
+    def views(self):
+        # Rows still pending in memory are not visible here, call write() first
+        if self.empty:
+            return []
+
+        if self.tail > self.head:
+            return [self.table.read(self.head, self.tail)]
+
+        return [self.table.read(self.head), self.table.read(0, self.tail)]
+
     def fill_initial(self):
         self.table.truncate(self.size)
         self.table.flush()
 
     def push(self, timestamp, value):
-        self.table[self.table.attrs.tail] = (timestamp, value)
-        self.table.attrs.tail = (self.table.attrs.tail + 1) % self.size
-        if self.table.attrs.head == self.table.attrs.tail:
-            self.table.attrs.head = (self.table.attrs.head + 1) % self.size
+        if len(self.pending) == self.size:
+            # Wrapped around before anything got written out
+            self.write()
 
-        self.table.flush()
+        self.pending.append((timestamp, value))
+        self.tail = (self.tail + 1) % self.size
+        if self.head == self.tail:
+            self.head = (self.head + 1) % self.size
+
+    def write(self):
+        """
+        Write pending rows to the table, in at most two contiguous slices.
+        Doesn't flush the file; that is left to the owner of the HDF5 file,
+        which does it once for all tables.
+        """
+        if not self.pending:
+            return False
+
+        rows = np.array(self.pending, dtype=self.table.dtype)
+        start = self.pending_start
+        first = min(len(rows), self.size - start)
+        self.table.modify_rows(start, start + first, rows=rows[:first])
+        if first < len(rows):
+            self.table.modify_rows(0, len(rows) - first, rows=rows[first:])
+
+        self.table.attrs.head = self.head
+        self.table.attrs.tail = self.tail
+        self.pending = []
+        self.pending_start = self.tail
+        return True
 
     def pop(self):
         pass
@@ -45,12 +45,17 @@ from bsd import kinfo_getproc
 from bsd import SyslogPriority, SyslogFacility
 from freenas.dispatcher.server import Server
 from freenas.dispatcher.rpc import RpcContext, RpcService, RpcException, generator, get_sender
-from freenas.serviced import ServicedException, checkin, get_job_by_pid
+from freenas.serviced import ServicedException, checkin, get_job_by_pid, subscribe
 from freenas.utils import query as q
 from freenas.utils.debug import DebugService
+from store import LogStore
 
 
 FLUSH_INTERVAL = 180
+FLUSH_BATCH_SIZE = 1000
+BACKPRESSURE_TIMEOUT = 1
+PID_CACHE_SIZE = 1024
+PID_CACHE_TTL = 60
 RCVBUF_MINSIZE = 80 * 1024  # same as in syslogd
 SYSLOG_PATTERN = re.compile(r'<(?P<priority>\d+)>(?P<syslog_timestamp>\w+\s+\d+\s+\d+:\d+:\d+) (?P<identifier>[\w\[\]]+): (?P<message>.*)')
 KLOG_PATTERN = re.compile(r'<(?P<priority>\d+)>(?P<message>.*)')
@@ -76,6 +81,48 @@ def parse_priority(prio):
         return SyslogPriority(int(prio) & 0x7), facility
 
 
+class ServiceLabelCache(object):
+    """
+    Caches serviced job labels by pid, misses included, for PID_CACHE_TTL
+    seconds. Entries are dropped early when serviced reports a job
+    starting or going away.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def get(self, pid):
+        with self.lock:
+            entry = self.entries.get(pid)
+            if entry and entry[1] > time.monotonic():
+                self.entries.move_to_end(pid)
+                return entry[0]
+
+        try:
+            label = get_job_by_pid(pid, True)['Label']
+        except ServicedException:
+            label = None
+
+        with self.lock:
+            self.entries[pid] = (label, time.monotonic() + PID_CACHE_TTL)
+            self.entries.move_to_end(pid)
+            while len(self.entries) > PID_CACHE_SIZE:
+                self.entries.popitem(last=False)
+
+        return label
+
+    def on_event(self, name, args):
+        with self.lock:
+            if name == 'serviced.job.started':
+                self.entries.pop(args.get('PID'), None)
+                return
+
+            if name in ('serviced.job.stopped', 'serviced.job.error'):
+                for pid, (label, _) in list(self.entries.items()):
+                    if label == args.get('Label'):
+                        del self.entries[pid]
+
+
 class LoggingService(RpcService):
     def __init__(self, context):
         self.context = context
@@ -119,7 +166,7 @@ class LoggingService(RpcService):
             else []
 
         return q.query(
-            itertools.chain(ds_results, self.context.store),
+            itertools.chain(ds_results, self.context.store.query(filter)),
             *(filter or []),
             stream=True,
             **(params or {})
@@ -231,9 +278,7 @@ class SyslogForwarder(object):
 
 class Context(object):
     def __init__(self):
-        self.store = collections.deque()
-        self.lock = threading.Lock()
-        self.seqno = 0
+        self.store = LogStore()
         self.rpc_server = Server(self)
         self.boot_id = str(uuid.uuid4())
         self.exiting = False
@@ -243,13 +288,17 @@ class Context(object):
         self.klog_reader = None
         self.flush = False
         self.flush_thread = None
+        self.labels = ServiceLabelCache()
         self.datastore = None
+        self.flush_failing = False
         self.configstore = None
         self.started_at = datetime.utcnow()
         self.rpc = RpcContext()
         self.rpc.register_service_instance('logd.logging', LoggingService(self))
         self.rpc.register_service_instance('logd.debug', DebugService())
-        self.cv = threading.Condition()
+        self.cv_lock = threading.RLock()
+        self.cv = threading.Condition(self.cv_lock)
+        self.drained = threading.Condition(self.cv_lock)
 
     def init_configstore(self):
         ds = datastore.get_datastore()
@@ -288,6 +337,12 @@ class Context(object):
         thread = threading.Thread(target=self.klog_reader.process, name='klog reader', daemon=True)
         thread.start()
 
+    def init_serviced_events(self):
+        try:
+            subscribe(self.labels.on_event)
+        except (ServicedException, OSError) as err:
+            logging.warning('Cannot subscribe to serviced events: {0}'.format(err))
+
     def init_flush(self):
         self.flush_thread = threading.Thread(target=self.do_flush, name='Flush thread')
         self.flush_thread.start()
@@ -324,23 +379,22 @@ class Context(object):
             item['timestamp'] = datetime.now()
 
         if 'pid' in item:
-            try:
-                job = get_job_by_pid(item['pid'], True)
-                item['service'] = job['Label']
-            except ServicedException:
-                pass
+            label = self.labels.get(item['pid'])
+            if label:
+                item['service'] = label
+
+        priority, facility = parse_priority(item['priority'])
+        item.update({
+            'id': str(uuid.uuid4()),
+            'boot_id': self.boot_id,
+            'priority': priority.name,
+            'facility': facility.name if facility else None
+        })
 
-        with self.lock:
-            priority, facility = parse_priority(item['priority'])
-            item.update({
-                'id': str(uuid.uuid4()),
-                'seqno': self.seqno,
-                'boot_id': self.boot_id,
-                'priority': priority.name,
-                'facility': facility.name if facility else None
-            })
-            self.store.append(item)
-            self.seqno += 1
+        if self.store.full:
+            self.wait_for_flush()
+
+        self.store.append(item)
 
         self.server.broadcast_event('logd.logging.message', item)
         self.forward(item)
@@ -358,34 +412,89 @@ class Context(object):
         for i in self.forwarders:
             i.forward(msg.encode('utf-8', 'ignore'))
 
+    def wait_for_flush(self):
+        # Store is at capacity. Unless flushing is off, wake up the flush
+        # thread and give it a moment to drain the store before the oldest
+        # entries start going to disk. Without a working datastore there's
+        # nothing to wait for, entries spill to disk right away and the
+        # flush thread retries on its own schedule
+        with self.cv:
+            if not self.flush or self.exiting or not self.datastore or self.flush_failing:
+                return
+
+            self.cv.notify_all()
+            self.drained.wait(BACKPRESSURE_TIMEOUT)
+
+    def save(self, entries):
+        batch = []
+        for i in entries:
+            batch.append(i)
+            if len(batch) == FLUSH_BATCH_SIZE:
+                self.save_batch(batch)
+                batch = []
+
+        if batch:
+            self.save_batch(batch)
+
+    def save_batch(self, batch):
+        try:
+            self.datastore.insert_many('syslog', batch)
+        except datastore.DuplicateKeyException:
+            # Batch saved partially by an earlier, failed attempt
+            pass
+
+    def flush_store(self):
+        segments, items = self.store.drain()
+        with self.cv:
+            self.drained.notify_all()
+
+        try:
+            while segments:
+                self.save(segments[0].read())
+                self.store.release_segment(segments.pop(0))
+
+            self.save(items)
+            self.store.release_items()
+        except datastore.DatastoreException as err:
+            logging.warning('Cannot flush logs: {0}, will retry'.format(err))
+            self.store.requeue(segments, items)
+            self.flush_failing = True
+            return
+
+        self.flush_failing = False
+
     def do_flush(self):
         logging.debug('Flush thread initialized')
         while True:
             # Flush immediately after getting wakeup or when timeout expires
             with self.cv:
-                self.cv.wait(FLUSH_INTERVAL)
+                if not self.exiting:
+                    self.cv.wait(FLUSH_INTERVAL)
 
+                exiting = self.exiting
                 if not self.flush:
+                    if exiting:
+                        return
+
                     continue
 
-                if not self.datastore:
-                    try:
-                        self.init_datastore()
-                        logging.info('Datastore initialized')
-                    except BaseException as err:
-                        logging.warning('Cannot initialize datastore: {0}'.format(err))
-                        logging.warning('Flush skipped')
-                        continue
+            if not self.datastore:
+                try:
+                    self.init_datastore()
+                    logging.info('Datastore initialized')
+                except BaseException as err:
+                    logging.warning('Cannot initialize datastore: {0}'.format(err))
+                    logging.warning('Flush skipped')
+                    if exiting:
+                        return
 
-                logging.debug('Attempting to flush logs')
-                with self.lock:
-                    for i in self.store:
-                        self.datastore.insert('syslog', i)
+                    continue
 
-                    self.store.clear()
+            logging.debug('Attempting to flush logs')
+            self.flush_store()
 
-                if self.exiting:
-                    return
+            if exiting:
+                return
 
     def sigusr1(self, signo, frame):
         with self.cv:
@@ -401,6 +510,7 @@ class Context(object):
         self.init_rpc_server()
         self.init_flush()
         self.load_configuration()
+        self.init_serviced_events()
         checkin()
         signal.signal(signal.SIGUSR1, signal.SIG_DFL)
         signal.signal(signal.SIGHUP, signal.SIG_DFL)
@@ -0,0 +1,475 @@
+#
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import os
+import time
+import bisect
+import logging
+import threading
+import collections
+from datetime import datetime
+from freenas.dispatcher.jsonenc import dumps, loads
+
+
+STORE_CAPACITY = 65536
+SEGMENT_SIZE = 16384
+MAX_SEGMENTS = 64
+SPILL_DIRECTORY = '/var/tmp/logd'
+SEGMENT_SUFFIX = '.segment'
+RANGE_OPERATORS = ('=', '>', '>=', '<', '<=')
+SET_OPERATORS = ('=', 'in')
+
+
+class Segment(object):
+    """
+    Spill file holding entries pushed out of the in-memory ring, one JSON
+    encoded entry per line. Seqno and timestamp bounds are tracked for
+    segments written by this process, so queries can skip them; segments
+    left over from a previous run have unknown bounds and are always read.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.count = 0
+        self.first = None
+        self.last = None
+        self.start = None
+        self.end = None
+
+    @property
+    def bounded(self):
+        return self.first is not None
+
+    def write(self, item):
+        if not self.file:
+            self.file = open(self.path, 'a')
+
+        self.file.write(dumps(item))
+        self.file.write('\n')
+        self.count += 1
+
+        seqno = item['seqno']
+        self.first = seqno if self.first is None else self.first
+        self.last = seqno
+
+        ts = item.get('timestamp')
+        if isinstance(ts, datetime):
+            try:
+                self.start = ts if self.start is None else min(self.start, ts)
+                self.end = ts if self.end is None else max(self.end, ts)
+            except TypeError:
+                pass
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def length(self):
+        """
+        Returns the number of bytes written so far. Must be called with the
+        store locked, as it flushes the file being written by the store.
+        """
+        try:
+            if self.file:
+                self.file.flush()
+                return os.fstat(self.file.fileno()).st_size
+
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def read(self, length=None):
+        """
+        Reads entries back, up to length bytes if given. Does not touch the
+        file being written, so it can be called without holding the lock.
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                offset = 0
+                for line in f:
+                    offset += len(line)
+                    if length is not None and offset > length:
+                        return
+
+                    try:
+                        yield loads(line.decode('utf-8'))
+                    except ValueError:
+                        # Torn write at the end of a segment
+                        continue
+        except FileNotFoundError:
+            return
+
+    def remove(self):
+        self.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def overlaps(self, seqno_range, ts_range):
+        if not self.bounded:
+            return True
+
+        if seqno_range and not ranges_overlap(seqno_range, (self.first, self.last)):
+            return False
+
+        if ts_range and self.start is not None:
+            try:
+                return ranges_overlap(ts_range, (self.start, self.end))
+            except TypeError:
+                return True
+
+        return True
+
+
+def ranges_overlap(a, b):
+    lo, hi = a
+    return (lo is None or b[1] >= lo) and (hi is None or b[0] <= hi)
+
+
+def extract_range(filter, field):
+    """
+    Folds simple comparisons on field found at the top level of a query filter
+    into an inclusive (low, high) range; None means unbounded. Exclusive
+    bounds are treated as inclusive, as the range only narrows candidates
+    that are filtered again afterwards.
+    """
+    lo = hi = None
+    found = False
+    for f in filter:
+        if not isinstance(f, (list, tuple)) or len(f) != 3 or f[0] != field or f[1] not in RANGE_OPERATORS:
+            continue
+
+        _, op, value = f
+        try:
+            if op in ('=', '>', '>=') and (lo is None or value > lo):
+                lo = value
+
+            if op in ('=', '<', '<=') and (hi is None or value < hi):
+                hi = value
+        except TypeError:
+            continue
+
+        found = True
+
+    return (lo, hi) if found else None
+
+
+def extract_set(filter, field):
+    result = None
+    for f in filter:
+        if not isinstance(f, (list, tuple)) or len(f) != 3 or f[0] != field or f[1] not in SET_OPERATORS:
+            continue
+
+        _, op, value = f
+        values = set(value) if op == 'in' else {value}
+        result = values if result is None else result & values
+
+    return result
+
+
+class LogStore(object):
+    """
+    Fixed capacity store for log entries that haven't been flushed to the
+    datastore yet.
+
+    Entries are kept in a ring addressed by seqno, with secondary indexes by
+    timestamp, identifier and priority. When the ring is full, the oldest
+    entry is spilled to a segment file instead of being dropped; once
+    max_segments segments exist, the oldest segment is discarded.
+
+    Drained entries stay in flight, and visible to queries, until the
+    caller releases them after saving.
+    """
+    def __init__(self, capacity=STORE_CAPACITY, directory=SPILL_DIRECTORY,
+                 segment_size=SEGMENT_SIZE, max_segments=MAX_SEGMENTS):
+        self.lock = threading.RLock()
+        self.capacity = capacity
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.logger = logging.getLogger('LogStore')
+        self.ring = [None] * capacity
+        self.first = 0
+        self.next = 0
+        self.segments = []
+        self.spill = None
+        self.inflight_segments = []
+        self.inflight_items = []
+        self.__reset_indexes()
+        self.__load_segments()
+
+    def __len__(self):
+        with self.lock:
+            return self.next - self.first + sum(s.count for s in self.segments)
+
+    @property
+    def full(self):
+        return self.next - self.first >= self.capacity
+
+    def __reset_indexes(self):
+        # by_timestamp is a sorted list of (timestamp, seqno) pairs. Evicted
+        # entries are removed lazily, see __evict()
+        self.by_timestamp = []
+        self.stale_timestamps = 0
+        self.untimed = collections.deque()
+        self.by_identifier = {}
+        self.by_priority = {}
+
+    def __load_segments(self):
+        try:
+            names = [i for i in os.listdir(self.directory) if i.endswith(SEGMENT_SUFFIX)]
+        except FileNotFoundError:
+            return
+
+        for i in sorted(names):
+            self.segments.append(Segment(os.path.join(self.directory, i)))
+
+        if self.segments:
+            self.logger.info('Found {0} spilled log segments from previous run'.format(len(self.segments)))
+
+    def __index(self, item):
+        seqno = item['seqno']
+        self.by_identifier.setdefault(item.get('identifier'), collections.deque()).append(seqno)
+        self.by_priority.setdefault(item.get('priority'), collections.deque()).append(seqno)
+
+        ts = item.get('timestamp')
+        if isinstance(ts, datetime):
+            try:
+                bisect.insort(self.by_timestamp, (ts, seqno))
+                return
+            except TypeError:
+                # Naive and aware timestamps can't be compared
+                pass
+
+        self.untimed.append(seqno)
+
+    def __unindex(self, index, key, seqno):
+        seqnos = index.get(key)
+        if seqnos and seqnos[0] == seqno:
+            seqnos.popleft()
+            if not seqnos:
+                del index[key]
+
+    def __evict(self):
+        seqno = self.first
+        pos = seqno % self.capacity
+        item = self.ring[pos]
+        self.ring[pos] = None
+        self.first += 1
+
+        self.__unindex(self.by_identifier, item.get('identifier'), seqno)
+        self.__unindex(self.by_priority, item.get('priority'), seqno)
+        if self.untimed and self.untimed[0] == seqno:
+            self.untimed.popleft()
+        else:
+            self.stale_timestamps += 1
+            if self.stale_timestamps > self.capacity // 2:
+                self.by_timestamp = [i for i in self.by_timestamp if i[1] >= self.first]
+                self.stale_timestamps = 0
+
+        self.__spill(item)
+
+    def __new_segment(self, seqno):
+        os.makedirs(self.directory, exist_ok=True)
+        name = '{0:020d}-{1:012d}{2}'.format(int(time.time() * 1000000), seqno, SEGMENT_SUFFIX)
+        return Segment(os.path.join(self.directory, name))
+
+    def __trim_segments(self):
+        while len(self.segments) > self.max_segments:
+            dropped = self.segments.pop(0)
+            self.logger.warning('Spill limit reached, discarding {0} log entries'.format(dropped.count))
+            dropped.remove()
+
+    def __spill(self, item):
+        try:
+            if not self.spill or self.spill.count >= self.segment_size:
+                if self.spill:
+                    self.spill.close()
+
+                self.spill = self.__new_segment(item['seqno'])
+                self.segments.append(self.spill)
+                self.__trim_segments()
+
+            self.spill.write(item)
+        except OSError as err:
+            self.logger.warning('Cannot spill log entry: {0}'.format(str(err)))
+
+    def append(self, item):
+        """
+        Stores item, assigning it the next seqno
+        """
+        with self.lock:
+            if self.next - self.first == self.capacity:
+                self.__evict()
+
+            item['seqno'] = self.next
+            self.ring[self.next % self.capacity] = item
+            self.__index(item)
+            self.next += 1
+
+    def __seqno_candidates(self, seqno_range):
+        lo, hi = seqno_range
+        lo = self.first if lo is None else max(lo, self.first)
+        hi = self.next - 1 if hi is None else min(hi, self.next - 1)
+        return range(lo, hi + 1)
+
+    def __timestamp_candidates(self, ts_range):
+        lo, hi = ts_range
+        try:
+            start = 0 if lo is None else bisect.bisect_left(self.by_timestamp, (lo,))
+            end = len(self.by_timestamp) if hi is None else bisect.bisect_right(self.by_timestamp, (hi, float('inf')))
+        except TypeError:
+            return None
+
+        seqnos = {s for _, s in self.by_timestamp[start:end] if s >= self.first}
+        seqnos.update(self.untimed)
+        return seqnos
+
+    def __set_candidates(self, index, keys):
+        seqnos = set()
+        for k in keys:
+            seqnos.update(index.get(k, ()))
+
+        return seqnos
+
+    def query(self, filter=None):
+        """
+        Returns entries that may match filter: in flight ones first, then
+        spilled ones, then the ones held in the ring, each in seqno order. Only simple top level
+        conditions on seqno, timestamp, identifier and priority are used to
+        narrow the result down, so it still has to be filtered by the caller.
+        """
+        filter = filter or []
+        seqno_range = extract_range(filter, 'seqno')
+        ts_range = extract_range(filter, 'timestamp')
+        identifiers = extract_set(filter, 'identifier')
+        priorities = extract_set(filter, 'priority')
+
+        with self.lock:
+            # Segments are read after releasing the lock, only up to what has
+            # been written by now
+            inflight_segments = [(s, s.length()) for s in self.inflight_segments if s.overlaps(seqno_range, ts_range)]
+            inflight = list(self.inflight_items)
+            segments = [(s, s.length()) for s in self.segments if s.overlaps(seqno_range, ts_range)]
+            candidates = None
+
+            def narrow(seqnos):
+                nonlocal candidates
+                if seqnos is not None:
+                    candidates = set(seqnos) if candidates is None else candidates.intersection(seqnos)
+
+            if seqno_range:
+                narrow(self.__seqno_candidates(seqno_range))
+
+            if ts_range:
+                narrow(self.__timestamp_candidates(ts_range))
+
+            if identifiers is not None:
+                narrow(self.__set_candidates(self.by_identifier, identifiers))
+
+            if priorities is not None:
+                narrow(self.__set_candidates(self.by_priority, priorities))
+
+            if candidates is None:
+                seqnos = range(self.first, self.next)
+            else:
+                seqnos = sorted(candidates)
+
+            items = [self.ring[s % self.capacity] for s in seqnos]
+
+        for s, length in inflight_segments:
+            yield from s.read(length)
+
+        yield from inflight
+
+        for s, length in segments:
+            yield from s.read(length)
+
+        yield from items
+
+    def requeue(self, segments, items):
+        """
+        Puts back drained segments and entries that couldn't be saved, ahead
+        of everything stored since. Entries are written to a new segment.
+        """
+        with self.lock:
+            self.inflight_segments = []
+            self.inflight_items = []
+            segments = list(segments)
+            if items:
+                try:
+                    segment = self.__new_segment(items[0]['seqno'])
+                    for i in items:
+                        segment.write(i)
+
+                    segment.close()
+                    segments.append(segment)
+                except OSError as err:
+                    self.logger.warning('Cannot spill {0} log entries: {1}'.format(len(items), str(err)))
+
+            self.segments = segments + self.segments
+            self.__trim_segments()
+
+    def release_segment(self, segment):
+        """
+        Removes a drained segment once its contents have been saved.
+        """
+        with self.lock:
+            self.inflight_segments.remove(segment)
+
+        segment.remove()
+
+    def release_items(self):
+        """
+        Forgets drained entries once they have been saved.
+        """
+        with self.lock:
+            self.inflight_items = []
+
+    def drain(self):
+        """
+        Takes everything out of the store. Returns spilled segments and the
+        list of entries held in memory. Both stay in flight until passed to
+        release_segment() and release_items() once saved, or to requeue().
+        """
+        with self.lock:
+            if self.spill:
+                self.spill.close()
+                self.spill = None
+
+            segments = self.segments
+            items = [self.ring[s % self.capacity] for s in range(self.first, self.next)]
+            self.segments = []
+            self.ring = [None] * self.capacity
+            self.first = self.next
+            self.__reset_indexes()
+            self.inflight_segments = list(segments)
+            self.inflight_items = items
+
+        return segments, items
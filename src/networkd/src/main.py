@@ -44,7 +44,7 @@ import itertools
 from bsd import setproctitle
 from threading import Condition
 from datastore import get_datastore, DatastoreException
-from datastore.config import ConfigStore
+from datastore.config import ConfigStore, CONFIG_CHANGED_EVENT
 from freenas.dispatcher.client import Client, ClientError
 from freenas.dispatcher.rpc import RpcService, RpcException, private, generator
 from freenas.utils.debug import DebugService
@@ -1085,7 +1085,14 @@ class Main(object):
             self.logger.error('Cannot initialize datastore: %s', str(err))
             sys.exit(1)
 
-        self.configstore = ConfigStore(self.datastore)
+        self.configstore = ConfigStore(self.datastore, notify=self.config_changed)
+
+    def config_changed(self, keys):
+        # Dispatcher and task executors cache the config collection
+        try:
+            self.client.emit_event(CONFIG_CHANGED_EVENT, {'keys': keys, 'pid': os.getpid()})
+        except (OSError, RpcException) as err:
+            self.logger.warning('Cannot announce config change: {0}'.format(str(err)))
 
     def connect(self, resume=False):
         while True:
@@ -33,6 +33,10 @@ from freenas.dispatcher.rpc import RpcException
 SERVICED_SOCKET = 'unix:///var/run/serviced.sock'
 _client = Client()
 _lock = Lock()
+# Subscriptions need a connection of their own, as every call on _client
+# disconnects it when done
+_event_client = Client()
+_event_lock = Lock()
 
 
 class ServicedException(RpcException):
@@ -62,11 +66,11 @@ def push_status(status, extra=None):
 
 
 def subscribe(callback):
-    with _lock:
+    with _event_lock:
         try:
-            _client.connect(SERVICED_SOCKET)
-            _client.subscribe_events('serviced.*')
-            _client.on_event(callback)
+            _event_client.connect(SERVICED_SOCKET)
+            _event_client.subscribe_events('serviced.*')
+            _event_client.on_event(callback)
         except RpcException as err:
             raise ServicedException(err.code, err.message, err.extra)
 
@@ -83,6 +87,6 @@ def get_job_by_pid(pid, fuzzy=False):
 
 
 def unsubscribe():
-    with _lock:
-        _client.on_event = None
-        _client.disconnect()
+    with _event_lock:
+        _event_client.on_event = None
+        _event_client.disconnect()
@@ -162,6 +162,7 @@ class Resource(object):
         if type_ == 'task':
             t = Task(self, req.context['client'], method, name=name)
             rv = req.context['result'] = t.run(req, urlparams)['result']
+            self.rest.changes.touch(name.rsplit('.', 1)[0])
         elif type_ == 'atask':
             t = Task(self, req.context['client'], method, name=name)
             rv = req.context['result'] = t.run(req, urlparams, asynchronous=True)
@@ -294,6 +295,25 @@ class ResourceQueryMixin:
 class EntityResource(Resource, ResourceQueryMixin):
 
     def do(self, method, req, resp, *args, **kwargs):
+        if method == 'get':
+            typ, name = self._get_type_name(self.get)
+            if typ == 'rpc':
+                etag = self.rest.changes.get_etag(
+                    name.rsplit('.', 1)[0],
+                    req.context['session'].username,
+                    req.path,
+                    req.query_string
+                )
+
+                if etag:
+                    # Counters are read before running the query, so a change
+                    # racing with it only makes the next request miss
+                    resp.set_header('ETag', etag)
+                    if_none_match = req.get_header('If-None-Match') or ''
+                    if etag in (i.strip().replace('W/', '', 1) for i in if_none_match.split(',')):
+                        resp.status = falcon.HTTP_304
+                        return
+
         rv = super(EntityResource, self).do(method, req, resp, *args, **kwargs)
         if method == 'post':
             typ, name = self._get_type_name(self.post)
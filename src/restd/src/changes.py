@@ -0,0 +1,50 @@
+import hashlib
+import os
+
+
+EVENT_SUFFIX = '.changed'
+ENTITY_SUBSCRIBER_PREFIX = 'entity-subscriber.'
+
+
+class ChangeCounters(object):
+    """
+    Per-service change counters fed from <service>.changed events, used to
+    derive ETags of collection queries. Only services which emit change
+    events get ETags, anything else is always queried.
+    """
+
+    def __init__(self):
+        self.epoch = None
+        self.services = set()
+        self.counters = {}
+        self.reset([])
+
+    def reset(self, event_types):
+        # Events might have been missed, so make all the old ETags stale
+        self.epoch = os.urandom(8).hex()
+        self.counters.clear()
+        self.services = {
+            i[:-len(EVENT_SUFFIX)] for i in event_types
+            if i.endswith(EVENT_SUFFIX) and not i.startswith(ENTITY_SUBSCRIBER_PREFIX)
+        }
+
+    @property
+    def event_types(self):
+        return [i + EVENT_SUFFIX for i in self.services]
+
+    def touch(self, service):
+        self.counters[service] = self.counters.get(service, 0) + 1
+
+    def on_event(self, name, args):
+        if name.endswith(EVENT_SUFFIX) and name[:-len(EVENT_SUFFIX)] in self.services:
+            self.touch(name[:-len(EVENT_SUFFIX)])
+
+    def get_etag(self, service, *extra):
+        if service not in self.services:
+            return None
+
+        digest = hashlib.sha1(':'.join(
+            str(i) for i in (self.epoch, service, self.counters.get(service, 0)) + extra
+        ).encode('utf8'))
+
+        return '"{0}"'.format(digest.hexdigest())
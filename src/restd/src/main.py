@@ -19,7 +19,9 @@ from freenas.serviced import checkin
 
 from gevent.pywsgi import WSGIHandler, WSGIServer
 
-from serializers import JsonEncoder
+from changes import ChangeCounters
+from serializers import JsonStream, GZIP_MIN_SIZE, encode
+from sessions import SessionPool, SESSION_TTL
 from swagger import SwaggerResource
 
 
@@ -61,12 +63,34 @@ class JSONTranslator(object):
                                    'UTF-8.')
 
     def process_response(self, req, resp, resource):
-        if 'result' in req.context:
-            resp.body = JsonEncoder(indent=True).encode(req.context['result'])
+        if 'result' not in req.context:
+            return
+
+        result = req.context['result']
+        gzip = 'gzip' in (req.get_header('Accept-Encoding') or '')
+        resp.set_header('Vary', 'Accept-Encoding')
+
+        if isinstance(result, (dict, str)) or not hasattr(result, '__iter__'):
+            data = encode(result)
+            if gzip and len(data) >= GZIP_MIN_SIZE:
+                data = encode(result, gzip=True)
+                resp.set_header('Content-Encoding', 'gzip')
+
+            resp.data = data
+            return
+
+        # Lists and streamed query results are encoded as they are sent
+        if gzip:
+            resp.set_header('Content-Encoding', 'gzip')
+
+        resp.stream = req.context['stream'] = JsonStream(result, gzip)
 
 
 class AuthMiddleware(object):
 
+    def __init__(self, sessions):
+        self.sessions = sessions
+
     def process_request(self, req, resp):
         # Do not require auth to access index
         if req.relative_uri == '/':
@@ -89,10 +113,9 @@ class AuthMiddleware(object):
             )
 
         try:
-            client = Client()
-            client.connect('unix:')
-            client.login_user(username, password, check_password=True)
-            req.context['client'] = client
+            session = self.sessions.checkout(username, password)
+            req.context['session'] = session
+            req.context['client'] = session.client
         except RpcException as e:
             if e.code == errno.EACCES:
                 raise falcon.HTTPUnauthorized(
@@ -103,8 +126,18 @@ class AuthMiddleware(object):
             raise falcon.HTTPUnauthorized('Unknown authentication error', str(e), ['Basic realm="FreeNAS"'])
 
     def process_response(self, req, resp, resource):
-        if 'client' in req.context:
-            req.context['client'].disconnect()
+        session = req.context.get('session')
+        if not session:
+            return
+
+        if 'stream' in req.context:
+            # Session is still in use until the response body is fully sent
+            req.context['stream'].callbacks.append(
+                lambda complete: self.sessions.checkin(session) if complete else self.sessions.close(session)
+            )
+            return
+
+        self.sessions.checkin(session)
 
 
 class RESTApi(object):
@@ -118,8 +151,10 @@ class RESTApi(object):
         self._used_schemas = set()
         self._services = {}
         self._tasks = {}
+        self.sessions = SessionPool()
+        self.changes = ChangeCounters()
         self.api = falcon.API(middleware=[
-            AuthMiddleware(),
+            AuthMiddleware(self.sessions),
             JSONTranslator(),
         ])
         self.api.add_route('/', SwaggerResource(self))
@@ -134,7 +169,10 @@ class RESTApi(object):
 
         self.dispatcher = Client()
         self.dispatcher.on_error(on_error)
+        self.dispatcher.on_event(self.changes.on_event)
         self.connect()
+        self.dispatcher.register_event_handler('user.changed', self.sessions.on_user_changed)
+        self.dispatcher.register_event_handler('server.client_logout', self.sessions.on_logout)
 
     def init_metadata(self):
         self._tasks = self.dispatcher.call_sync('discovery.get_tasks')
@@ -160,6 +198,13 @@ class RESTApi(object):
             try:
                 self.dispatcher.connect('unix:')
                 self.dispatcher.login_service('restd')
+                self.changes.reset(self.dispatcher.call_sync('event.get_event_types'))
+                # Subscribed by name, as a wildcard would also match (and keep running)
+                # every entity-subscriber event source
+                self.dispatcher.subscribe_events(*self.changes.event_types)
+                # Handlers are registered once, but subscriptions don't survive
+                # a dispatcher restart
+                self.dispatcher.subscribe_events('user.changed', 'server.client_logout')
                 return
             except (OSError, RpcException) as err:
                 self.logger.warning('Cannot connect to dispatcher: {0}, retrying in 1 second'.format(str(err)))
@@ -186,10 +231,18 @@ class RESTApi(object):
         self.load_plugins()
 
         server4 = WSGIServer(('0.0.0.0', 8889), self, handler_class=RESTWSGIHandler)
-        self._threads = [gevent.spawn(server4.serve_forever)]
+        self._threads = [
+            gevent.spawn(server4.serve_forever),
+            gevent.spawn(self.expire_sessions)
+        ]
         checkin()
         gevent.joinall(self._threads)
 
+    def expire_sessions(self):
+        while True:
+            gevent.sleep(SESSION_TTL)
+            self.sessions.expire()
+
     def die(self, *args):
         gevent.killall(self._threads)
         sys.exit(0)
@@ -1,6 +1,11 @@
 from datetime import datetime
 
 import json
+import zlib
+
+
+STREAM_CHUNK_SIZE = 65536
+GZIP_MIN_SIZE = 1024
 
 
 class JsonEncoder(json.JSONEncoder):
@@ -8,3 +13,78 @@ class JsonEncoder(json.JSONEncoder):
         if isinstance(obj, datetime):
             return str(obj)
         return json.JSONEncoder.default(self, obj)
+
+
+def compressor():
+    return zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+
+
+def encode(obj, gzip=False):
+    body = JsonEncoder(separators=(',', ':')).encode(obj).encode('utf8')
+    if gzip:
+        c = compressor()
+        return c.compress(body) + c.flush()
+
+    return body
+
+
+class JsonStream(object):
+    """
+    WSGI response body encoding a sequence of objects as a JSON array,
+    a chunk at a time. Callbacks added to `callbacks` are called on close
+    with a flag telling whether the whole sequence has been sent.
+    """
+
+    def __init__(self, iterable, gzip=False):
+        self.iterable = iterable
+        self.compressor = compressor() if gzip else None
+        self.callbacks = []
+        self.complete = False
+        self.closed = False
+
+    def __iter__(self):
+        encoder = JsonEncoder(separators=(',', ':'))
+        buffer = ['[']
+        size = 1
+        first = True
+
+        for i in self.iterable:
+            if not first:
+                buffer.append(',')
+
+            first = False
+            chunk = encoder.encode(i)
+            buffer.append(chunk)
+            size += len(chunk) + 1
+            if size >= STREAM_CHUNK_SIZE:
+                data = self.compress(''.join(buffer))
+                buffer = []
+                size = 0
+                if data:
+                    yield data
+
+        buffer.append(']')
+        data = self.compress(''.join(buffer))
+        if self.compressor:
+            data += self.compressor.flush()
+
+        self.complete = True
+        yield data
+
+    def compress(self, data):
+        data = data.encode('utf8')
+        if self.compressor:
+            return self.compressor.compress(data)
+
+        return data
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        if hasattr(self.iterable, 'close'):
+            self.iterable.close()
+
+        for i in self.callbacks:
+            i(self.complete)
@@ -0,0 +1,150 @@
+import hashlib
+import hmac
+import logging
+import os
+import time
+
+from freenas.dispatcher.client import Client
+
+
+SESSION_TTL = 60
+MAX_IDLE_SESSIONS = 4
+
+
+class Session(object):
+
+    def __init__(self, key, username, client, generation):
+        self.key = key
+        self.username = username
+        self.client = client
+        self.generation = generation
+        self.address = None
+        self.created_at = time.monotonic()
+        self.valid = True
+
+    @property
+    def expired(self):
+        return time.monotonic() - self.created_at > SESSION_TTL
+
+
+class SessionPool(object):
+    """
+    Keeps authenticated dispatcher connections around between requests.
+    Sessions are keyed by a digest of the credentials salted with a per
+    process secret, so passwords are not kept after the initial login.
+
+    Revoking sessions bumps a generation counter, either global or per
+    user. Sessions carry the generation they were created in and are
+    never reused once it's outdated, even if they were checked out at
+    the time of revocation.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger('SessionPool')
+        self.salt = os.urandom(32)
+        self.idle = {}
+        self.generation = 0
+        self.user_generations = {}
+        self.own_logouts = {}
+
+    def digest(self, username, password):
+        return hmac.new(self.salt, '{0}:{1}'.format(username, password).encode('utf8'), hashlib.sha256).digest()
+
+    def get_generation(self, username):
+        return self.generation, self.user_generations.get(username, 0)
+
+    def usable(self, session):
+        return session.valid and not session.expired and session.generation == self.get_generation(session.username)
+
+    def checkout(self, username, password):
+        key = self.digest(username, password)
+        sessions = self.idle.get(key)
+        while sessions:
+            session = sessions.pop()
+            if self.usable(session):
+                return session
+
+            self.close(session)
+
+        # Taken before logging in, so that revocations done meanwhile apply
+        generation = self.get_generation(username)
+        client = Client()
+        client.connect('unix:')
+        try:
+            client.login_user(username, password, check_password=True)
+            client.call_sync('management.enable_features', ['streaming_responses'])
+            address = client.call_sync('management.get_sender_address')
+        except BaseException:
+            client.disconnect()
+            raise
+
+        session = Session(key, username, client, generation)
+        session.address = address
+        client.on_error(lambda reason, **kwargs: self.discard(session))
+        return session
+
+    def checkin(self, session):
+        sessions = self.idle.setdefault(session.key, [])
+        if not self.usable(session) or len(sessions) >= MAX_IDLE_SESSIONS:
+            self.close(session)
+            return
+
+        sessions.append(session)
+
+    def discard(self, session):
+        session.valid = False
+        sessions = self.idle.get(session.key, [])
+        if session in sessions:
+            sessions.remove(session)
+
+    def close(self, session):
+        # Only a live connection gets a server.client_logout event
+        live = session.valid and session.address
+        self.discard(session)
+        if live:
+            # Recorded up front, the event may be handled before disconnect() returns
+            self.own_logouts[session.address] = time.monotonic()
+
+        try:
+            session.client.disconnect()
+        except BaseException:
+            if live:
+                self.own_logouts.pop(session.address, None)
+
+    def revoke(self, username=None):
+        if username is None:
+            self.generation += 1
+        else:
+            self.user_generations[username] = self.user_generations.get(username, 0) + 1
+
+        for sessions in list(self.idle.values()):
+            for i in list(sessions):
+                if username is None or i.username == username:
+                    self.close(i)
+
+    def expire(self):
+        for sessions in list(self.idle.values()):
+            for i in list(sessions):
+                if i.expired:
+                    self.close(i)
+
+        for key in [k for k, v in self.idle.items() if not v]:
+            del self.idle[key]
+
+        # Logout events that never arrived, e.g. while reconnecting to dispatcher
+        now = time.monotonic()
+        for address in [k for k, v in self.own_logouts.items() if now - v > SESSION_TTL]:
+            del self.own_logouts[address]
+
+    def on_logout(self, args):
+        # Disconnects done by the pool itself show up here as well
+        if self.own_logouts.pop(args.get('address'), None) is not None:
+            return
+
+        username = args.get('username')
+        self.logger.debug('User {0} logged out, revoking pooled sessions'.format(username))
+        self.revoke(username)
+
+    def on_user_changed(self, args):
+        # Passwords could have changed, make everyone log in again
+        self.revoke()